@@ -1,57 +1,339 @@
-from io import StringIO
-from uuid import uuid4
-import psycopg2
-from fastapi import FastAPI, APIRouter
-from starlette.background import BackgroundTasks
-from starlette.responses import JSONResponse, Response
+import sys
+from contextlib import asynccontextmanager
+from datetime import datetime
+from time import perf_counter
+from typing import List
+from urllib.parse import urlencode
 
-from reporting import create_report, generate_report_data, is_report_completed, get_report_data, convert_to_csv
+from fastapi import FastAPI, APIRouter, Depends, Header, Query, Request
+from psycopg2 import DatabaseError
+from pytz import utc
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
-app = FastAPI()
+from reporting import get_report_status, iter_report_csv, REPORT_CSV_HEADER, REPORT_ENGINES
+from db import close_pool, pooled_connection, prepare_statements
+from jobs import DEFAULT_JOB_PRIORITY, cancel_report_job, enqueue_report_job, observe_finished_reports
+from metrics import UPTIME_QUERY_SECONDS, render_metrics
+from report_artifacts import REPORT_CACHE_CONTROL, REPORT_FORMATS, etag_matches, get_available_report_formats, \
+    get_report_artifact, iter_report_artifact, negotiate_report_format, parse_byte_range, try_write_report_artifacts
+from report_cache import get_or_create_report
+from report_query import DEFAULT_PAGE_SIZE, MAX_FILTER_STORE_IDS, MAX_PAGE_SIZE, decode_report_cursor, \
+    encode_report_cursor, get_report_query_key, parse_report_filter, query_report_data
+from schema import bootstrap_schema
+
+INGEST_RETRY_AFTER_SECONDS = 1
+# How soon a download waiting for the files of a report written by another request is retried
+ARTIFACT_RETRY_AFTER_SECONDS = 5
+# How long a query waits for the first uptime index of the process to be built
+UPTIME_INDEX_WAIT_SECONDS = 30
+# The statements of the report status polls, prepared on the pool's first connection when the API starts
+API_PREPARED_STATEMENTS = ('report_status', 'report_progress')
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """
+    Creates the tables of the service and prepares the hot statements once when the API starts, so requests run no
+    DDL; if the database is not reachable yet, the first request that needs it does this instead. Stops the
+    background threads and closes the pool when the API shuts down. `ingestion` and `uptime_index` (and with them
+    pandas and NumPy) are only imported by the first request that uses them.
+    """
+    try:
+        with pooled_connection() as connection:
+            bootstrap_schema(connection)
+            prepare_statements(connection, API_PREPARED_STATEMENTS)
+            connection.commit()
+    except DatabaseError as error:
+        print(f'Bootstrapping the schema on startup failed: {error}')
+    yield
+    if 'ingestion' in sys.modules:
+        sys.modules['ingestion'].close_status_ingest_queue()
+    if 'uptime_index' in sys.modules:
+        sys.modules['uptime_index'].close_uptime_index_refresher()
+    close_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 
 api_router = APIRouter()
 
-_connection = psycopg2.connect(
-    host="localhost",
-    database="loop_datastore_db",
-    user="loop_datastore_admin",
-    password="top_secret"
-)
+
+def get_connection():
+    """
+    Lends a pooled connection to a single request.
+    """
+    with pooled_connection() as connection:
+        bootstrap_schema(connection)
+        yield connection
+
+
+def stream_report_artifact(report_id: str, report_format: str, first_byte: int, byte_count: int):
+    """
+    Streams a byte range of a report artifact from a pooled connection held only while the response body is sent.
+    """
+    with pooled_connection() as connection:
+        yield from iter_report_artifact(connection, report_id, report_format, first_byte, byte_count)
 
 
 @api_router.get('/trigger_report')
-def trigger_report(background_tasks: BackgroundTasks):
+def trigger_report(engine: str = 'python', shards: int = 0, force: bool = False, priority: int = DEFAULT_JOB_PRIORITY,
+                   connection=Depends(get_connection)):
+    """
+    Triggers the creation of a report and queues its generation for the report workers (see `worker.py`). A report
+    triggered earlier in the same hour, on the same data and with the same engine is returned instead, whether it is
+    still running or completed.
+
+    :param engine: The report engine computing the report, one of `REPORT_ENGINES`.
+    :param shards: Split the stores into this many shards computed by a pool of worker processes,
+            or compute the report in the job itself when 0.
+    :param force: Generate a new report even if a cached one exists.
+    :param priority: Reports with a higher priority are generated first.
+    :param connection: A pooled connection lent to this request.
+
+    :return: A JSON response containing the report ID and a status code of 201, or 200 for a cached report.
+    """
+    if engine not in REPORT_ENGINES:
+        return JSONResponse(status_code=400, content={"error": f"Unknown report engine \"{engine}\"."})
+    now = datetime.now(utc)
+    report_id, created = get_or_create_report(
+        connection, engine, now, force=force,
+        on_create=lambda cursor, created_report_id: enqueue_report_job(cursor, created_report_id, engine, now, shards,
+                                                                        priority))
+    if not created:
+        return JSONResponse(status_code=200, content={"report_id": report_id, "cached": True})
+    return JSONResponse(status_code=201, content={"report_id": report_id})
+
+
+@api_router.post('/cancel_report/{report_id}')
+def cancel_report(report_id: str, connection=Depends(get_connection)):
+    """
+    Cancels a report that is still queued or running.
+
+    :param report_id: The ID of the report to cancel.
+    :param connection: A pooled connection lent to this request.
+
+    :return: A JSON response with a status code of 200 if the report was cancelled, 404 if it does not exist or 409
+            if it already finished.
     """
-    Triggers the creation and generation of a report in the background.
+    if cancel_report_job(connection, report_id):
+        return JSONResponse(status_code=200, content={"report_id": report_id, "status": "Cancelled"})
+    report_status = get_report_status(connection, report_id)
+    if report_status is None:
+        return JSONResponse(status_code=404, content={"error": "Report not found."})
+    return JSONResponse(status_code=409, content={"error": f"Report is {report_status['status']}."})
+
 
-    :param background_tasks: The background task manager.
+def get_report_page(connection, request: Request, report_id: str, accept: str, store_ids: List[int],
+                    store_id_min: int | None, store_id_max: int | None, filter_expressions: List[str],
+                    limit: int | None, cursor: str | None):
+    """
+    Serves a page of the rows of a completed report that pass the filters of the request, as CSV or, if the
+    Accept header asks for it, as JSON. The page is read with `report_query.query_report_data`; if more rows
+    follow, the cursor of the next page is returned in the X-Next-Cursor and Link headers (and the JSON body).
 
-    :return: A JSON response containing the report ID and a status code of 201.
+    :return: The page, or a 400 JSON response for invalid filters, limit or cursor.
     """
-    report_id = str(uuid4())
-    background_tasks.add_task(create_report, _connection, report_id)
-    background_tasks.add_task(generate_report_data, _connection, report_id)
-    return JSONResponse(status_code=201, content={"report_id": report_id}, background=background_tasks)
+    limit = DEFAULT_PAGE_SIZE if limit is None else limit
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        return JSONResponse(status_code=400, content={"error": f"The limit must be between 1 and {MAX_PAGE_SIZE}."})
+    if len(store_ids) > MAX_FILTER_STORE_IDS:
+        return JSONResponse(status_code=400,
+                            content={"error": f"At most {MAX_FILTER_STORE_IDS} store ids can be requested at once."})
+    store_range = None
+    if store_id_min is not None or store_id_max is not None:
+        store_range = (store_id_min if store_id_min is not None else -2 ** 63,
+                       store_id_max if store_id_max is not None else 2 ** 63 - 1)
+    try:
+        filters = [parse_report_filter(expression) for expression in filter_expressions]
+        query_key = get_report_query_key(report_id, store_ids, store_range, filters)
+        after_store_id = decode_report_cursor(cursor, query_key) if cursor else None
+    except ValueError as error:
+        return JSONResponse(status_code=400, content={"error": str(error)})
+
+    # One row more than the page tells whether another page follows
+    report_rows = query_report_data(connection, report_id, store_ids, store_range, filters, after_store_id, limit + 1)
+    next_cursor = None
+    headers = {"Vary": "Accept"}
+    if len(report_rows) > limit:
+        report_rows = report_rows[:limit]
+        next_cursor = encode_report_cursor(query_key, report_rows[-1][0])
+        query = [('store_id', store_id) for store_id in store_ids]
+        query += [(name, value) for name, value in (('store_id_min', store_id_min), ('store_id_max', store_id_max))
+                  if value is not None]
+        query += [('filter', expression) for expression in filter_expressions]
+        query += [('limit', limit), ('cursor', next_cursor)]
+        headers.update({"X-Next-Cursor": next_cursor,
+                        "Link": f'<{request.url.path}?{urlencode(query)}>; rel="next"'})
+    if 'application/json' in accept.lower():
+        return JSONResponse(status_code=200, headers=headers, content={
+            "report_id": report_id,
+            "rows": [dict(zip(REPORT_CSV_HEADER, report_row)) for report_row in report_rows],
+            "next_cursor": next_cursor})
+    return Response(''.join(iter_report_csv(report_rows)), status_code=200, media_type='text/csv', headers=headers)
 
 
 @api_router.get('/get_report/{report_id}')
-def get_report(report_id: str):
+def get_report(report_id: str, request: Request, connection=Depends(get_connection), accept: str = Header(default=''),
+               accept_encoding: str = Header(default=''), if_none_match: str = Header(default=''),
+               range_header: str = Header(default='', alias='Range'), if_range: str = Header(default=''),
+               store_id: List[int] = Query(default=[]), store_id_min: int | None = None,
+               store_id_max: int | None = None, filter_expressions: List[str] = Query(default=[], alias='filter'),
+               limit: int | None = None, cursor: str | None = None):
     """
-    Retrieves a report with the given ID from the database.
+    Retrieves a report with the given ID from the database. Completed reports are served from the files written
+    once by `report_artifacts.py`, in the format negotiated from the Accept and Accept-Encoding headers: CSV
+    (plain, gzip or zstd encoded), Parquet or Arrow IPC. Each file has an ETag, so clients polling a report get a
+    304 with If-None-Match, and a single byte range can be requested with Range. While the report is running, or
+    if it failed, its status and progress are returned instead: the stores processed out of the total, the start
+    and finish times and the seconds spent per stage. A report completed outside of the report workers gets its files
+    on its first download; concurrent downloads get a 503 with Retry-After until they are written.
+
+    With any of the query parameters below, only the matching rows are returned, a page at a time ordered by store
+    id (see `get_report_page`), e.g. `?store_id_min=100&store_id_max=200&filter=uptime_last_day<30&limit=50`; the
+    next page is requested with the cursor of the previous one and the same filters.
 
     :param report_id: The ID of the report to retrieve.
+    :param request: The request, whose path the link to the next page uses.
+    :param connection: A pooled connection lent to this request.
+    :param accept: The Accept header of the request.
+    :param accept_encoding: The Accept-Encoding header of the request.
+    :param if_none_match: The If-None-Match header of the request.
+    :param range_header: The Range header of the request.
+    :param if_range: The If-Range header of the request; the range is only sent if it matches the ETag.
+    :param store_id: Only return these stores; may be repeated.
+    :param store_id_min: Only return the stores with this id or a higher one.
+    :param store_id_max: Only return the stores with this id or a lower one.
+    :param filter_expressions: Threshold filters on report columns such as `uptime_last_day<30`, given as
+            `filter`; may be repeated, and every one must pass.
+    :param limit: The maximum number of rows of a page, `DEFAULT_PAGE_SIZE` by default.
+    :param cursor: The cursor of the page to return, from the X-Next-Cursor header of the previous page.
 
     return: The report with the given ID, or None if no such report exists.
     """
-    is_completed = is_report_completed(_connection, report_id)
-    if is_completed is None:
+    report_status = get_report_status(connection, report_id)
+    if report_status is None:
         return JSONResponse(status_code=404, content={"error": "Report not found."})
-    if not is_completed:
-        return Response(status_code=200, content="Running")
-    report_data = get_report_data(_connection, report_id)
-    csv_string = convert_to_csv(report_data)
-    csv_file = StringIO(csv_string)
-    return Response(content=csv_file.getvalue(), media_type="text/csv")
+    if report_status['status'] != 'Completed':
+        return JSONResponse(status_code=200, content=report_status)
+    if store_id or store_id_min is not None or store_id_max is not None or filter_expressions or limit is not None \
+            or cursor:
+        return get_report_page(connection, request, report_id, accept, store_id, store_id_min, store_id_max,
+                               filter_expressions, limit, cursor)
+
+    available_formats = get_available_report_formats()
+    report_format = negotiate_report_format(accept, accept_encoding, available_formats)
+    if report_format is None:
+        return JSONResponse(status_code=406, content={
+            "error": "None of the report formats is acceptable.",
+            "media_types": sorted({REPORT_FORMATS[available][0] for available in available_formats})})
+    artifact = get_report_artifact(connection, report_id, report_format)
+    if artifact is None:
+        # Reports completed outside of the report workers have no artifacts yet; the first download writes them,
+        # and the concurrent ones come back later instead of encoding the report again
+        if not try_write_report_artifacts(connection, report_id):
+            return JSONResponse(status_code=503, content={"error": "The report files are being written."},
+                                headers={"Retry-After": str(ARTIFACT_RETRY_AFTER_SECONDS)})
+        artifact = get_report_artifact(connection, report_id, report_format)
+        if artifact is None:
+            # Deleted by compaction meanwhile
+            return JSONResponse(status_code=404, content={"error": "Report not found."})
+    etag, size = artifact
+    media_type, content_encoding, extension = REPORT_FORMATS[report_format]
+    headers = {"ETag": etag, "Cache-Control": REPORT_CACHE_CONTROL, "Vary": "Accept, Accept-Encoding"}
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    headers.update({"Accept-Ranges": "bytes", "Content-Disposition": f"attachment; filename={report_id}.{extension}"})
+    byte_range = None
+    if range_header and (not if_range or if_range == etag):
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers=dict(headers, **{"Content-Range": f"bytes */{size}"}))
+    first_byte, last_byte = byte_range or (0, size - 1)
+    # Only the responses carrying the (encoded) artifact say how it is encoded; clients decode a bodyless 304 or
+    # 416 with a Content-Encoding as truncated data
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    headers["Content-Length"] = str(last_byte - first_byte + 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {first_byte}-{last_byte}/{size}"
+    return StreamingResponse(stream_report_artifact(report_id, report_format, first_byte, last_byte - first_byte + 1),
+                             status_code=206 if byte_range else 200, media_type=media_type, headers=headers)
+
+
+@api_router.post('/status')
+async def ingest_status(request: Request):
+    """
+    Queues a batch of status checks to be written to "StoreStatus", as a JSON array of objects or as NDJSON
+    (Content-Type: application/x-ndjson). Every object has the fields store_id, status and timestamp_utc.
+
+    :param request: The request carrying the batch.
+
+    :return: A JSON response with the number of accepted rows and a status code of 202, 400 for a malformed
+            batch or 429 when the ingest queue is full.
+    """
+    from ingestion import IngestQueueFull, get_status_ingest_queue, parse_status_payload
+    try:
+        status_checks = parse_status_payload(await request.body(), request.headers.get('content-type', ''))
+    except (ValueError, TypeError) as error:
+        return JSONResponse(status_code=400, content={"error": str(error)})
+    try:
+        queued_rows = get_status_ingest_queue().submit(status_checks)
+    except IngestQueueFull as error:
+        return JSONResponse(status_code=429, content={"error": str(error)},
+                            headers={"Retry-After": str(INGEST_RETRY_AFTER_SECONDS)})
+    return JSONResponse(status_code=202, content={"accepted": len(status_checks), "queued": queued_rows})
+
+
+@api_router.get('/uptime')
+def get_uptime(store_id: int, start: datetime, end: datetime):
+    """
+    Calculates the uptime and downtime of a store within its business hours in any window, with the same estimate
+    as the reports, from the in-memory index of `uptime_index.py` instead of a report. The index is refreshed
+    every `UPTIME_INDEX_REFRESH_SECONDS` and holds the last `UPTIME_INDEX_DAYS` days of status checks.
+
+    :param store_id: The ID of the store.
+    :param start: The start of the window (inclusive), an ISO 8601 datetime, in UTC if it has no offset.
+    :param end: The end of the window (exclusive), an ISO 8601 datetime, in UTC if it has no offset.
+
+    :return: A JSON response with the uptime and downtime in seconds, 400 for an invalid window, 404 for an
+            unknown store or 503 (with Retry-After) while the index is first built.
+    """
+    from uptime_index import get_uptime_index_refresher
+    start = start if start.tzinfo else utc.localize(start)
+    end = end if end.tzinfo else utc.localize(end)
+    if start >= end:
+        return JSONResponse(status_code=400, content={"error": "The window must end after it starts."})
+    uptime_index = get_uptime_index_refresher().get_index(UPTIME_INDEX_WAIT_SECONDS)
+    if uptime_index is None:
+        return JSONResponse(status_code=503, content={"error": "The uptime index is not built yet."},
+                            headers={"Retry-After": str(UPTIME_INDEX_WAIT_SECONDS)})
+    if not uptime_index.covers(start):
+        return JSONResponse(status_code=400, content={
+            "error": "The window starts before the indexed status checks.",
+            "indexed_since": datetime.fromtimestamp(uptime_index.status_index.since_us / 1e6, utc).isoformat()})
+    started_at = perf_counter()
+    uptime_and_downtime = uptime_index.get_uptime_and_downtime(store_id, start, end)
+    UPTIME_QUERY_SECONDS.observe(perf_counter() - started_at)
+    if uptime_and_downtime is None:
+        return JSONResponse(status_code=404, content={"error": "Store not found."})
+    uptime, downtime = uptime_and_downtime
+    return JSONResponse(status_code=200, content={
+        "store_id": store_id, "start": start.isoformat(), "end": end.isoformat(),
+        "uptime_seconds": uptime.total_seconds(), "downtime_seconds": downtime.total_seconds()})
+
+
+@app.get('/metrics')
+def metrics():
+    """
+    Exposes the metrics of this API process in the Prometheus text format: report durations and stage times, queued
+    and running report jobs, database statement latencies, the ingest queue depth and rate, and the age and query
+    latency of the uptime index. The reports are generated by the report workers, so their durations, stage times
+    and processed stores are read from "ReportStatus" (see `jobs.observe_finished_reports`).
+    """
+    observe_finished_reports()
+    return Response(content=render_metrics(), media_type='text/plain; version=0.0.4')
 
 
 app.include_router(api_router, prefix='/api/v1')
@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+from urllib.request import Request, urlopen
+from uuid import uuid4
+
+import psycopg2
+from pytz import utc
+
+from db import get_connection_parameters
+from reporting import REPORT_ENGINES
+
+BENCHMARK_DATABASE = 'loop_benchmark_db'
+BENCHMARK_DIRECTORY = 'benchmark_results'
+DEFAULT_SCALES = (1_000, 10_000, 100_000)
+DEFAULT_ENGINES = ('sweep', 'vectorized', 'sql')
+SERVER_START_TIMEOUT_SECONDS = 30
+
+
+def get_peak_rss_mb() -> float:
+    """
+    :return: The peak resident set size of this process and of its finished worker processes in megabytes.
+    """
+    # The high water mark of /proc starts over at exec, while ru_maxrss inherits the RSS of the forking parent
+    try:
+        with open('/proc/self/status') as status_file:
+            own_kilobytes = next(int(line.split()[1]) for line in status_file if line.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        own_kilobytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux
+    return round(max(own_kilobytes, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024, 1)
+
+
+def run_step(step: str, *arguments: str, environment: dict) -> dict:
+    """
+    Runs one benchmark step in a fresh Python process, so its peak resident set size is measured on its own.
+
+    :param step: The name of the step, see `STEPS`.
+    :param arguments: The arguments of the step.
+    :param environment: The environment of the process, pointing it at the benchmark database.
+
+    :return: The JSON result printed by the step, including the peak RSS of its process.
+    """
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), 'step', step, *arguments],
+                            env=environment, stdout=subprocess.PIPE, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(f'Benchmark step "{step}" failed with exit code {output.returncode}')
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def step_ingest(mode: str) -> dict:
+    from sequelize import create_tables, populate_tables
+
+    connection = psycopg2.connect(**get_connection_parameters())
+    started_at = time.perf_counter()
+    create_tables(connection)
+    populate_tables(connection, mode)
+    seconds = time.perf_counter() - started_at
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT (SELECT COUNT(*) FROM "StoreStatus"), (SELECT COUNT(*) FROM "StoreTimezones")')
+        status_count, store_count = cursor.fetchone()
+    connection.close()
+    return {'seconds': round(seconds, 3), 'status_rows': status_count, 'stores': store_count,
+            'rows_per_second': round(status_count / seconds)}
+
+
+def step_report(engine: str, now: str) -> dict:
+    from reporting import create_report, generate_report_data
+    from report_artifacts import create_report_artifacts_table, write_report_artifacts
+
+    connection = psycopg2.connect(**get_connection_parameters())
+    create_report_artifacts_table(connection)
+    report_id = str(uuid4())
+    create_report(connection, report_id)
+    started_at = time.perf_counter()
+    generate_report_data(connection, report_id, engine, datetime.fromisoformat(now))
+    seconds = time.perf_counter() - started_at
+    # As the report workers do, so downloads are served from the artifacts
+    artifacts_started_at = time.perf_counter()
+    artifact_sizes = write_report_artifacts(connection, report_id)
+    artifact_seconds = time.perf_counter() - artifacts_started_at
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM "ReportData" WHERE "report_id" = %s', (report_id,))
+        row_count = cursor.fetchone()[0]
+    connection.close()
+    return {'report_id': report_id, 'seconds': round(seconds, 3), 'stores': row_count,
+            'stores_per_second': round(row_count / seconds), 'artifact_seconds': round(artifact_seconds, 3),
+            'artifact_bytes': artifact_sizes}
+
+
+def step_download(report_id: str, compressed: str) -> dict:
+    """
+    Serves the API with uvicorn in this process and downloads a report through `/get_report`.
+    """
+    import uvicorn
+    from threading import Thread
+
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port = free_socket.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config('api:app', host='127.0.0.1', port=port, log_level='warning'))
+    Thread(target=server.run, daemon=True).start()
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_SECONDS
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError('The API server did not start')
+        time.sleep(0.05)
+
+    request = Request(f'http://127.0.0.1:{port}/api/v1/get_report/{report_id}',
+                      headers={'Accept-Encoding': 'gzip' if compressed == 'gzip' else 'identity'})
+    started_at = time.perf_counter()
+    with urlopen(request) as response:
+        first_chunk = response.read(1)
+        first_byte_seconds = time.perf_counter() - started_at
+        size = len(first_chunk) + len(response.read())
+    seconds = time.perf_counter() - started_at
+    server.should_exit = True
+    return {'seconds': round(seconds, 3), 'first_byte_seconds': round(first_byte_seconds, 4), 'bytes': size,
+            'megabytes_per_second': round(size / 1024 / 1024 / seconds, 2)}
+
+
+STEPS = {'ingest': step_ingest, 'report': step_report, 'download': step_download}
+
+
+def reset_database(database: str) -> None:
+    """
+    Drops and creates the benchmark database, so every scale starts from an empty datastore.
+    """
+    connection = psycopg2.connect(**dict(get_connection_parameters(), dbname='postgres'))
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE IF EXISTS "{database}"')
+        cursor.execute(f'CREATE DATABASE "{database}"')
+    connection.close()
+
+
+def run_benchmark(scales=DEFAULT_SCALES, engines=DEFAULT_ENGINES, polls_per_hour: float = 1.0,
+                  ingest_mode: str = 'chunked', database: str = BENCHMARK_DATABASE,
+                  output_directory: str = BENCHMARK_DIRECTORY) -> str:
+    """
+    Generates synthetic data at every scale, loads it into an empty benchmark database, generates a report with
+    every engine and downloads one through the API, recording the duration, throughput and peak RSS of each step.
+
+    :param scales: The store counts to benchmark.
+    :param engines: The report engines to benchmark.
+    :param polls_per_hour: The average number of status checks per store and hour of the generated data.
+    :param ingest_mode: The `sequelize.populate_tables` mode.
+    :param database: The benchmark database; it is dropped and created again for every scale.
+    :param output_directory: The directory to write the JSON results to.
+
+    :return: The path of the JSON results.
+    """
+    from generate_data import generate_data
+
+    now = datetime.now(utc)
+    results = {
+        'started_at': now.isoformat(),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()},
+        'parameters': {'polls_per_hour': polls_per_hour, 'ingest_mode': ingest_mode, 'engines': list(engines)},
+        'scales': [],
+    }
+    environment = dict(os.environ, POSTGRES_DB=database)
+    for stores in scales:
+        print(f'Benchmarking {stores} stores...')
+        work_directory = os.path.join(output_directory, f'data_{stores}')
+        row_counts = generate_data(os.path.join(work_directory, 'data_source'), stores, polls_per_hour, end=now)
+        reset_database(database)
+        scale_results = {'stores': stores, 'source_rows': row_counts}
+        step_environment = dict(environment, PYTHONPATH=os.pathsep.join(filter(None, [
+            os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH')])))
+
+        # The loaders read data_source/ relative to the working directory
+        current_directory = os.getcwd()
+        os.chdir(work_directory)
+        try:
+            scale_results['ingest'] = run_step('ingest', ingest_mode, environment=step_environment)
+            scale_results['reports'] = {engine: run_step('report', engine, now.isoformat(),
+                                                         environment=step_environment)
+                                        for engine in engines}
+            report_id = scale_results['reports'][engines[0]]['report_id']
+            scale_results['download'] = {encoding: run_step('download', report_id, encoding,
+                                                            environment=step_environment)
+                                         for encoding in ('identity', 'gzip')}
+        finally:
+            os.chdir(current_directory)
+        results['scales'].append(scale_results)
+        print(json.dumps(scale_results, indent=2))
+
+    results_path = os.path.join(output_directory, f'benchmark-{now:%Y%m%dT%H%M%S}.json')
+    with open(results_path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    return results_path
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'step':
+        _result = STEPS[sys.argv[2]](*sys.argv[3:])
+        print(json.dumps(dict(_result, peak_rss_mb=get_peak_rss_mb())))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Benchmarks ingestion, report generation and report download.')
+    parser.add_argument('--scales', type=lambda value: [int(scale) for scale in value.split(',')],
+                        default=list(DEFAULT_SCALES), help='Comma separated store counts.')
+    parser.add_argument('--engines', type=lambda value: value.split(','), default=list(DEFAULT_ENGINES),
+                        help=f'Comma separated report engines out of {", ".join(REPORT_ENGINES)}.')
+    parser.add_argument('--polls-per-hour', type=float, default=1.0)
+    parser.add_argument('--ingest-mode', choices=['chunked', 'copy', 'row'], default='chunked')
+    parser.add_argument('--database', default=BENCHMARK_DATABASE,
+                        help='The benchmark database, dropped and created again for every scale.')
+    parser.add_argument('--output', default=BENCHMARK_DIRECTORY)
+    arguments = parser.parse_args()
+    unknown_engines = set(arguments.engines) - set(REPORT_ENGINES)
+    if unknown_engines:
+        parser.error(f'Unknown report engines: {", ".join(sorted(unknown_engines))}')
+
+    print(f'Results written to {run_benchmark(arguments.scales, arguments.engines, arguments.polls_per_hour, arguments.ingest_mode, arguments.database, arguments.output)}')
@@ -0,0 +1,120 @@
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from threading import Lock
+
+from pytz import timezone, utc
+
+from type_defs import BusinessIntervalList, StoreBusinessHoursListRaw
+
+# Expanded calendars reach this many days past the requested horizon, so the following reports reuse them
+CALENDAR_PADDING_DAYS = 1
+DEFAULT_MAX_CACHED_STORES = 50_000
+
+
+def to_naive_utc(value: datetime) -> datetime:
+    """
+    :return: The UTC wall time of a timezone aware datetime, without tzinfo (the form of "StoreStatus"."timestamp").
+    """
+    return value.astimezone(utc).replace(tzinfo=None)
+
+
+@lru_cache(maxsize=65_536)
+def localize_to_utc(timezone_name: str, day: date, time_value: time) -> datetime:
+    """
+    Localizes a local business-hours time on a given day and converts it to naive UTC. Shared by every store in
+    the timezone, so a report localizes each (timezone, day, time) only once.
+    Ambiguous and non-existent local times (DST transitions) are resolved to standard time, like `localize_time`.
+    """
+    return to_naive_utc(timezone(timezone_name).localize(datetime.combine(day, time_value)))
+
+
+def parse_business_time(time_value: time | str) -> time:
+    if isinstance(time_value, str):
+        return datetime.strptime(time_value, '%H:%M:%S').time()
+    return time_value
+
+
+def expand_weekly_hours(business_days: StoreBusinessHoursListRaw, timezone_name: str,
+                        first_day: date, last_day: date) -> BusinessIntervalList:
+    """
+    Expands the weekly business hours of a store into the concrete business intervals of every local calendar day
+    from `first_day` to `last_day`.
+
+    :return: A list of (open, close) naive UTC datetime tuples, ordered by opening time.
+    """
+    business_days = [(day_of_week, parse_business_time(start_time_local), parse_business_time(end_time_local))
+                     for day_of_week, start_time_local, end_time_local in business_days]
+    business_intervals: BusinessIntervalList = []
+    for offset in range((last_day - first_day).days + 1):
+        day = first_day + timedelta(days=offset)
+        for day_of_week, start_time_local, end_time_local in business_days:
+            if day_of_week == day.weekday():
+                business_intervals.append((localize_to_utc(timezone_name, day, start_time_local),
+                                           localize_to_utc(timezone_name, day, end_time_local)))
+    return sorted(business_intervals)
+
+
+class BusinessCalendarCache:
+    """
+    A least recently used cache of the concrete business intervals of stores, keyed by store and timezone.
+    An entry is expanded again when the store's business hours change or a horizon outside the expanded days is
+    requested, and can be dropped explicitly with `invalidate`.
+    """
+
+    def __init__(self, max_stores: int = DEFAULT_MAX_CACHED_STORES):
+        self.max_stores = max_stores
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def get_business_intervals(self, store_id: int, timezone_name: str, business_days: StoreBusinessHoursListRaw,
+                               horizon_start: datetime, horizon_end: datetime) -> BusinessIntervalList:
+        """
+        Gets the business intervals of a store overlapping a horizon.
+
+        :param store_id: The id of the store.
+        :param timezone_name: The name of the store's timezone.
+        :param business_days: The weekly business hours of the store; a change expires the cached calendar.
+        :param horizon_start: A timezone aware datetime, the start of the horizon.
+        :param horizon_end: A timezone aware datetime, the end of the horizon.
+
+        :return: A list of (open, close) naive UTC datetime tuples, unclipped and ordered by opening time.
+        """
+        store_timezone = timezone(timezone_name)
+        first_day = (horizon_start.astimezone(store_timezone) - timedelta(days=1)).date()
+        last_day = horizon_end.astimezone(store_timezone).date()
+        fingerprint = tuple(sorted((day_of_week, str(start_time_local), str(end_time_local))
+                                   for day_of_week, start_time_local, end_time_local in business_days))
+        key = (store_id, timezone_name)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None or entry[0] != fingerprint or not entry[1] <= first_day <= last_day <= entry[2]:
+            entry = (fingerprint, first_day, last_day + timedelta(days=CALENDAR_PADDING_DAYS),
+                     expand_weekly_hours(business_days, timezone_name, first_day,
+                                         last_day + timedelta(days=CALENDAR_PADDING_DAYS)))
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_stores:
+                    self._entries.popitem(last=False)
+
+        start, end = to_naive_utc(horizon_start), to_naive_utc(horizon_end)
+        return [(open_datetime, close_datetime) for open_datetime, close_datetime in entry[3]
+                if open_datetime < end and close_datetime > start]
+
+    def invalidate(self, store_id: int | None = None) -> None:
+        """
+        Drops the cached calendars of a store, or of every store when `store_id` is None.
+        """
+        with self._lock:
+            if store_id is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == store_id]:
+                del self._entries[key]
+
+
+business_calendar_cache = BusinessCalendarCache()
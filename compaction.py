@@ -0,0 +1,382 @@
+import argparse
+import os
+import signal
+import time
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+import psycopg2
+from psycopg2 import errors
+
+from db import get_connection_parameters
+from hourly_rollup import refresh_hourly_rollup
+from reporting import LAST_WEEK
+from schema import bootstrap_schema
+from sequelize import STORE_STATUS_PARTITION_DAYS, is_store_status_partitioned
+from status_index import get_index_start
+
+DEFAULT_REPORT_RETENTION_DAYS = int(os.environ.get('REPORT_RETENTION_DAYS', 30))
+# Raw status checks older than this (before the latest one) are only kept as "StoreStatusHourlyRollup" rows
+DEFAULT_STATUS_RETENTION_DAYS = int(os.environ.get('STATUS_RETENTION_DAYS', 30))
+DEFAULT_COMPACTION_INTERVAL_SECONDS = int(os.environ.get('COMPACTION_INTERVAL_SECONDS', 3600))
+DEFAULT_COMPACTION_BATCH_ROWS = int(os.environ.get('COMPACTION_BATCH_ROWS', 10_000))
+DEFAULT_COMPACTION_BATCH_STORES = int(os.environ.get('COMPACTION_BATCH_STORES', 100))
+DEFAULT_COMPACTION_PAUSE_SECONDS = float(os.environ.get('COMPACTION_PAUSE_SECONDS', 0.2))
+# Compaction waits while more reports than this are running
+DEFAULT_COMPACTION_MAX_RUNNING_REPORTS = int(os.environ.get('COMPACTION_MAX_RUNNING_REPORTS', 0))
+# The week window of a report, plus a day for the business intervals reaching back from its start
+MIN_STATUS_RETENTION_DAYS = LAST_WEEK // 24 + 1
+# Compaction gives up a statement rather than queueing behind the locks of a report, and retries on its next run
+COMPACTION_LOCK_TIMEOUT = '1s'
+COMPACTION_LOCK_KEY = 'Compaction'
+
+_stopping = False
+
+
+def request_stop(signal_number, frame) -> None:
+    """
+    Lets the compaction finish its current batch and exit.
+    """
+    global _stopping
+    _stopping = True
+
+
+class CompactionThrottle:
+    """
+    Paces the batches of a compaction run: every batch is followed by a short pause, and no batch starts while more
+    than `max_running_reports` reports are being generated, so compaction only uses the database when reports do not.
+    """
+
+    def __init__(self, connection, pause_seconds: float = DEFAULT_COMPACTION_PAUSE_SECONDS,
+                 max_running_reports: int = DEFAULT_COMPACTION_MAX_RUNNING_REPORTS):
+        self.connection = connection
+        self.pause_seconds = pause_seconds
+        self.max_running_reports = max_running_reports
+        self.waited_seconds = 0.0
+
+    def count_running_reports(self) -> int:
+        with self.connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT COUNT(*) FROM "ReportJobs" WHERE "status" = 'Running';
+            """)
+            running_count = cursor.fetchone()[0]
+        self.connection.rollback()
+        return running_count
+
+    def pause(self) -> None:
+        started_at = time.monotonic()
+        time.sleep(self.pause_seconds)
+        while not _stopping and self.count_running_reports() > self.max_running_reports:
+            time.sleep(max(self.pause_seconds, 1.0))
+        self.waited_seconds += time.monotonic() - started_at
+
+
+def get_expired_reports(connection, retention: timedelta) -> List[str]:
+    """
+    :return: The IDs of the finished reports created more than `retention` ago.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT "id" FROM "ReportStatus"
+            WHERE "created_at" < LOCALTIMESTAMP - %s AND "status" IN ('Completed', 'Failed', 'Cancelled')
+            ORDER BY "created_at";
+        """, (retention,))
+        report_ids = [str(report_id) for report_id, in cursor.fetchall()]
+    connection.rollback()
+    return report_ids
+
+
+def delete_expired_reports(connection, throttle: CompactionThrottle, retention: timedelta,
+                           batch_rows: int = DEFAULT_COMPACTION_BATCH_ROWS) -> Tuple[int, int]:
+    """
+    Deletes the finished reports created more than `retention` ago: their "ReportData" rows in batches of
+    `batch_rows`, found through the ("report_id", "store_id") index, then their shards and status. Their jobs,
+    cache entries and artifacts are deleted with the status.
+
+    :param connection: A database connection object.
+    :param throttle: Paces the batches.
+    :param retention: How long reports are kept after they were triggered.
+    :param batch_rows: The number of report rows deleted per transaction.
+
+    :return: The number of deleted reports and report rows.
+    """
+    report_ids = get_expired_reports(connection, retention)
+    if not report_ids:
+        return 0, 0
+    deleted_rows = 0
+    with connection.cursor() as cursor:
+        while not _stopping:
+            cursor.execute("""
+                DELETE FROM "ReportData" WHERE "id" IN (
+                    SELECT "id" FROM "ReportData" WHERE "report_id" = ANY(%s::UUID[]) LIMIT %s
+                );
+            """, (report_ids, batch_rows))
+            connection.commit()
+            deleted_rows += cursor.rowcount
+            if cursor.rowcount < batch_rows:
+                break
+            throttle.pause()
+        if _stopping:
+            return 0, deleted_rows
+        cursor.execute("""
+            SELECT to_regclass('"ReportShards"') IS NOT NULL;
+        """)
+        if cursor.fetchone()[0]:
+            cursor.execute("""
+                DELETE FROM "ReportShards" WHERE "report_id" = ANY(%s::UUID[]);
+            """, (report_ids,))
+        cursor.execute("""
+            DELETE FROM "ReportStatus" WHERE "id" = ANY(%s::UUID[]);
+        """, (report_ids,))
+        deleted_reports = cursor.rowcount
+    connection.commit()
+    return deleted_reports, deleted_rows
+
+
+def get_rollup_watermark(connection) -> int:
+    """
+    :return: The id of the last status check summarized into "StoreStatusHourlyRollup".
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT COALESCE((SELECT "last_status_id" FROM "_RollupWatermark" WHERE "name" = 'StoreStatus'), 0);
+        """)
+        last_status_id = cursor.fetchone()[0]
+    connection.rollback()
+    return last_status_id
+
+
+def get_expired_partitions(connection, cutoff: datetime) -> List[Tuple[str, bool, bool]]:
+    """
+    :return: The names of the weekly "StoreStatus" partitions holding only status checks older than `cutoff`,
+            whether they are still attached, and whether their detach is pending; detached ones and pending ones
+            are left over from an interrupted compaction.
+    """
+    # Only a concurrent detach (Postgres 14 and later) can be left pending
+    detach_pending = 'COALESCE(pg_inherits.inhdetachpending, FALSE)' if connection.server_version >= 140000 \
+        else 'FALSE'
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT child.relname, pg_inherits.inhparent IS NOT NULL, {detach_pending} FROM pg_class AS child
+            LEFT JOIN pg_inherits ON pg_inherits.inhrelid = child.oid
+            WHERE child.relkind = 'r' AND child.relname ~ '^StoreStatus_[0-9]{{8}}$'
+                AND child.relnamespace = current_schema()::REGNAMESPACE
+            ORDER BY child.relname
+        """)
+        partitions = cursor.fetchall()
+    connection.rollback()
+    # Partitions are named after the Monday they start on, see `sequelize.ensure_store_status_partitions`
+    return [(partition_name, attached, pending) for partition_name, attached, pending in partitions
+            if datetime.strptime(partition_name.removeprefix('StoreStatus_'), '%Y%m%d')
+            + timedelta(days=STORE_STATUS_PARTITION_DAYS) <= cutoff]
+
+
+def drop_expired_partitions(connection, throttle: CompactionThrottle, cutoff: datetime) -> int:
+    """
+    Drops the weekly partitions of a partitioned "StoreStatus" whose status checks are all older than `cutoff` and
+    summarized already. A partition is detached first, concurrently on Postgres 14 and later, so neither the
+    detach nor the drop blocks the queries of running reports on the other partitions. A concurrent detach that
+    timed out or was interrupted leaves its partition pending, which is finalized by the next run.
+
+    :return: The number of dropped partitions.
+    """
+    last_status_id = get_rollup_watermark(connection)
+    concurrently = 'CONCURRENTLY' if connection.server_version >= 140000 else ''
+    dropped_count = 0
+    for partition_name, attached, pending in get_expired_partitions(connection, cutoff):
+        if _stopping:
+            break
+        if attached:
+            with connection.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT COALESCE(MAX("id"), 0) FROM "{partition_name}";
+                """)
+                summarized = cursor.fetchone()[0] <= last_status_id
+            connection.rollback()
+            if not summarized:
+                print(f'Compaction: Kept partition {partition_name}, it has status checks not summarized yet')
+                continue
+        # DETACH ... CONCURRENTLY cannot run in a transaction block
+        detach_mode = 'FINALIZE' if pending else concurrently
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                if attached:
+                    cursor.execute(f"""
+                        ALTER TABLE "StoreStatus" DETACH PARTITION "{partition_name}" {detach_mode};
+                    """)
+                cursor.execute(f"""
+                    DROP TABLE "{partition_name}";
+                """)
+            dropped_count += 1
+        finally:
+            connection.autocommit = False
+        throttle.pause()
+    return dropped_count
+
+
+def delete_expired_status_checks(connection, throttle: CompactionThrottle, cutoff: datetime,
+                                 batch_stores: int = DEFAULT_COMPACTION_BATCH_STORES) -> int:
+    """
+    Deletes the summarized status checks older than `cutoff` of an unpartitioned "StoreStatus", `batch_stores`
+    stores per transaction, through the ("store_id", "timestamp") index.
+
+    :return: The number of deleted status checks.
+    """
+    last_status_id = get_rollup_watermark(connection)
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT "store_id" FROM "StoreTimezones" ORDER BY "store_id";
+        """)
+        store_ids = [store_id for store_id, in cursor.fetchall()]
+    connection.rollback()
+
+    deleted_count = 0
+    for first_store in range(0, len(store_ids), batch_stores):
+        if _stopping:
+            break
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                DELETE FROM "StoreStatus" WHERE "store_id" = ANY(%s) AND "timestamp" < %s AND "id" <= %s;
+            """, (store_ids[first_store:first_store + batch_stores], cutoff, last_status_id))
+            deleted_count += cursor.rowcount
+        connection.commit()
+        if cursor.rowcount:
+            throttle.pause()
+    return deleted_count
+
+
+def run_compaction(connection, report_retention_days: int = DEFAULT_REPORT_RETENTION_DAYS,
+                   status_retention_days: int = DEFAULT_STATUS_RETENTION_DAYS,
+                   batch_rows: int = DEFAULT_COMPACTION_BATCH_ROWS,
+                   batch_stores: int = DEFAULT_COMPACTION_BATCH_STORES,
+                   pause_seconds: float = DEFAULT_COMPACTION_PAUSE_SECONDS,
+                   max_running_reports: int = DEFAULT_COMPACTION_MAX_RUNNING_REPORTS) -> dict:
+    """
+    Applies the retention of reports and raw status checks once:
+    1. Deletes the finished reports triggered more than `report_retention_days` ago.
+    2. Brings the hourly rollup (`hourly_rollup.py`) up to date, so every status check is summarized per hour. If
+       it cannot get its locks in time, the run goes on with the status checks summarized already.
+    3. Removes the status checks more than `status_retention_days` older than the latest one, which only the rollup
+       keeps from then on: by dropping whole weekly partitions of a partitioned "StoreStatus", or in batches of stores
+       otherwise.
+    Every batch runs in a short transaction of its own, paced by a `CompactionThrottle`, and every statement gives
+    up after `COMPACTION_LOCK_TIMEOUT` instead of queueing behind a report, so compaction never stalls reports.
+    Status checks ingested later than `status_retention_days` minus one day after their timestamp are not supported:
+    summarizing them would recompute hours whose raw checks are gone.
+
+    :param connection: A database connection object.
+    :param report_retention_days: How long reports are kept after they were triggered.
+    :param status_retention_days: How many days of raw status checks are kept, at least `MIN_STATUS_RETENTION_DAYS`.
+    :param batch_rows: The number of report rows deleted per transaction.
+    :param batch_stores: The number of stores whose status checks are deleted per transaction.
+    :param pause_seconds: The pause after every batch.
+    :param max_running_reports: Wait while more reports than this are running.
+
+    :return: The number of deleted reports, report rows, dropped partitions and deleted status checks.
+    """
+    if status_retention_days < MIN_STATUS_RETENTION_DAYS:
+        raise ValueError(f'Status checks have to be kept for at least {MIN_STATUS_RETENTION_DAYS} days, '
+                         f'the window of a report.')
+    start_time = time.perf_counter()
+    bootstrap_schema(connection)
+    throttle = CompactionThrottle(connection, pause_seconds, max_running_reports)
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT pg_try_advisory_lock(hashtext(%s));
+        """, (COMPACTION_LOCK_KEY,))
+        locked = cursor.fetchone()[0]
+        cursor.execute("""
+            SET lock_timeout = %s;
+        """, (COMPACTION_LOCK_TIMEOUT,))
+    connection.commit()
+    if not locked:
+        print('Compaction: Another compaction is running')
+        return {}
+
+    compacted = {'reports': 0, 'report_rows': 0, 'partitions': 0, 'status_checks': 0}
+    try:
+        compacted['reports'], compacted['report_rows'] = delete_expired_reports(
+            connection, throttle, timedelta(days=report_retention_days), batch_rows)
+        if not _stopping:
+            throttle.pause()
+            try:
+                refresh_hourly_rollup(connection)
+            except errors.LockNotAvailable as error:
+                # Only summarized status checks are removed below, so the rollup can catch up on the next run
+                connection.rollback()
+                print(f'Compaction: Gave up refreshing the hourly rollup, compacting up to its watermark ({error})')
+        cutoff = get_index_start(connection, status_retention_days)
+        if cutoff is not None and not _stopping:
+            cutoff = cutoff.replace(tzinfo=None)
+            if is_store_status_partitioned(connection):
+                compacted['partitions'] = drop_expired_partitions(connection, throttle, cutoff)
+            else:
+                compacted['status_checks'] = delete_expired_status_checks(connection, throttle, cutoff,
+                                                                          batch_stores)
+    except errors.LockNotAvailable as error:
+        connection.rollback()
+        print(f'Compaction: Gave up waiting for a lock, retrying on the next run ({error})')
+    finally:
+        # Any other error leaves the transaction aborted; the session keeps the lock until it is released here
+        connection.rollback()
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT pg_advisory_unlock(hashtext(%s));
+            """, (COMPACTION_LOCK_KEY,))
+            cursor.execute("""
+                RESET lock_timeout;
+            """)
+        connection.commit()
+    print(f'Compaction: Deleted {compacted["reports"]} reports ({compacted["report_rows"]} rows), dropped '
+          f'{compacted["partitions"]} status partitions and deleted {compacted["status_checks"]} status checks in '
+          f'{time.perf_counter() - start_time:.1f}s ({throttle.waited_seconds:.1f}s throttled)')
+    return compacted
+
+
+def run_compaction_periodically(interval_seconds: int = DEFAULT_COMPACTION_INTERVAL_SECONDS,
+                                **compaction_options) -> None:
+    """
+    Runs `run_compaction` every `interval_seconds` with a connection of its own, until it is asked to stop
+    (SIGTERM or SIGINT).
+    """
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    connection = psycopg2.connect(**get_connection_parameters())
+    try:
+        while not _stopping:
+            try:
+                run_compaction(connection, **compaction_options)
+            except psycopg2.Error as error:
+                connection.rollback()
+                print(f'Compaction failed: {error}')
+            next_run = time.monotonic() + interval_seconds
+            while not _stopping and time.monotonic() < next_run:
+                time.sleep(1)
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Deletes expired reports and compacts old status checks into the '
+                                                 'hourly rollup.')
+    parser.add_argument('--once', action='store_true', help='Compact once instead of every --interval seconds.')
+    parser.add_argument('--interval', type=int, default=DEFAULT_COMPACTION_INTERVAL_SECONDS)
+    parser.add_argument('--report-retention-days', type=int, default=DEFAULT_REPORT_RETENTION_DAYS)
+    parser.add_argument('--status-retention-days', type=int, default=DEFAULT_STATUS_RETENTION_DAYS)
+    parser.add_argument('--batch-rows', type=int, default=DEFAULT_COMPACTION_BATCH_ROWS)
+    parser.add_argument('--batch-stores', type=int, default=DEFAULT_COMPACTION_BATCH_STORES)
+    parser.add_argument('--pause-seconds', type=float, default=DEFAULT_COMPACTION_PAUSE_SECONDS)
+    parser.add_argument('--max-running-reports', type=int, default=DEFAULT_COMPACTION_MAX_RUNNING_REPORTS)
+    arguments = parser.parse_args()
+
+    _options = {'report_retention_days': arguments.report_retention_days,
+                'status_retention_days': arguments.status_retention_days, 'batch_rows': arguments.batch_rows,
+                'batch_stores': arguments.batch_stores, 'pause_seconds': arguments.pause_seconds,
+                'max_running_reports': arguments.max_running_reports}
+    if arguments.once:
+        _connection = psycopg2.connect(**get_connection_parameters())
+        run_compaction(_connection, **_options)
+        _connection.close()
+    else:
+        run_compaction_periodically(arguments.interval, **_options)
@@ -0,0 +1,266 @@
+import os
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+from time import monotonic, perf_counter
+from typing import Sequence, Tuple
+from weakref import WeakKeyDictionary
+
+from psycopg2 import DatabaseError, InterfaceError, OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, cursor as Cursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from metrics import DB_QUERY_SECONDS
+
+ENV_FILE = '.env'
+DEFAULT_POOL_MIN_SIZE = 1
+DEFAULT_POOL_MAX_SIZE = 10
+DEFAULT_POOL_TIMEOUT_SECONDS = 30.0
+# Connections idle for longer than this are checked with a round trip before being handed out
+DEFAULT_HEALTH_CHECK_SECONDS = 30.0
+
+_default_pool = None
+_default_pool_lock = Lock()
+# name -> (parameter types, statement) of the statements prepared on every connection that executes them, see
+# `register_prepared_statement`
+PREPARED_STATEMENTS: dict = {}
+# connection -> names of the statements prepared on it; a replaced connection is forgotten with its object
+_prepared_statement_names: WeakKeyDictionary = WeakKeyDictionary()
+_prepared_statements_lock = Lock()
+
+
+def load_env_file(path: str = ENV_FILE) -> None:
+    """
+    Reads the KEY=VALUE lines of a .env file into the environment. Variables that are already set win.
+
+    :param path: The path of the .env file; a missing file is ignored.
+
+    :return: None
+    """
+    if not os.path.exists(path):
+        return
+    with open(path) as env_file:
+        for line in env_file:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            os.environ.setdefault(key.strip(), value.strip().strip('\'"'))
+
+
+def get_connection_parameters() -> dict:
+    """
+    Gets the keyword arguments of `psycopg2.connect` from the environment and the .env file shared with
+    docker-compose.db.yml.
+
+    :return: A dictionary of connection parameters.
+    """
+    load_env_file()
+    return dict(
+        host=os.environ.get('DB_HOST', 'localhost'),
+        port=int(os.environ.get('DB_PORT', 5432)),
+        dbname=os.environ.get('POSTGRES_DB', 'loop_datastore_db'),
+        user=os.environ.get('POSTGRES_USER', 'loop_datastore_admin'),
+        password=os.environ.get('POSTGRES_PASSWORD', 'top_secret'),
+    )
+
+
+def get_statement_type(query) -> str:
+    """
+    :return: The leading keyword of a statement, e.g. 'SELECT', used as the label of its latency.
+    """
+    if isinstance(query, bytes):
+        query = query[:64].decode(errors='replace')
+    words = query.split(None, 2) if isinstance(query, str) else []
+    if len(words) > 1 and words[0].upper() == 'EXECUTE' and words[1] in PREPARED_STATEMENTS:
+        return get_statement_type(PREPARED_STATEMENTS[words[1]][1])
+    return words[0].upper() if words else 'OTHER'
+
+
+def register_prepared_statement(name: str, parameter_types: Tuple[str, ...], statement: str) -> None:
+    """
+    Registers a hot statement to be prepared once per connection, so executing it again skips parsing and planning
+    (Postgres switches to a generic plan after a few executions).
+
+    :param name: The name of the prepared statement, a lowercase SQL identifier.
+    :param parameter_types: The SQL type of each parameter.
+    :param statement: The statement, with $1, $2, ... for its parameters.
+
+    :return: None
+    """
+    PREPARED_STATEMENTS[name] = (parameter_types, statement)
+
+
+def prepare_statements(connection, names: Sequence[str] | None = None) -> None:
+    """
+    Prepares the registered statements a connection has not prepared yet. Prepared statements live as long as the
+    connection's session, whether or not the current transaction is committed.
+
+    :param connection: A database connection object.
+    :param names: The names of the statements to prepare, or None for every registered statement.
+
+    :return: None
+    """
+    with _prepared_statements_lock:
+        prepared_names = _prepared_statement_names.setdefault(connection, set())
+        missing_names = [name for name in (PREPARED_STATEMENTS if names is None else names)
+                         if name not in prepared_names]
+    if not missing_names:
+        return
+    with connection.cursor() as cursor:
+        for name in missing_names:
+            parameter_types, statement = PREPARED_STATEMENTS[name]
+            cursor.execute(f'PREPARE {name} ({", ".join(parameter_types)}) AS {statement}')
+            with _prepared_statements_lock:
+                prepared_names.add(name)
+
+
+def execute_prepared(cursor, name: str, parameters: Sequence) -> None:
+    """
+    Executes a registered statement with `EXECUTE`, preparing it on the cursor's connection first if needed.
+
+    :param cursor: A cursor of the connection to execute on.
+    :param name: The name the statement was registered with.
+    :param parameters: The values of the statement's parameters.
+
+    :return: None
+    """
+    prepare_statements(cursor.connection, (name,))
+    cursor.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(parameters))})', parameters)
+
+
+class TimedCursor(Cursor):
+    """
+    A cursor recording the latency of every statement in the `db_query_seconds` metric.
+    """
+
+    def execute(self, query, vars=None):
+        started_at = perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            DB_QUERY_SECONDS.observe(perf_counter() - started_at, statement=get_statement_type(query))
+
+    def copy_expert(self, sql, file, size=8192):
+        started_at = perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            DB_QUERY_SECONDS.observe(perf_counter() - started_at, statement='COPY')
+
+
+class ConnectionPool:
+    """
+    A thread safe pool of database connections. Callers wait for a free connection instead of failing when all
+    `max_size` connections are in use, idle connections are health checked before reuse and broken ones are
+    replaced by new connections. Cursors of pooled connections are `TimedCursor`s unless another cursor factory
+    is given.
+    """
+
+    def __init__(self, min_size: int = DEFAULT_POOL_MIN_SIZE, max_size: int = DEFAULT_POOL_MAX_SIZE,
+                 timeout: float = DEFAULT_POOL_TIMEOUT_SECONDS,
+                 health_check_seconds: float = DEFAULT_HEALTH_CHECK_SECONDS, **connection_parameters):
+        self.timeout = timeout
+        self.health_check_seconds = health_check_seconds
+        connection_parameters.setdefault('cursor_factory', TimedCursor)
+        self._pool = ThreadedConnectionPool(min_size, max_size, **connection_parameters)
+        self._available = BoundedSemaphore(max_size)
+        self._last_used = {}
+
+    def getconn(self):
+        """
+        Takes a healthy connection out of the pool, waiting up to `timeout` seconds for one to be returned.
+
+        :return: A psycopg2 connection.
+        """
+        if not self._available.acquire(timeout=self.timeout):
+            raise OperationalError(f'No database connection became available within {self.timeout} seconds')
+        try:
+            connection = self._pool.getconn()
+            if not self._is_healthy(connection):
+                self._pool.putconn(connection, close=True)
+                connection = self._pool.getconn()
+        except Exception:
+            self._available.release()
+            raise
+        return connection
+
+    def putconn(self, connection, broken: bool = False) -> None:
+        """
+        Returns a connection to the pool. Connections left inside a transaction are rolled back, closed or broken
+        connections are discarded.
+        """
+        try:
+            if not broken and not connection.closed \
+                    and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except (InterfaceError, OperationalError):
+            broken = True
+        broken = broken or bool(connection.closed)
+        if broken:
+            self._last_used.pop(id(connection), None)
+        else:
+            self._last_used[id(connection)] = monotonic()
+        self._pool.putconn(connection, close=broken)
+        self._available.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Lends a connection for the duration of a `with` block. The caller commits; anything left uncommitted is
+        rolled back when the block exits.
+        """
+        connection = self.getconn()
+        broken = False
+        try:
+            yield connection
+        except (InterfaceError, OperationalError):
+            broken = True
+            raise
+        finally:
+            self.putconn(connection, broken)
+
+    def close(self) -> None:
+        self._pool.closeall()
+
+    def _is_healthy(self, connection) -> bool:
+        if connection.closed:
+            return False
+        if monotonic() - self._last_used.get(id(connection), 0.0) < self.health_check_seconds:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except DatabaseError:
+            return False
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Gets the process wide connection pool, creating it on first use with the size set by the DB_POOL_MIN_SIZE
+    and DB_POOL_MAX_SIZE environment variables.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            connection_parameters = get_connection_parameters()
+            _default_pool = ConnectionPool(int(os.environ.get('DB_POOL_MIN_SIZE', DEFAULT_POOL_MIN_SIZE)),
+                                           int(os.environ.get('DB_POOL_MAX_SIZE', DEFAULT_POOL_MAX_SIZE)),
+                                           **connection_parameters)
+        return _default_pool
+
+
+def pooled_connection():
+    """
+    Lends a connection of the process wide pool, see `ConnectionPool.connection`.
+    """
+    return get_pool().connection()
+
+
+def close_pool() -> None:
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is not None:
+            _default_pool.close()
+            _default_pool = None
@@ -0,0 +1,161 @@
+import argparse
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from pytz import utc
+from tqdm import tqdm
+
+from sequelize import DATA_SOURCE_DIRECTORY
+
+DEFAULT_TIMEZONE_MIX = 'America/Chicago=0.4,America/New_York=0.3,America/Denver=0.1,America/Los_Angeles=0.15,' \
+                       'Asia/Kolkata=0.05'
+DEFAULT_DAYS = 8
+# Stores are written in blocks, so the status checks of a large scale never have to fit in memory at once
+STORES_PER_BLOCK = 5_000
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def parse_timezone_mix(timezone_mix: str):
+    """
+    :param timezone_mix: Comma separated `timezone=weight` pairs.
+
+    :return: A tuple of the timezone names and their probabilities.
+    """
+    names, weights = zip(*((name.strip(), float(weight)) for name, weight in
+                           (pair.split('=') for pair in timezone_mix.split(','))))
+    weights = np.array(weights)
+    return list(names), weights / weights.sum()
+
+
+def format_timestamps(epoch_microseconds: np.ndarray) -> np.ndarray:
+    """
+    Formats epoch microseconds like "store_status.csv": '%Y-%m-%d %H:%M:%S.%f UTC'.
+    """
+    timestamps = np.datetime_as_string(epoch_microseconds.astype('datetime64[us]'), unit='us')
+    return np.char.add(np.char.replace(timestamps, 'T', ' '), ' UTC')
+
+
+def format_times_of_day(seconds: np.ndarray):
+    return [f'{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}' for second in seconds.tolist()]
+
+
+def generate_timezones(rng, store_ids: np.ndarray, timezone_names, timezone_weights,
+                       missing_timezone_ratio: float) -> pd.DataFrame:
+    timezones = pd.DataFrame({'store_id': store_ids,
+                              'timezone_str': rng.choice(timezone_names, size=len(store_ids), p=timezone_weights)})
+    # Stores listed without a timezone get the default one when loaded
+    timezones.loc[rng.random(len(store_ids)) < missing_timezone_ratio, 'timezone_str'] = None
+    return timezones
+
+
+def generate_business_hours(rng, store_ids: np.ndarray, always_open_ratio: float) -> pd.DataFrame:
+    """
+    Generates one row per store and open day of the week, like "business_hours.csv". A store is closed on about
+    one day a week, and stores listed with 00:00:00 to 23:59:59 every day are open around the clock.
+    """
+    always_open = rng.random(len(store_ids)) < always_open_ratio
+    store_days = pd.DataFrame({'store_id': np.repeat(store_ids, 7), 'dayOfWeek': np.tile(np.arange(7), len(store_ids)),
+                               'always_open': np.repeat(always_open, 7)})
+    store_days = store_days[store_days['always_open'] | (rng.random(len(store_days)) >= 1 / 7)]
+    # Opening between 06:00 and 12:00 for 6 to 14 hours, in quarter hours
+    opening_seconds = rng.integers(6 * 4, 12 * 4, size=len(store_days)) * 900
+    closing_seconds = np.minimum(opening_seconds + rng.integers(6 * 4, 14 * 4, size=len(store_days)) * 900,
+                                 SECONDS_PER_DAY - 1)
+    return pd.DataFrame({
+        'store_id': store_days['store_id'].to_numpy(),
+        'dayOfWeek': store_days['dayOfWeek'].to_numpy(),
+        'start_time_local': format_times_of_day(np.where(store_days['always_open'], 0, opening_seconds)),
+        'end_time_local': format_times_of_day(np.where(store_days['always_open'], SECONDS_PER_DAY - 1,
+                                                       closing_seconds)),
+    })
+
+
+def generate_store_status_block(rng, store_ids: np.ndarray, polls_per_hour: float, start: datetime,
+                                end: datetime) -> pd.DataFrame:
+    """
+    Generates the status checks of a block of stores, like "store_status.csv". Each store is polled at random
+    times at `polls_per_hour` on average, and is active with a probability of its own.
+    """
+    start_us = int(start.timestamp() * 1_000_000)
+    end_us = int(end.timestamp() * 1_000_000)
+    hours = (end - start) / timedelta(hours=1)
+    poll_counts = rng.poisson(polls_per_hour * hours, size=len(store_ids))
+    uptime_probabilities = rng.uniform(0.7, 1.0, size=len(store_ids))
+    statuses = rng.random(poll_counts.sum()) < np.repeat(uptime_probabilities, poll_counts)
+    return pd.DataFrame({
+        'store_id': np.repeat(store_ids, poll_counts),
+        'status': np.where(statuses, 'active', 'inactive'),
+        'timestamp_utc': format_timestamps(rng.integers(start_us, end_us, size=poll_counts.sum())),
+    })
+
+
+def generate_data(output_directory: str = DATA_SOURCE_DIRECTORY, stores: int = 1_000, polls_per_hour: float = 1.0,
+                  orphan_ratio: float = 0.01, missing_timezone_ratio: float = 0.01, always_open_ratio: float = 0.05,
+                  timezone_mix: str = DEFAULT_TIMEZONE_MIX, days: int = DEFAULT_DAYS, end: datetime | None = None,
+                  seed: int = 0) -> dict:
+    """
+    Writes synthetic "timezones.csv", "business_hours.csv" and "store_status.csv" files in the formats of the
+    problem statement.
+
+    :param output_directory: The directory to write the files to.
+    :param stores: The number of stores.
+    :param polls_per_hour: The average number of status checks per store and hour.
+    :param orphan_ratio: The share of stores missing from "timezones.csv" (repaired when loaded).
+    :param missing_timezone_ratio: The share of stores listed in "timezones.csv" without a timezone.
+    :param always_open_ratio: The share of stores open around the clock.
+    :param timezone_mix: Comma separated `timezone=weight` pairs the timezones of the stores are drawn from.
+    :param days: The number of days of status checks, ending at `end`.
+    :param end: A timezone aware datetime, the end of the status checks, defaults to the current time.
+    :param seed: The seed of the random generator, the same seed always generates the same files.
+
+    :return: A dictionary of the number of rows written to each file.
+    """
+    rng = np.random.default_rng(seed)
+    end = end or datetime.now(utc)
+    start = end - timedelta(days=days)
+    os.makedirs(output_directory, exist_ok=True)
+    store_ids = np.arange(1, stores + 1, dtype=np.int64)
+    listed_store_ids = store_ids[rng.random(stores) >= orphan_ratio]
+    timezone_names, timezone_weights = parse_timezone_mix(timezone_mix)
+
+    timezones = generate_timezones(rng, listed_store_ids, timezone_names, timezone_weights, missing_timezone_ratio)
+    timezones.to_csv(f'{output_directory}/timezones.csv', index=False)
+    business_hours = generate_business_hours(rng, listed_store_ids, always_open_ratio)
+    business_hours.to_csv(f'{output_directory}/business_hours.csv', index=False)
+
+    store_status_count = 0
+    with open(f'{output_directory}/store_status.csv', 'w') as store_status_file:
+        store_status_file.write('store_id,status,timestamp_utc\n')
+        for block_start in tqdm(range(0, stores, STORES_PER_BLOCK), smoothing=0.9):
+            store_status = generate_store_status_block(rng, store_ids[block_start:block_start + STORES_PER_BLOCK],
+                                                       polls_per_hour, start, end)
+            store_status.to_csv(store_status_file, index=False, header=False)
+            store_status_count += len(store_status)
+
+    return {'timezones.csv': len(timezones), 'business_hours.csv': len(business_hours),
+            'store_status.csv': store_status_count}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes synthetic source csv files.')
+    parser.add_argument('--output', default=DATA_SOURCE_DIRECTORY, help='The directory to write the files to.')
+    parser.add_argument('--stores', type=int, default=1_000)
+    parser.add_argument('--polls-per-hour', type=float, default=1.0)
+    parser.add_argument('--orphan-ratio', type=float, default=0.01,
+                        help='Share of stores missing from timezones.csv.')
+    parser.add_argument('--missing-timezone-ratio', type=float, default=0.01,
+                        help='Share of stores listed in timezones.csv without a timezone.')
+    parser.add_argument('--always-open-ratio', type=float, default=0.05)
+    parser.add_argument('--timezone-mix', default=DEFAULT_TIMEZONE_MIX,
+                        help='Comma separated timezone=weight pairs.')
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS)
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    row_counts = generate_data(arguments.output, arguments.stores, arguments.polls_per_hour, arguments.orphan_ratio,
+                               arguments.missing_timezone_ratio, arguments.always_open_ratio, arguments.timezone_mix,
+                               arguments.days, seed=arguments.seed)
+    for file_name, row_count in row_counts.items():
+        print(f'Wrote {row_count} rows to "{arguments.output}/{file_name}"')
@@ -0,0 +1,414 @@
+import argparse
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta
+from operator import itemgetter
+from typing import Dict, Iterator, List, Tuple
+
+import psycopg2
+from psycopg2 import errors
+from psycopg2.extras import execute_values
+from pytz import timezone, utc
+from tqdm import tqdm
+
+from business_calendar import business_calendar_cache, to_naive_utc
+from db import get_connection_parameters
+from report_progress import report_stage
+from reporting import ALL_STORES, REPORT_WINDOWS, attribute_business_interval, get_report_window, \
+    sweep_business_interval, to_report_row
+from schema import bootstrap_schema
+from type_defs import BusinessIntervalList, ReportRow, StoreRange
+
+ONE_HOUR = timedelta(hours=1)
+DEFAULT_ROLLUP_BATCH_STORES = 500
+# Serializes rollup jobs, so two of them never advance the watermark past each other's work
+ROLLUP_LOCK_KEY = 'StoreStatusHourlyRollup'
+# A SHARE lock waiting on a writer holds up every later writer, so the watermark read gives up quickly and retries
+WATERMARK_LOCK_TIMEOUT = '100ms'
+WATERMARK_LOCK_ATTEMPTS = 30
+WATERMARK_LOCK_RETRY_SECONDS = 1.0
+
+
+def create_rollup_tables(connection) -> None:
+    """
+    Creates the hourly rollup of the status checks and the watermark of the rollup job.
+
+    :param connection: A database connection object.
+
+    :return: None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS "StoreStatusHourlyRollup" (
+            "store_id" BIGINT NOT NULL,
+            "hour" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            "uptime_seconds" DOUBLE PRECISION NOT NULL,
+            "downtime_seconds" DOUBLE PRECISION NOT NULL,
+
+            PRIMARY KEY ("store_id", "hour")
+        );
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS "_RollupWatermark" (
+            "name" TEXT NOT NULL PRIMARY KEY,
+            "last_status_id" BIGINT NOT NULL,
+            "updated_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+    connection.commit()
+
+
+def floor_hour(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(value: datetime) -> datetime:
+    hour = floor_hour(value)
+    return hour if hour == value else hour + ONE_HOUR
+
+
+def rollup_store_hours(cursor, store_id: int, timezone_name: str, business_days, first_timestamp: datetime,
+                       last_timestamp: datetime) -> Tuple[Tuple[datetime, datetime], Dict[datetime, list]]:
+    """
+    Recomputes the hourly uptime and downtime of a store around new status checks. A status check only changes
+    the time attributed within its own business interval, so every hour of the business intervals overlapping
+    the new checks is recomputed from scratch, including the time other intervals attribute to those hours.
+
+    :param cursor: A database cursor object.
+    :param store_id: The id of the store.
+    :param timezone_name: The name of the store's timezone.
+    :param business_days: The weekly business hours of the store.
+    :param first_timestamp: The naive UTC timestamp of the earliest new status check.
+    :param last_timestamp: The naive UTC timestamp of the latest new status check.
+
+    :return: A tuple of the recomputed [start, end) range of hours and the [uptime, downtime] of every hour of
+            the range with business time.
+    """
+    get_intervals = business_calendar_cache.get_business_intervals
+    touched_intervals = get_intervals(store_id, timezone_name, business_days, utc.localize(first_timestamp),
+                                      utc.localize(last_timestamp) + timedelta(microseconds=1))
+    if not touched_intervals:
+        return (floor_hour(first_timestamp), floor_hour(first_timestamp)), {}
+    hours_start = floor_hour(min(open_datetime for open_datetime, _ in touched_intervals))
+    hours_end = ceil_hour(max(close_datetime for _, close_datetime in touched_intervals))
+
+    business_intervals = get_intervals(store_id, timezone_name, business_days, utc.localize(hours_start),
+                                       utc.localize(hours_end))
+    cursor.execute("""
+        SELECT "timestamp", "active"
+        FROM "StoreStatus"
+        WHERE "store_id" = %s AND "timestamp" >= %s AND "timestamp" < %s
+        ORDER BY "timestamp"
+    """, (store_id, min(open_datetime for open_datetime, _ in business_intervals),
+          max(close_datetime for _, close_datetime in business_intervals)))
+    status_checks = cursor.fetchall()
+    timestamps = [timestamp for timestamp, _ in status_checks]
+
+    hours = defaultdict(lambda: [timedelta(), timedelta()])
+    for business_interval in business_intervals:
+        for held_from, held_until, status in attribute_business_interval(
+                status_checks, bisect_left(timestamps, business_interval[0]),
+                bisect_left(timestamps, business_interval[1]), business_interval):
+            held_from, held_until = max(held_from, hours_start), min(held_until, hours_end)
+            hour = floor_hour(held_from)
+            while hour < held_until:
+                hours[hour][0 if status else 1] += min(held_until, hour + ONE_HOUR) - max(held_from, hour)
+                hour += ONE_HOUR
+    return (hours_start, hours_end), hours
+
+
+def write_rollup_hours(cursor, store_hours) -> None:
+    """
+    Replaces the rollup rows of recomputed hour ranges.
+
+    :param cursor: A database cursor object.
+    :param store_hours: A list of (store_id, (hours start, hours end), hourly seconds) tuples
+            as returned by `rollup_store_hours`.
+    """
+    execute_values(cursor, """
+        DELETE FROM "StoreStatusHourlyRollup" AS rollup USING (VALUES %s) AS recomputed ("store_id", "start", "end")
+        WHERE rollup."store_id" = recomputed."store_id"
+            AND rollup."hour" >= recomputed."start" AND rollup."hour" < recomputed."end";
+    """, [(store_id, hours_start, hours_end) for store_id, (hours_start, hours_end), _ in store_hours])
+    execute_values(cursor, """
+        INSERT INTO "StoreStatusHourlyRollup" ("store_id", "hour", "uptime_seconds", "downtime_seconds") VALUES %s
+    """, [(store_id, hour, uptime.total_seconds(), downtime.total_seconds()) for store_id, _, hours in store_hours
+          for hour, (uptime, downtime) in hours.items()], page_size=5_000)
+
+
+def refresh_hourly_rollup(connection, rebuild: bool = False,
+                          batch_stores: int = DEFAULT_ROLLUP_BATCH_STORES) -> int:
+    """
+    Brings "StoreStatusHourlyRollup" up to date with the status checks added since the last run. Only the stores
+    with new status checks are visited, and only the hours of the business intervals around the new checks are
+    recomputed. The watermark is advanced once every store is written, so an interrupted run is redone by the next.
+    It is read under a short SHARE lock of "StoreStatus", so checks committed late by concurrent writers are not
+    skipped. The lock is given up after `WATERMARK_LOCK_TIMEOUT` rather than stalling ingestion behind a long write,
+    and tried again up to `WATERMARK_LOCK_ATTEMPTS` times.
+    Changes to business hours are not tracked; `rebuild` recomputes every hour from scratch.
+
+    :param connection: A database connection object.
+    :param rebuild: Drop the rollup and recompute it from every status check.
+    :param batch_stores: The number of stores written per transaction.
+
+    :return: The number of stores whose rollup was refreshed.
+    """
+    bootstrap_schema(connection)
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT pg_advisory_lock(hashtext(%s));
+    """, (ROLLUP_LOCK_KEY,))
+    try:
+        if rebuild:
+            cursor.execute("""
+                TRUNCATE "StoreStatusHourlyRollup";
+                DELETE FROM "_RollupWatermark" WHERE "name" = 'StoreStatus';
+            """)
+            connection.commit()
+        # Concurrent writers commit their ids out of order, so a row below MAX("id") may still be uncommitted. The
+        # SHARE lock waits for the transactions writing to "StoreStatus" and keeps new ones out until the commit
+        # below, so every id up to the new watermark is committed (or rolled back) when it is read.
+        for attempt in range(1, WATERMARK_LOCK_ATTEMPTS + 1):
+            try:
+                cursor.execute("""
+                    SET LOCAL lock_timeout = %s;
+                    LOCK TABLE "StoreStatus" IN SHARE MODE;
+                    SELECT COALESCE((SELECT "last_status_id" FROM "_RollupWatermark" WHERE "name" = 'StoreStatus'), 0),
+                        COALESCE((SELECT MAX("id") FROM "StoreStatus"), 0);
+                """, (WATERMARK_LOCK_TIMEOUT,))
+                break
+            except errors.LockNotAvailable:
+                connection.rollback()
+                if attempt == WATERMARK_LOCK_ATTEMPTS:
+                    raise
+                time.sleep(WATERMARK_LOCK_RETRY_SECONDS)
+        last_status_id, new_status_id = cursor.fetchone()
+        connection.commit()
+        if new_status_id <= last_status_id:
+            return 0
+
+        cursor.execute("""
+            SELECT "StoreStatus"."store_id", "Timezones"."name",
+                MIN("StoreStatus"."timestamp"), MAX("StoreStatus"."timestamp")
+            FROM "StoreStatus" JOIN "StoreTimezones" ON "StoreTimezones"."store_id" = "StoreStatus"."store_id"
+            JOIN "Timezones" ON "Timezones"."id" = "StoreTimezones"."timezone_id"
+            WHERE "StoreStatus"."id" > %s AND "StoreStatus"."id" <= %s
+            GROUP BY "StoreStatus"."store_id", "Timezones"."name"
+        """, (last_status_id, new_status_id))
+        stores = cursor.fetchall()
+        cursor.execute("""
+            SELECT "store_id", "day_of_week", "start_time_local", "end_time_local"
+            FROM "StoreBusinessHours"
+            WHERE "store_id" = ANY(%s)
+        """, ([store_id for store_id, *_ in stores],))
+        business_hours = defaultdict(list)
+        for store_id, *business_day in cursor.fetchall():
+            business_hours[store_id].append(tuple(business_day))
+
+        store_hours = []
+        for store_id, timezone_name, first_timestamp, last_timestamp in tqdm(stores, smoothing=0.9):
+            store_hours.append((store_id, *rollup_store_hours(cursor, store_id, timezone_name,
+                                                              business_hours[store_id], first_timestamp,
+                                                              last_timestamp)))
+            if len(store_hours) >= batch_stores:
+                write_rollup_hours(cursor, store_hours)
+                connection.commit()
+                store_hours = []
+        if store_hours:
+            write_rollup_hours(cursor, store_hours)
+
+        cursor.execute("""
+            INSERT INTO "_RollupWatermark" ("name", "last_status_id") VALUES ('StoreStatus', %s)
+            ON CONFLICT ("name") DO UPDATE SET "last_status_id" = EXCLUDED."last_status_id",
+                "updated_at" = CURRENT_TIMESTAMP;
+        """, (new_status_id,))
+        connection.commit()
+        return len(stores)
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.execute("""
+            SELECT pg_advisory_unlock(hashtext(%s));
+        """, (ROLLUP_LOCK_KEY,))
+        connection.commit()
+        cursor.close()
+
+
+def get_rollup_bounds(business_intervals: BusinessIntervalList, window_start: datetime,
+                      window_end: datetime) -> Tuple[datetime, datetime]:
+    """
+    Finds the range of whole UTC hours within a window that no business interval crosses. The rollup rows of its
+    hours hold exactly the time of the business intervals within it, which the other engines attribute the same
+    way, since they only clip the intervals crossing a window bound.
+
+    :param business_intervals: The (open, close) naive UTC business intervals of a store overlapping the window,
+            ordered by opening time.
+    :param window_start: The naive UTC start of the window.
+    :param window_end: The naive UTC end of the window.
+
+    :return: The naive UTC (start, end) hours of the range, or (window_start, window_start) when it is empty.
+    """
+    rollup_start = ceil_hour(window_start)
+    for open_datetime, close_datetime in business_intervals:
+        if open_datetime >= rollup_start:
+            break
+        if close_datetime > rollup_start:
+            rollup_start = ceil_hour(close_datetime)
+    rollup_end = floor_hour(window_end)
+    for open_datetime, close_datetime in sorted(business_intervals, key=itemgetter(1), reverse=True):
+        if close_datetime <= rollup_end:
+            break
+        if open_datetime < rollup_end:
+            rollup_end = floor_hour(open_datetime)
+    if rollup_start >= rollup_end:
+        return window_start, window_start
+    return rollup_start, rollup_end
+
+
+def merge_ranges(ranges: List[Tuple[datetime, datetime]]) -> List[Tuple[datetime, datetime]]:
+    """
+    :return: The non-empty [start, end) ranges merged where they overlap or touch, ordered by start.
+    """
+    merged_ranges = []
+    for range_start, range_end in sorted(ranges):
+        if range_start >= range_end:
+            continue
+        if merged_ranges and range_start <= merged_ranges[-1][1]:
+            merged_ranges[-1] = (merged_ranges[-1][0], max(merged_ranges[-1][1], range_end))
+        else:
+            merged_ranges.append((range_start, range_end))
+    return merged_ranges
+
+
+def compute_report_rows_rollup(connection, now: datetime, store_range: StoreRange = ALL_STORES) \
+        -> Iterator[ReportRow]:
+    """
+    Computes the report of every store from its "StoreStatusHourlyRollup" rows, so most of a week of status checks
+    is never read. The rollup attributes time over whole business intervals, while the other engines clip the
+    intervals crossing a window bound to the window first, which shifts their hour slots and drops the checks
+    outside the window. So only the hours that no business interval crosses (see `get_rollup_bounds`) are summed
+    from the rollup, and the business intervals around the window bounds are swept from their status checks like
+    `reporting.calculate_uptime_and_downtime_windows` does. The rows are those of `reporting.compute_report_rows`.
+    The rollup must be refreshed first, see `refresh_hourly_rollup`.
+
+    :param connection: A database connection object.
+    :param now: A timezone aware datetime used as the current time of the report.
+    :param store_range: The inclusive range of store ids to report on.
+
+    :return: An iterator of report rows.
+    """
+    with connection.cursor() as cursor:
+        with report_stage('fetch'):
+            cursor.execute("""
+                SELECT "StoreTimezones"."store_id", "Timezones"."name"
+                FROM "StoreTimezones" JOIN "Timezones" ON "Timezones"."id" = "StoreTimezones"."timezone_id"
+                WHERE "StoreTimezones"."store_id" BETWEEN %s AND %s
+                ORDER BY "StoreTimezones"."store_id"
+            """, store_range)
+            stores = cursor.fetchall()
+            cursor.execute("""
+                SELECT "store_id", "day_of_week", "start_time_local", "end_time_local"
+                FROM "StoreBusinessHours"
+                WHERE "store_id" BETWEEN %s AND %s
+            """, store_range)
+            business_hours = defaultdict(list)
+            for store_id, *business_day in cursor.fetchall():
+                business_hours[store_id].append(tuple(business_day))
+        if not stores:
+            return
+
+        # Every window ends at the same instant; the windows of a timezone are computed once
+        timezone_windows: Dict[str, Dict[int, Tuple[datetime, datetime]]] = {}
+        # store_id -> business intervals, and (rollup start, rollup end) per window
+        store_intervals, store_bounds = {}, {}
+        check_ranges = []
+        with report_stage('localize'):
+            for store_id, timezone_name in stores:
+                windows = timezone_windows.get(timezone_name)
+                if windows is None:
+                    windows = timezone_windows[timezone_name] = {
+                        duration_in_hours: tuple(to_naive_utc(bound) for bound in get_report_window(
+                            duration_in_hours, timezone(timezone_name), now))
+                        for duration_in_hours in REPORT_WINDOWS}
+                widest_start, widest_end = windows[max(REPORT_WINDOWS)]
+                business_intervals = business_calendar_cache.get_business_intervals(
+                    store_id, timezone_name, business_hours[store_id], utc.localize(widest_start),
+                    utc.localize(widest_end))
+                bounds = {duration_in_hours: get_rollup_bounds(business_intervals, *windows[duration_in_hours])
+                          for duration_in_hours in REPORT_WINDOWS}
+                store_intervals[store_id], store_bounds[store_id] = business_intervals, bounds
+                # The status checks of the business intervals swept outside the rollup range of each window
+                check_ranges.extend((store_id, *check_range) for check_range in merge_ranges(
+                    [(windows[duration_in_hours][0], bounds[duration_in_hours][0])
+                     for duration_in_hours in REPORT_WINDOWS] +
+                    [(bounds[duration_in_hours][1], windows[duration_in_hours][1])
+                     for duration_in_hours in REPORT_WINDOWS]))
+
+        window_columns = ', '.join(f'"start_{duration_in_hours}", "end_{duration_in_hours}"'
+                                   for duration_in_hours in REPORT_WINDOWS)
+        window_sums = ', '.join(
+            f'COALESCE(SUM(rollup."{column}") FILTER (WHERE rollup."hour" >= bounds."start_{duration_in_hours}" '
+            f'AND rollup."hour" < bounds."end_{duration_in_hours}"), 0)'
+            for column in ('uptime_seconds', 'downtime_seconds') for duration_in_hours in REPORT_WINDOWS)
+        # The rollup holds the estimates already, summing them per window is a fetch
+        with report_stage('fetch'):
+            cursor.execute(f"""
+                SELECT bounds."store_id", {window_sums}
+                FROM unnest(%s::BIGINT[], {', '.join(['%s::TIMESTAMP[]'] * 2 * len(REPORT_WINDOWS))})
+                    AS bounds ("store_id", {window_columns})
+                LEFT JOIN "StoreStatusHourlyRollup" AS rollup ON rollup."store_id" = bounds."store_id"
+                    AND rollup."hour" >= LEAST({', '.join(f'bounds."start_{duration_in_hours}"'
+                                                          for duration_in_hours in REPORT_WINDOWS)})
+                    AND rollup."hour" < GREATEST({', '.join(f'bounds."end_{duration_in_hours}"'
+                                                            for duration_in_hours in REPORT_WINDOWS)})
+                GROUP BY bounds."store_id"
+            """, (list(store_bounds), *([store_bounds[store_id][duration_in_hours][bound] for store_id in store_bounds]
+                                        for duration_in_hours in REPORT_WINDOWS for bound in (0, 1))))
+            rollup_seconds = {store_id: seconds for store_id, *seconds in cursor.fetchall()}
+            cursor.execute("""
+                SELECT ranges."store_id", status."timestamp", status."active"
+                FROM unnest(%s::BIGINT[], %s::TIMESTAMP[], %s::TIMESTAMP[]) AS ranges ("store_id", "start", "end")
+                JOIN "StoreStatus" AS status ON status."store_id" = ranges."store_id"
+                    AND status."timestamp" >= ranges."start" AND status."timestamp" < ranges."end"
+                ORDER BY ranges."store_id", status."timestamp"
+            """, tuple(map(list, zip(*check_ranges))) if check_ranges else ([], [], []))
+            store_status_checks = defaultdict(list)
+            for store_id, timestamp, active in cursor.fetchall():
+                store_status_checks[store_id].append((timestamp, active))
+
+    for store_id, timezone_name in stores:
+        with report_stage('estimate'):
+            status_checks = store_status_checks.get(store_id, [])
+            timestamps = [timestamp for timestamp, _ in status_checks]
+            seconds = rollup_seconds[store_id]
+            uptime_and_downtime = {}
+            for i, duration_in_hours in enumerate(REPORT_WINDOWS):
+                window_start, window_end = timezone_windows[timezone_name][duration_in_hours]
+                rollup_start, rollup_end = store_bounds[store_id][duration_in_hours]
+                uptime = timedelta(seconds=seconds[i])
+                downtime = timedelta(seconds=seconds[len(REPORT_WINDOWS) + i])
+                for open_datetime, close_datetime in store_intervals[store_id]:
+                    if rollup_start <= open_datetime and close_datetime <= rollup_end:
+                        continue
+                    open_datetime, close_datetime = max(open_datetime, window_start), min(close_datetime, window_end)
+                    if open_datetime >= close_datetime:
+                        continue
+                    interval_uptime, interval_downtime = sweep_business_interval(
+                        status_checks, bisect_left(timestamps, open_datetime), bisect_left(timestamps, close_datetime),
+                        (open_datetime, close_datetime))
+                    uptime += interval_uptime
+                    downtime += interval_downtime
+                uptime_and_downtime[duration_in_hours] = uptime, downtime
+        yield to_report_row(store_id, uptime_and_downtime)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refreshes the hourly rollup of the status checks.')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute the rollup from every status check.')
+    arguments = parser.parse_args()
+
+    _connection = psycopg2.connect(**get_connection_parameters())
+    print(f'Refreshed the hourly rollup of {refresh_hourly_rollup(_connection, arguments.rebuild)} stores.')
+    _connection.close()
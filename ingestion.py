@@ -0,0 +1,253 @@
+import json
+import os
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+from typing import List, Tuple
+
+import pandas as pd
+from psycopg2 import DataError, IntegrityError
+
+from db import pooled_connection
+from metrics import INGEST_BATCH_SECONDS, INGEST_DROPPED_ROWS, INGEST_QUEUE_ROWS, INGEST_ROWS, INGEST_ROWS_PER_SECOND
+from sequelize import ensure_store_status_partitions, load_store_status_frame, prepare_store_status
+
+STORE_STATUS_FIELDS = ('store_id', 'status', 'timestamp_utc')
+STATUS_VALUES = ('active', 'inactive')
+DEFAULT_BATCH_ROWS = int(os.environ.get('INGEST_BATCH_ROWS', 5_000))
+DEFAULT_BATCH_MILLISECONDS = int(os.environ.get('INGEST_BATCH_MILLISECONDS', 200))
+DEFAULT_QUEUE_MAX_ROWS = int(os.environ.get('INGEST_QUEUE_MAX_ROWS', 100_000))
+MAX_RETRY_DELAY_SECONDS = 30.0
+# A batch failing this many writes in a row is dropped, so one bad batch cannot block the queue
+MAX_WRITE_ATTEMPTS = 10
+# How long shutting down waits for the queued status checks to be written
+DEFAULT_CLOSE_TIMEOUT_SECONDS = 10.0
+# The window `StatusIngestQueue.rows_per_second` is measured over
+INGEST_RATE_WINDOW_SECONDS = 60.0
+
+
+class IngestQueueFull(Exception):
+    """
+    Raised when a batch does not fit into the ingest queue; the caller should retry later.
+    """
+
+
+def parse_status_payload(body: bytes, content_type: str) -> pd.DataFrame:
+    """
+    Parses a batch of status checks posted as a JSON array of objects (or a single object), or as NDJSON with one
+    object per line. Every object has the fields of "store_status.csv": store_id, status and timestamp_utc.
+
+    :param body: The request body.
+    :param content_type: The Content-Type header of the request.
+
+    :return: A DataFrame of (store_id, active, timestamp) rows with naive UTC timestamps, ready for
+            `sequelize.load_store_status_frame`.
+    """
+    if 'ndjson' in content_type:
+        records = [json.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+        records = json.loads(body or b'[]')
+        if isinstance(records, dict):
+            records = [records]
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        raise ValueError('Expected a JSON object, an array of objects or NDJSON.')
+    missing = [field for field in STORE_STATUS_FIELDS if records and any(field not in record for record in records)]
+    if missing:
+        raise ValueError(f'Every status check needs the fields {", ".join(STORE_STATUS_FIELDS)}, '
+                         f'missing {", ".join(missing)}.')
+
+    status_checks = pd.DataFrame.from_records(records, columns=list(STORE_STATUS_FIELDS))
+    status_checks['store_id'] = pd.to_numeric(status_checks['store_id'], errors='raise').astype('int64')
+    invalid_status = ~status_checks['status'].isin(STATUS_VALUES)
+    if invalid_status.any():
+        raise ValueError(f'Unknown status "{status_checks["status"][invalid_status].iloc[0]}", '
+                         f'expected one of {", ".join(STATUS_VALUES)}.')
+    status_checks = prepare_store_status(status_checks)
+    # Null timestamps parse to NaT, which would fail every write of the batch
+    missing_timestamp = status_checks['timestamp'].isna()
+    if missing_timestamp.any():
+        raise ValueError(f'Status check {missing_timestamp.idxmax()} has no timestamp_utc.')
+    return status_checks
+
+
+class StatusIngestQueue:
+    """
+    An in-process queue of posted status checks, written to "StoreStatus" by a background thread in micro-batches
+    of up to `batch_rows` rows, at the latest `batch_milliseconds` after the oldest queued check arrived. Each
+    micro-batch is copied in one transaction by `sequelize.load_store_status_frame`, which also gives stores
+    missing from "StoreTimezones" the default timezone and 24/7 business hours. The queue holds at most
+    `max_rows` rows; batches that do not fit are refused with `IngestQueueFull` instead of growing the memory
+    of the API. A failed write is retried with backoff while new batches are refused once the queue is full; a
+    batch the database rejects (`DataError`, `IntegrityError`) or that failed `MAX_WRITE_ATTEMPTS` writes in a row
+    is logged and dropped instead.
+    """
+
+    def __init__(self, batch_rows: int = DEFAULT_BATCH_ROWS, batch_milliseconds: int = DEFAULT_BATCH_MILLISECONDS,
+                 max_rows: int = DEFAULT_QUEUE_MAX_ROWS):
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_milliseconds / 1000
+        self.max_rows = max_rows
+        self.written_rows = 0
+        self.repaired_stores = 0
+        self.dropped_rows = 0
+        self._frames: deque = deque()
+        self._recent_writes: deque = deque()
+        self._queued_rows = 0
+        self._closed = False
+        self._condition = Condition()
+        self._writer = Thread(target=self._write_batches, name='status-ingest-writer', daemon=True)
+        self._writer.start()
+
+    @property
+    def queued_rows(self) -> int:
+        return self._queued_rows
+
+    @property
+    def rows_per_second(self) -> float:
+        """
+        :return: The rows written per second over the last `INGEST_RATE_WINDOW_SECONDS`.
+        """
+        with self._condition:
+            self._forget_old_writes()
+            return sum(row_count for _, row_count in self._recent_writes) / INGEST_RATE_WINDOW_SECONDS
+
+    def submit(self, status_checks: pd.DataFrame) -> int:
+        """
+        Queues a batch of parsed status checks, see `parse_status_payload`.
+
+        :param status_checks: A DataFrame of (store_id, status, timestamp) rows.
+
+        :return: The number of rows queued after this batch.
+        """
+        with self._condition:
+            if self._closed:
+                raise IngestQueueFull('The ingest queue is shut down.')
+            if self._queued_rows + len(status_checks) > self.max_rows:
+                raise IngestQueueFull(f'The ingest queue is full ({self._queued_rows} of {self.max_rows} rows).')
+            if len(status_checks):
+                self._frames.append((time.monotonic(), status_checks))
+                self._queued_rows += len(status_checks)
+                self._condition.notify()
+            return self._queued_rows
+
+    def close(self, timeout: float | None = None) -> bool:
+        """
+        Stops accepting status checks and waits for the queued ones to be written.
+
+        :param timeout: Seconds to wait at most, or None to wait until they are written.
+
+        :return: Whether every queued status check was written (or dropped) within the timeout.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._writer.join(timeout)
+        return not self._writer.is_alive()
+
+    def _take_batch(self) -> List[Tuple[float, pd.DataFrame]] | None:
+        with self._condition:
+            while True:
+                if self._queued_rows >= self.batch_rows or (self._closed and self._frames):
+                    break
+                if self._closed:
+                    return None
+                if self._frames:
+                    remaining = self._frames[0][0] + self.batch_seconds - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                else:
+                    self._condition.wait()
+            batch, batch_rows = [], 0
+            while self._frames and batch_rows < self.batch_rows:
+                batch_rows += len(self._frames[0][1])
+                batch.append(self._frames.popleft())
+            return batch
+
+    def _write_batches(self) -> None:
+        retry_delay = self.batch_seconds
+        failed_attempts = 0
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            status_checks = pd.concat([frame for _, frame in batch], ignore_index=True)
+            started_at = time.perf_counter()
+            try:
+                with pooled_connection() as connection:
+                    ensure_store_status_partitions(connection, status_checks['timestamp'])
+                    with connection.cursor() as cursor:
+                        inserted_count, repaired_count = load_store_status_frame(cursor, status_checks)
+                    connection.commit()
+            except Exception as error:
+                failed_attempts += 1
+                if isinstance(error, (DataError, IntegrityError)) or failed_attempts >= MAX_WRITE_ATTEMPTS:
+                    print(f'Writing {len(status_checks)} status checks failed {failed_attempts} times, dropping '
+                          f'them: {error}')
+                    INGEST_DROPPED_ROWS.inc(len(status_checks))
+                    with self._condition:
+                        self._queued_rows -= len(status_checks)
+                        self.dropped_rows += len(status_checks)
+                    retry_delay, failed_attempts = self.batch_seconds, 0
+                    continue
+                print(f'Writing {len(status_checks)} status checks failed, retrying in {retry_delay:.1f}s: {error}')
+                with self._condition:
+                    self._frames.extendleft(reversed(batch))
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY_SECONDS)
+                continue
+            retry_delay, failed_attempts = self.batch_seconds, 0
+            INGEST_BATCH_SECONDS.observe(time.perf_counter() - started_at)
+            INGEST_ROWS.inc(inserted_count)
+            with self._condition:
+                self._queued_rows -= len(status_checks)
+                self.written_rows += inserted_count
+                self.repaired_stores += repaired_count
+                self._recent_writes.append((time.monotonic(), inserted_count))
+                self._forget_old_writes()
+
+    def _forget_old_writes(self) -> None:
+        while self._recent_writes and self._recent_writes[0][0] < time.monotonic() - INGEST_RATE_WINDOW_SECONDS:
+            self._recent_writes.popleft()
+
+
+_status_ingest_queue = None
+_status_ingest_queue_lock = Lock()
+
+
+def get_status_ingest_queue() -> StatusIngestQueue:
+    """
+    Gets the process wide ingest queue, starting its writer on first use.
+    """
+    global _status_ingest_queue
+    with _status_ingest_queue_lock:
+        if _status_ingest_queue is None:
+            _status_ingest_queue = StatusIngestQueue()
+        return _status_ingest_queue
+
+
+def get_ingest_queue_rows() -> int:
+    queue = _status_ingest_queue
+    return queue.queued_rows if queue is not None else 0
+
+
+def get_ingest_rows_per_second() -> float:
+    queue = _status_ingest_queue
+    return queue.rows_per_second if queue is not None else 0.0
+
+
+def close_status_ingest_queue(timeout: float = DEFAULT_CLOSE_TIMEOUT_SECONDS) -> None:
+    """
+    Writes the queued status checks and stops the process wide ingest queue, if it was started. Status checks not
+    written within `timeout` seconds (e.g. while the database is down) are lost with the process.
+    """
+    global _status_ingest_queue
+    with _status_ingest_queue_lock:
+        if _status_ingest_queue is not None:
+            if not _status_ingest_queue.close(timeout):
+                print(f'Gave up writing {_status_ingest_queue.queued_rows} queued status checks after {timeout}s.')
+            _status_ingest_queue = None
+
+
+INGEST_QUEUE_ROWS.set_function(get_ingest_queue_rows)
+INGEST_ROWS_PER_SECOND.set_function(get_ingest_rows_per_second)
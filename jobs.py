@@ -0,0 +1,463 @@
+import os
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+import psycopg2
+from psycopg2 import DatabaseError
+
+from db import get_connection_parameters, pooled_connection
+from metrics import REPORT_DURATION_SECONDS, REPORT_JOBS_PENDING, REPORT_JOBS_RUNNING, REPORT_STAGE_SECONDS, \
+    REPORT_STORES_PROCESSED
+from report_progress import REPORT_STAGES, ReportCancelled
+
+DEFAULT_JOB_PRIORITY = 0
+DEFAULT_MAX_ATTEMPTS = int(os.environ.get('REPORT_JOB_MAX_ATTEMPTS', 3))
+# 0 leaves the number of running jobs to the number of workers
+DEFAULT_MAX_RUNNING_JOBS = int(os.environ.get('REPORT_JOBS_MAX_RUNNING', 0))
+DEFAULT_JOB_LEASE_DURATION = timedelta(minutes=5)
+DEFAULT_RETRY_DELAY = timedelta(seconds=30)
+MAX_RETRY_DELAY = timedelta(minutes=30)
+# Serializes claims while a limit on the running jobs is set, so concurrent claims cannot exceed it
+CLAIM_LOCK_KEY = 'ReportJobs:claim'
+JOB_STATUSES = ('Pending', 'Running', 'Completed', 'Failed', 'Cancelled')
+# Reports committed this long after they finished are still observed, see `observe_finished_reports`
+FINISHED_REPORTS_OVERLAP = timedelta(minutes=5)
+
+# The latest "finished_at" observed by `observe_finished_reports`, and the reports observed since it minus the overlap
+_observed_reports_until: datetime | None = None
+_observed_reports: set = set()
+_observed_reports_lock = Lock()
+
+
+def create_report_jobs_table(connection) -> None:
+    """
+    Creates the queue of report generation jobs.
+
+    :param connection: A database connection object.
+
+    :return: None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS "ReportJobs" (
+            "id" BIGSERIAL NOT NULL PRIMARY KEY,
+            "report_id" UUID NOT NULL UNIQUE,
+            "engine" TEXT NOT NULL,
+            "shards" INT NOT NULL DEFAULT 0,
+            "report_time" TIMESTAMP WITH TIME ZONE NOT NULL,
+            "priority" INT NOT NULL DEFAULT 0,
+            "status" TEXT NOT NULL DEFAULT 'Pending',
+            "attempts" INT NOT NULL DEFAULT 0,
+            "max_attempts" INT NOT NULL DEFAULT 3,
+            "run_after" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+            "leased_by" TEXT,
+            "lease_expires_at" TIMESTAMP WITH TIME ZONE,
+            "last_error" TEXT,
+            "created_at" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+            "finished_at" TIMESTAMP WITH TIME ZONE,
+
+            FOREIGN KEY ("report_id") REFERENCES "ReportStatus"("id") ON DELETE CASCADE ON UPDATE CASCADE
+        );
+        """)
+        # The claim order of the pending jobs; only created when missing, as it would wait for running claims
+        cursor.execute("""
+            SELECT to_regclass('"ReportJobs_pending_idx"') IS NULL;
+        """)
+        if cursor.fetchone()[0]:
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS "ReportJobs_pending_idx" ON "ReportJobs" ("priority" DESC, "run_after", "id")
+                WHERE "status" = 'Pending';
+            """)
+    connection.commit()
+
+
+def enqueue_report_job(cursor, report_id: str, engine: str, now: datetime, shards: int = 0,
+                       priority: int = DEFAULT_JOB_PRIORITY, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> int:
+    """
+    Queues the generation of a created report. Nothing is committed, so the job can be queued in the transaction
+    that creates the report, and a report never exists without its job.
+
+    :param cursor: A cursor of the connection to queue with.
+    :param report_id: A UUID string representing the ID of the report.
+    :param engine: The report engine computing the report, one of `REPORT_ENGINES`.
+    :param now: A timezone aware datetime used as the current time of the report.
+    :param shards: Split the stores into this many shards computed by a pool of worker processes, or 0.
+    :param priority: Jobs with a higher priority are claimed first.
+    :param max_attempts: How often the job is tried before the report is failed.
+
+    :return: The ID of the job.
+    """
+    cursor.execute("""
+        INSERT INTO "ReportJobs" ("report_id", "engine", "shards", "report_time", "priority", "max_attempts")
+        VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING "id";
+    """, (report_id, engine, shards, now, priority, max_attempts))
+    return cursor.fetchone()[0]
+
+
+def claim_report_job(connection, worker_id: str, lease_duration: timedelta = DEFAULT_JOB_LEASE_DURATION,
+                     max_running: int = DEFAULT_MAX_RUNNING_JOBS):
+    """
+    Leases the pending job with the highest priority whose retry delay is over. `FOR UPDATE SKIP LOCKED` lets any
+    number of workers claim concurrently without waiting on each other.
+
+    :param connection: A database connection object.
+    :param worker_id: A string identifying the claiming worker.
+    :param lease_duration: How long the job stays leased to the worker unless the lease is renewed.
+    :param max_running: Claim nothing while this many jobs are running, or 0 for no limit.
+
+    :return: A (job_id, report_id, engine, shards, report_time, attempts) tuple or None.
+    """
+    with connection.cursor() as cursor:
+        if max_running > 0:
+            cursor.execute("""
+                SELECT pg_advisory_xact_lock(hashtext(%s));
+            """, (CLAIM_LOCK_KEY,))
+            cursor.execute("""
+                SELECT COUNT(*) FROM "ReportJobs" WHERE "status" = 'Running';
+            """)
+            if cursor.fetchone()[0] >= max_running:
+                connection.rollback()
+                return None
+        cursor.execute("""
+            UPDATE "ReportJobs"
+            SET "status" = 'Running', "leased_by" = %s, "lease_expires_at" = NOW() + %s, "attempts" = "attempts" + 1
+            WHERE "id" = (
+                SELECT "id" FROM "ReportJobs"
+                WHERE "status" = 'Pending' AND "run_after" <= NOW()
+                ORDER BY "priority" DESC, "run_after", "id"
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING "id", "report_id", "engine", "shards", "report_time", "attempts";
+        """, (worker_id, lease_duration))
+        job = cursor.fetchone()
+    connection.commit()
+    return job
+
+
+def get_retry_delay(attempts: int, retry_delay: timedelta = DEFAULT_RETRY_DELAY) -> timedelta:
+    """
+    :return: The delay before the next attempt of a job that failed `attempts` times, doubling with every attempt.
+    """
+    return min(retry_delay * 2 ** max(attempts - 1, 0), MAX_RETRY_DELAY)
+
+
+def finish_report_job(connection, job_id: int, worker_id: str, error: BaseException | None = None) -> str:
+    """
+    Records the outcome of a leased job. A failed job is queued again after its retry delay until it used up its
+    attempts, with its report set back to 'Running'; then the report stays 'Failed'. Nothing is recorded if the
+    lease was lost to stale job recovery.
+
+    :param connection: A database connection object.
+    :param job_id: The ID of the job.
+    :param worker_id: The string identifying the worker holding the lease.
+    :param error: The error the job failed with, or None if it completed.
+
+    :return: The status of the job after this outcome, or 'Lost' if the lease was lost.
+    """
+    connection.rollback()
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT "report_id", "status", "attempts", "max_attempts" FROM "ReportJobs"
+            WHERE "id" = %s AND "leased_by" = %s
+            FOR UPDATE;
+        """, (job_id, worker_id))
+        leased_job = cursor.fetchone()
+        if leased_job is None or leased_job[1] not in ('Running', 'Cancelled'):
+            connection.rollback()
+            return 'Lost'
+        report_id, status, attempts, max_attempts = leased_job
+        if status == 'Cancelled' or isinstance(error, ReportCancelled):
+            status = 'Cancelled'
+        elif error is None:
+            status = 'Completed'
+        elif attempts < max_attempts:
+            status = 'Pending'
+            cursor.execute("""
+                UPDATE "ReportStatus"
+                SET "status" = 'Running', "finished_at" = NULL, "stores_processed" = 0
+                WHERE "id" = %s AND "status" = 'Failed';
+            """, (report_id,))
+        else:
+            status = 'Failed'
+            cursor.execute("""
+                UPDATE "ReportStatus" SET "status" = 'Failed', "finished_at" = COALESCE("finished_at", NOW())
+                WHERE "id" = %s AND "status" = 'Running';
+            """, (report_id,))
+        cursor.execute("""
+            UPDATE "ReportJobs"
+            SET "status" = %s, "leased_by" = NULL, "lease_expires_at" = NULL, "last_error" = %s,
+                "run_after" = CASE WHEN %s = 'Pending' THEN NOW() + %s ELSE "run_after" END,
+                "finished_at" = CASE WHEN %s = 'Pending' THEN NULL ELSE NOW() END
+            WHERE "id" = %s;
+        """, (status, error and f'{type(error).__name__}: {error}', status, get_retry_delay(attempts), status,
+              job_id))
+    connection.commit()
+    return status
+
+
+def renew_report_job_lease(connection, job_id: int, worker_id: str,
+                           lease_duration: timedelta = DEFAULT_JOB_LEASE_DURATION) -> str | None:
+    """
+    Extends the lease of a running job.
+
+    :return: The status of the job, or None if the lease was lost.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE "ReportJobs" SET "lease_expires_at" = NOW() + %s
+            WHERE "id" = %s AND "leased_by" = %s
+            RETURNING "status";
+        """, (lease_duration, job_id, worker_id))
+        job = cursor.fetchone()
+    connection.commit()
+    return job and job[0]
+
+
+def recover_stale_report_jobs(connection) -> int:
+    """
+    Releases the running jobs whose lease expired because their worker died or hung. They are queued again, or
+    failed together with their report once they used up their attempts.
+
+    :param connection: A database connection object.
+
+    :return: The number of recovered jobs.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            WITH stale AS (
+                UPDATE "ReportJobs"
+                SET "status" = CASE WHEN "attempts" < "max_attempts" THEN 'Pending' ELSE 'Failed' END,
+                    "leased_by" = NULL, "lease_expires_at" = NULL, "last_error" = 'The lease expired',
+                    "finished_at" = CASE WHEN "attempts" < "max_attempts" THEN NULL ELSE NOW() END
+                WHERE "id" IN (
+                    SELECT "id" FROM "ReportJobs" WHERE "status" = 'Running' AND "lease_expires_at" < NOW()
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING "report_id", "status"
+            )
+            UPDATE "ReportStatus" AS report
+            SET "status" = CASE WHEN stale."status" = 'Failed' THEN 'Failed' ELSE 'Running' END,
+                "finished_at" = CASE WHEN stale."status" = 'Failed' THEN NOW() END,
+                "stores_processed" = 0
+            FROM stale
+            WHERE report."id" = stale."report_id" AND report."status" <> 'Cancelled';
+        """)
+        recovered_count = cursor.rowcount
+    connection.commit()
+    return recovered_count
+
+
+def cancel_report_job(connection, report_id: str) -> bool:
+    """
+    Cancels a pending or running report. A pending job is never claimed; a running one stops at its next progress
+    save, or at once if it waits on a statement (see `JobHeartbeat`).
+
+    :param connection: A database connection object.
+    :param report_id: A UUID string representing the ID of the report.
+
+    :return: Whether the report was still pending or running.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE "ReportJobs" SET "status" = 'Cancelled', "finished_at" = NOW()
+            WHERE "report_id" = %s AND "status" IN ('Pending', 'Running');
+        """, (report_id,))
+        cursor.execute("""
+            UPDATE "ReportStatus" SET "status" = 'Cancelled', "finished_at" = clock_timestamp()
+            WHERE "id" = %s AND "status" = 'Running';
+        """, (report_id,))
+        cancelled = cursor.rowcount > 0
+        cursor.execute("""
+            SELECT to_regclass('"ReportShards"') IS NOT NULL;
+        """)
+        if cancelled and cursor.fetchone()[0]:
+            cursor.execute("""
+                UPDATE "ReportShards" SET "status" = 'Cancelled' WHERE "report_id" = %s AND "status" = 'Pending';
+            """, (report_id,))
+    connection.commit()
+    return cancelled
+
+
+class JobHeartbeat(Thread):
+    """
+    Renews the lease of a running job on a connection of its own every third of the lease duration, so a long
+    report is not recovered as stale while its worker is alive. Once the job is cancelled, the statement running on
+    the job's connection is cancelled, so a report computed in one statement (the 'sql' engine) stops at once.
+    """
+
+    def __init__(self, job_connection, job_id: int, worker_id: str,
+                 lease_duration: timedelta = DEFAULT_JOB_LEASE_DURATION):
+        super().__init__(name=f'report-job-{job_id}-heartbeat', daemon=True)
+        self.job_connection = job_connection
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease_duration = lease_duration
+        self._stopped = Event()
+
+    def run(self) -> None:
+        connection = psycopg2.connect(**get_connection_parameters())
+        try:
+            while not self._stopped.wait(self.lease_duration.total_seconds() / 3):
+                try:
+                    status = renew_report_job_lease(connection, self.job_id, self.worker_id, self.lease_duration)
+                except DatabaseError as error:
+                    print(f'Renewing the lease of job {self.job_id} failed: {error}')
+                    connection.rollback()
+                    continue
+                if status == 'Cancelled':
+                    self.job_connection.cancel()
+                    return
+        finally:
+            connection.close()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+
+def run_report_job(connection, worker_id: str, job, lease_duration: timedelta = DEFAULT_JOB_LEASE_DURATION) -> str:
+    """
+    Generates the report of a leased job while a `JobHeartbeat` renews the lease, and records the outcome. The
+    downloadable files of a completed report are written right away (see `report_artifacts.py`).
+
+    :param connection: A database connection object, used for the report and nothing else meanwhile.
+    :param worker_id: The string identifying the worker holding the lease.
+    :param job: A job as returned by `claim_report_job`.
+    :param lease_duration: How long each renewal extends the lease.
+
+    :return: The status of the job afterwards, see `finish_report_job`.
+    """
+    from reporting import generate_report_data
+    from report_artifacts import write_report_artifacts
+    from report_shards import generate_report_data_sharded
+
+    job_id, report_id, engine, shards, report_time, attempts = job
+    report_id = str(report_id)
+    heartbeat = JobHeartbeat(connection, job_id, worker_id, lease_duration)
+    heartbeat.start()
+    started_at = perf_counter()
+    error = None
+    try:
+        if shards > 0:
+            generate_report_data_sharded(connection, report_id, engine, shards, now=report_time)
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT "status" FROM "ReportStatus" WHERE "id" = %s;
+                """, (report_id,))
+                report_status = cursor.fetchone()[0]
+            connection.rollback()
+            if report_status == 'Cancelled':
+                raise ReportCancelled(f'Report {report_id} was cancelled')
+            if report_status == 'Failed':
+                with connection.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT "shard_id", "last_error" FROM "ReportShards"
+                        WHERE "report_id" = %s AND "status" = 'Failed'
+                        ORDER BY "shard_id";
+                    """, (report_id,))
+                    shard_errors = '; '.join(f'shard {shard_id}: {shard_error}'
+                                             for shard_id, shard_error in cursor.fetchall())
+                connection.rollback()
+                raise RuntimeError(f'Shards of report {report_id} failed ({shard_errors})')
+            if report_status != 'Completed':
+                raise RuntimeError(f'Shards of report {report_id} are left unfinished')
+        else:
+            generate_report_data(connection, report_id, engine, report_time)
+    except Exception as job_error:
+        error = job_error
+    finally:
+        heartbeat.stop()
+    status = finish_report_job(connection, job_id, worker_id, error)
+    print(f'Job {job_id} (report {report_id}, attempt {attempts}): {status} after '
+          f'{perf_counter() - started_at:.1f}s{f" ({error})" if error else ""}')
+    if status == 'Completed':
+        # The report is complete either way; without artifacts its first download writes them
+        try:
+            write_report_artifacts(connection, report_id)
+        except Exception as artifact_error:
+            connection.rollback()
+            print(f'Writing the artifacts of report {report_id} failed: {artifact_error}')
+    return status
+
+
+def count_report_jobs(status: str) -> int:
+    """
+    :return: The number of jobs with the given status, or 0 if the queue cannot be read.
+    """
+    try:
+        with pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT COUNT(*) FROM "ReportJobs" WHERE "status" = %s;
+                """, (status,))
+                job_count = cursor.fetchone()[0]
+            connection.rollback()
+        return job_count
+    except DatabaseError:
+        return 0
+
+
+REPORT_JOBS_PENDING.set_function(lambda: count_report_jobs('Pending'))
+REPORT_JOBS_RUNNING.set_function(lambda: count_report_jobs('Running'))
+
+
+def observe_finished_reports() -> int:
+    """
+    Records the reports finished since the previous call in the report metrics of this process: their duration by
+    engine and outcome, their time per stage and their processed stores. Reports are generated by the report
+    workers, in processes of their own, so the API reads them from "ReportStatus" when its metrics are rendered.
+    Reports finished before the first call are marked as observed without being recorded, so the metrics count from
+    the start of the process like the others. A report is observed once per finish, also when it is committed out of "finished_at" order (within
+    `FINISHED_REPORTS_OVERLAP`).
+
+    :return: The number of newly observed reports, 0 if the reports cannot be read.
+    """
+    global _observed_reports_until
+    with _observed_reports_lock:
+        first_call_at = None
+        try:
+            with pooled_connection() as connection:
+                with connection.cursor() as cursor:
+                    if _observed_reports_until is None:
+                        cursor.execute("""
+                            SELECT LOCALTIMESTAMP;
+                        """)
+                        first_call_at = cursor.fetchone()[0]
+                    cursor.execute(f"""
+                        SELECT report."id", report."finished_at", COALESCE(job."engine", 'unknown'), report."status",
+                            EXTRACT(EPOCH FROM report."finished_at" - report."started_at"), report."stores_processed",
+                            {', '.join(f'report."{stage}_seconds"' for stage in REPORT_STAGES)}
+                        FROM "ReportStatus" AS report
+                        LEFT JOIN "ReportJobs" AS job ON job."report_id" = report."id"
+                        WHERE report."finished_at" > %s AND report."status" IN ('Completed', 'Failed', 'Cancelled')
+                        ORDER BY report."finished_at";
+                    """, ((_observed_reports_until or first_call_at) - FINISHED_REPORTS_OVERLAP,))
+                    finished_reports = cursor.fetchall()
+                connection.rollback()
+        except DatabaseError as error:
+            print(f'Reading the finished reports failed: {error}')
+            return 0
+        if first_call_at is not None:
+            _observed_reports_until = first_call_at
+        observed_count = 0
+        for report_id, finished_at, engine, status, duration, stores_processed, *stage_seconds in finished_reports:
+            if (report_id, finished_at) in _observed_reports:
+                continue
+            _observed_reports.add((report_id, finished_at))
+            _observed_reports_until = max(_observed_reports_until, finished_at)
+            # The overlap before the first call holds reports finished before this process started
+            if first_call_at is not None and finished_at <= first_call_at:
+                continue
+            observed_count += 1
+            if duration is not None:
+                REPORT_DURATION_SECONDS.observe(float(duration), engine=engine, status=status)
+            for stage, seconds in zip(REPORT_STAGES, stage_seconds):
+                REPORT_STAGE_SECONDS.observe(seconds, stage=stage)
+            REPORT_STORES_PROCESSED.inc(stores_processed)
+        overlap_start = _observed_reports_until - FINISHED_REPORTS_OVERLAP
+        _observed_reports.difference_update([observed_report for observed_report in _observed_reports
+                                             if observed_report[1] <= overlap_start])
+        return observed_count
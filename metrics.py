@@ -0,0 +1,164 @@
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Seconds, from a fast query up to a report over every store
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+                   600.0, 1800.0)
+
+_registry: List['Metric'] = []
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """
+    A metric of the process, rendered in the Prometheus text exposition format by `render_metrics`. Every
+    metric registers itself on creation and is safe to update from any thread.
+    """
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._lock = Lock()
+        _registry.append(self)
+
+    def label_values(self, labels: dict) -> Tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'Metric "{self.name}" takes the labels {", ".join(self.label_names) or "none"}')
+        return tuple(labels[name] for name in self.label_names)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        # Unlabelled metrics are rendered from the start, labelled ones once a label combination is seen
+        values = self._values or ({} if self.label_names else {(): 0.0})
+        for key, value in values.items():
+            yield f'{self.name}{format_labels(self.label_names, key)} {value}'
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, either set by the code it measures or read from `function` when rendered.
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple, float] = {}
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float, **labels) -> None:
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        Reads the (unlabelled) value from `function` every time the metrics are rendered.
+        """
+        self._function = function
+
+    def samples(self) -> Iterator[str]:
+        if self._function is not None:
+            yield f'{self.name} {self._function()}'
+            return
+        # Unlabelled metrics are rendered from the start, labelled ones once a label combination is seen
+        values = self._values or ({} if self.label_names else {(): 0.0})
+        for key, value in values.items():
+            yield f'{self.name}{format_labels(self.label_names, key)} {value}'
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (count per bucket, sum, count)
+        self._values: Dict[Tuple, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.label_values(labels)
+        with self._lock:
+            bucket_counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[i] += 1
+            self._values[key] = bucket_counts, total + value, count + 1
+
+    def samples(self) -> Iterator[str]:
+        for key, (bucket_counts, total, count) in self._values.items():
+            for upper_bound, bucket_count in zip((*self.buckets, '+Inf'), (*bucket_counts, count)):
+                bucket_labels = format_labels(self.label_names, key, f'le="{upper_bound}"')
+                yield f'{self.name}_bucket{bucket_labels} {bucket_count}'
+            yield f'{self.name}_sum{format_labels(self.label_names, key)} {total}'
+            yield f'{self.name}_count{format_labels(self.label_names, key)} {count}'
+
+
+def render_metrics() -> str:
+    """
+    :return: Every metric of the process in the Prometheus text exposition format (version 0.0.4).
+    """
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+REPORT_DURATION_SECONDS = Histogram('report_duration_seconds', 'Time to generate a report, by engine and outcome.',
+                                    ('engine', 'status'))
+REPORT_STAGE_SECONDS = Histogram('report_stage_seconds',
+                                 'Time a report spent in each stage: fetch, localize, estimate and write.', ('stage',))
+REPORT_STORES_PROCESSED = Counter('report_stores_processed_total', 'Stores whose report rows were computed.')
+REPORT_JOBS_PENDING = Gauge('report_jobs_pending', 'Report jobs queued and not claimed by a worker yet.')
+REPORT_JOBS_RUNNING = Gauge('report_jobs_running', 'Report jobs running on the workers.')
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'Latency of database statements on pooled connections, by '
+                                                 'statement type.', ('statement',))
+INGEST_QUEUE_ROWS = Gauge('status_ingest_queue_rows', 'Status checks queued for writing by POST /status.')
+INGEST_ROWS = Counter('status_ingest_rows_total', 'Status checks written by POST /status.')
+INGEST_DROPPED_ROWS = Counter('status_ingest_dropped_rows_total',
+                              'Status checks of POST /status dropped after their writes failed.')
+INGEST_ROWS_PER_SECOND = Gauge('status_ingest_rows_per_second',
+                               'Status checks written by POST /status per second, over the last minute.')
+UPTIME_INDEX_AGE_SECONDS = Gauge('uptime_index_age_seconds',
+                                 'Seconds since the uptime index of GET /uptime was last found to match the data.')
+UPTIME_QUERY_SECONDS = Histogram('uptime_query_seconds', 'Time to answer one GET /uptime query from the index.',
+                                 buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+INGEST_BATCH_SECONDS = Histogram('status_ingest_batch_seconds', 'Time to write one micro-batch of status checks.')
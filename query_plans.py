@@ -0,0 +1,107 @@
+import json
+import sys
+from datetime import timedelta
+from typing import Iterator, List, Tuple
+from uuid import uuid4
+
+import psycopg2
+
+from db import get_connection_parameters
+from reporting import create_reporting_tables
+
+# name -> (query, index name suffix the plan has to use)
+REPORT_QUERIES = {
+    'store status by store': ("""
+        SELECT "timestamp", "active" FROM "StoreStatus" WHERE "store_id" = %(store_id)s ORDER BY "timestamp"
+    """, 'store_id_timestamp_idx'),
+    'store status by store and time': ("""
+        SELECT "timestamp", "active" FROM "StoreStatus"
+        WHERE "store_id" = %(store_id)s AND "timestamp" >= %(week_start)s AND "timestamp" < %(week_end)s
+        ORDER BY "timestamp"
+    """, 'store_id_timestamp_idx'),
+    'business hours by store': ("""
+        SELECT "day_of_week", "start_time_local", "end_time_local" FROM "StoreBusinessHours"
+        WHERE "store_id" = %(store_id)s
+    """, 'StoreBusinessHours_store_id_day_of_week_idx'),
+    'report data by report': ("""
+        SELECT * FROM "ReportData" WHERE "report_id" = %(report_id)s
+    """, 'ReportData_report_id_store_id_idx'),
+}
+# The week window query of the vectorized engine, which has to be pruned to the partitions of the week
+WEEK_WINDOW_QUERY = """
+    SELECT "store_id", "timestamp", "active" FROM "StoreStatus"
+    WHERE "store_id" BETWEEN %(first_store_id)s AND %(last_store_id)s
+        AND "timestamp" >= %(week_start)s AND "timestamp" < %(week_end)s
+"""
+
+
+def iter_plan_nodes(plan: dict) -> Iterator[dict]:
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from iter_plan_nodes(child)
+
+
+def explain(cursor, query: str, parameters: dict) -> List[dict]:
+    cursor.execute(f'EXPLAIN (FORMAT JSON) {query}', parameters)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return list(iter_plan_nodes(plan[0]['Plan']))
+
+
+def check_report_query_plans(connection) -> List[Tuple[str, bool, str]]:
+    """
+    Explains the report queries and checks that each can use its index, and that the week window query only
+    scans the partitions of the week when "StoreStatus" is partitioned. Sequential scans are disabled while
+    explaining, so the check does not depend on the table sizes: a query still planned as a sequential scan has
+    no usable index.
+
+    :param connection: A database connection object.
+
+    :return: A list of (check name, passed, detail) tuples.
+    """
+    results = []
+    create_reporting_tables(connection)
+    with connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute("""
+            SELECT MIN("store_id"), MAX("store_id") FROM "StoreTimezones"
+        """)
+        first_store_id, last_store_id = cursor.fetchone()
+        cursor.execute("""
+            SELECT MAX("timestamp") FROM "StoreStatus"
+        """)
+        week_end = cursor.fetchone()[0]
+        if first_store_id is None or week_end is None:
+            connection.rollback()
+            return [('data', False, 'The datastore is empty.')]
+        parameters = dict(store_id=first_store_id, first_store_id=first_store_id, last_store_id=last_store_id,
+                          week_start=week_end - timedelta(weeks=1), week_end=week_end, report_id=str(uuid4()))
+
+        for name, (query, index_suffix) in REPORT_QUERIES.items():
+            indexes = {node['Index Name'] for node in explain(cursor, query, parameters) if 'Index Name' in node}
+            results.append((name, any(index.endswith(index_suffix) for index in indexes),
+                            f'uses {", ".join(sorted(indexes)) or "no index"}'))
+
+        cursor.execute("""SELECT relkind = 'p' FROM pg_class WHERE oid = '"StoreStatus"'::regclass""")
+        if cursor.fetchone()[0]:
+            relations = {node['Relation Name'] for node in explain(cursor, WEEK_WINDOW_QUERY, parameters)
+                         if 'Relation Name' in node}
+            cursor.execute("""
+                SELECT COUNT(*) FROM pg_inherits WHERE inhparent = '"StoreStatus"'::regclass
+            """)
+            partition_count = cursor.fetchone()[0]
+            # A week window overlaps at most two weekly partitions
+            results.append(('week window partition pruning', len(relations) <= 2,
+                            f'scans {len(relations)} of {partition_count} partitions'))
+    connection.rollback()
+    return results
+
+
+if __name__ == '__main__':
+    _connection = psycopg2.connect(**get_connection_parameters())
+    _results = check_report_query_plans(_connection)
+    _connection.close()
+    for _name, _passed, _detail in _results:
+        print(f'{"ok  " if _passed else "FAIL"} {_name}: {_detail}')
+    sys.exit(0 if all(_passed for _, _passed, _ in _results) else 1)
@@ -0,0 +1,359 @@
+import csv
+import gzip
+import hashlib
+from importlib.util import find_spec
+from io import StringIO
+from tempfile import SpooledTemporaryFile
+from time import perf_counter
+from typing import Dict, Iterator, List, Tuple
+
+from reporting import DEFAULT_READ_BATCH_SIZE, REPORT_CSV_HEADER, iter_report_data
+from type_defs import ReportRow
+
+# Optional encoders, see the `exports` extra of pyproject.toml; their formats are only offered when installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# pyarrow takes longer to import than the rest of the API, so it is only imported once a report is encoded
+PYARROW_INSTALLED = find_spec('pyarrow') is not None
+
+# format -> (media type, content encoding, file extension)
+REPORT_FORMATS: Dict[str, Tuple[str, str | None, str]] = {
+    'csv': ('text/csv', None, 'csv'),
+    'csv.gz': ('text/csv', 'gzip', 'csv'),
+    'csv.zst': ('text/csv', 'zstd', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', None, 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.file', None, 'arrow'),
+}
+# Accepted media types -> the format family they select
+REPORT_MEDIA_TYPES = {
+    'text/csv': 'csv', 'text/*': 'csv', '*/*': 'csv',
+    'application/vnd.apache.parquet': 'parquet', 'application/x-parquet': 'parquet',
+    'application/vnd.apache.arrow.file': 'arrow',
+}
+# Content encodings of the CSV, most preferred first
+CSV_ENCODINGS = (('zstd', 'csv.zst'), ('gzip', 'csv.gz'), ('identity', 'csv'))
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 6
+ARTIFACT_CHUNK_SIZE = 1024 * 1024
+# Encoded files larger than this are spooled to disk while a report is encoded
+ARTIFACT_SPOOL_SIZE = 16 * 1024 * 1024
+# Serializes the writes of the artifacts of a report, see `try_write_report_artifacts`
+ARTIFACT_LOCK_KEY = 'ReportArtifacts:{report_id}'
+# Completed reports never change, so clients may keep them as long as they like
+REPORT_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+
+def create_report_artifacts_table(connection) -> None:
+    """
+    Creates the table holding the encoded files of completed reports, one row per report and format.
+
+    :param connection: A database connection object.
+
+    :return: None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT to_regclass('"ReportArtifacts"') IS NULL;
+        """)
+        if cursor.fetchone()[0]:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS "ReportArtifacts" (
+                "report_id" UUID NOT NULL,
+                "format" TEXT NOT NULL,
+                "etag" TEXT NOT NULL,
+                "size" BIGINT NOT NULL,
+                "content" BYTEA NOT NULL,
+                "created_at" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+
+                PRIMARY KEY ("report_id", "format"),
+                FOREIGN KEY ("report_id") REFERENCES "ReportStatus"("id") ON DELETE CASCADE ON UPDATE CASCADE
+            );
+            """)
+            # The artifacts are compressed already; stored uncompressed, a byte range is read without the rest
+            cursor.execute("""
+                ALTER TABLE "ReportArtifacts" ALTER COLUMN "content" SET STORAGE EXTERNAL;
+            """)
+    connection.commit()
+
+
+def get_available_report_formats() -> List[str]:
+    """
+    :return: The formats of `REPORT_FORMATS` whose encoder is installed.
+    """
+    unavailable = set()
+    if zstandard is None:
+        unavailable.add('csv.zst')
+    if not PYARROW_INSTALLED:
+        unavailable.update(('parquet', 'arrow'))
+    return [report_format for report_format in REPORT_FORMATS if report_format not in unavailable]
+
+
+class ReportArtifactWriter:
+    """
+    Encodes report rows in every available format while they are read, `batch_size` rows at a time: the CSV is fed
+    to incremental gzip and zstd compressors, and Parquet and Arrow files are written a record batch at a time.
+    Every encoded file is spooled to a temporary file of its own, on disk once it outgrows `ARTIFACT_SPOOL_SIZE`, so
+    neither the rows nor the encoded files of a large report are held in memory at once.
+    """
+
+    def __init__(self, batch_size: int = DEFAULT_READ_BATCH_SIZE):
+        """
+        :param batch_size: The number of buffered rows that triggers an encoded batch.
+        """
+        self.batch_size = batch_size
+        self.files = {report_format: SpooledTemporaryFile(max_size=ARTIFACT_SPOOL_SIZE)
+                      for report_format in get_available_report_formats()}
+        self._buffer: List[ReportRow] = []
+        self._csv_buffer = StringIO()
+        self._csv_writer = csv.writer(self._csv_buffer, lineterminator='\n')
+        self._csv_writer.writerow(REPORT_CSV_HEADER)
+        # A fixed mtime and no file name keep the file, and so its ETag, the same for the same rows
+        self._csv_compressors = [gzip.GzipFile(filename='', mode='wb', compresslevel=GZIP_LEVEL,
+                                               fileobj=self.files['csv.gz'], mtime=0)]
+        if 'csv.zst' in self.files:
+            self._csv_compressors.append(zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+                self.files['csv.zst'], closefd=False))
+        self._arrow_writers = []
+        if 'parquet' in self.files:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+            self._arrow_schema = pyarrow.schema(
+                [(name, pyarrow.int64() if name == 'store_id' else pyarrow.int32()) for name in REPORT_CSV_HEADER])
+            self._arrow_writers = [
+                pyarrow.parquet.ParquetWriter(self.files['parquet'], self._arrow_schema, compression='zstd'),
+                pyarrow.ipc.new_file(self.files['arrow'], self._arrow_schema)]
+
+    def write(self, report_row: ReportRow) -> None:
+        self._buffer.append(report_row)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        self._csv_writer.writerows(self._buffer)
+        csv_chunk = self._csv_buffer.getvalue().encode()
+        self._csv_buffer.seek(0)
+        self._csv_buffer.truncate()
+        self.files['csv'].write(csv_chunk)
+        for csv_compressor in self._csv_compressors:
+            csv_compressor.write(csv_chunk)
+        if self._arrow_writers and self._buffer:
+            import pyarrow
+            columns = list(zip(*self._buffer))
+            record_batch = pyarrow.RecordBatch.from_arrays(
+                [pyarrow.array(column, type=field.type) for column, field in zip(columns, self._arrow_schema)],
+                schema=self._arrow_schema)
+            for arrow_writer in self._arrow_writers:
+                arrow_writer.write_batch(record_batch)
+        self._buffer.clear()
+
+    def close(self) -> Dict[str, SpooledTemporaryFile]:
+        """
+        Encodes the buffered rows and ends every file.
+
+        :return: The encoded files by format, rewound.
+        """
+        self.flush()
+        for encoder in self._csv_compressors + self._arrow_writers:
+            encoder.close()
+        for file in self.files.values():
+            file.seek(0)
+        return self.files
+
+
+def write_report_artifacts(connection, report_id: str) -> Dict[str, int]:
+    """
+    Encodes a completed report in every available format and stores the files, so downloads are served from them
+    instead of encoding the report again. The rows are read in store order and encoded as they arrive (see
+    `ReportArtifactWriter`), and the files are stored one at a time. Formats stored before, e.g. by a concurrent
+    download, are kept.
+
+    :param connection: A database connection object.
+    :param report_id: A UUID string representing the ID of the report.
+
+    :return: The size in bytes of every encoded format.
+    """
+    start_time = perf_counter()
+    writer = ReportArtifactWriter()
+    try:
+        for report_row in iter_report_data(connection, report_id):
+            writer.write(report_row)
+        sizes = {}
+        with connection.cursor() as cursor:
+            for report_format, file in writer.close().items():
+                content = file.read()
+                # Frees the file before the next one is read
+                file.close()
+                cursor.execute("""
+                    INSERT INTO "ReportArtifacts" ("report_id", "format", "etag", "size", "content")
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT ("report_id", "format") DO NOTHING;
+                """, (report_id, report_format, f'"{hashlib.sha256(content).hexdigest()[:32]}"', len(content),
+                      content))
+                sizes[report_format] = len(content)
+        connection.commit()
+    finally:
+        for file in writer.files.values():
+            file.close()
+    print(f'Report {report_id}: Wrote {len(sizes)} artifacts '
+          f'({", ".join(f"{report_format} {size} B" for report_format, size in sizes.items())}) '
+          f'in {perf_counter() - start_time:.1f}s')
+    return sizes
+
+
+def try_write_report_artifacts(connection, report_id: str) -> bool:
+    """
+    Writes the artifacts of a report unless another connection is writing them already, so concurrent downloads of
+    a report without artifacts encode it once. Nothing is encoded if every available format was stored meanwhile.
+
+    :param connection: A database connection object.
+    :param report_id: A UUID string representing the ID of the report.
+
+    :return: Whether the artifacts are stored, False if another connection is still writing them.
+    """
+    lock_key = ARTIFACT_LOCK_KEY.format(report_id=report_id)
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT pg_try_advisory_lock(hashtext(%s));
+        """, (lock_key,))
+        locked = cursor.fetchone()[0]
+    connection.commit()
+    if not locked:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT "format" FROM "ReportArtifacts" WHERE "report_id" = %s;
+            """, (report_id,))
+            stored_formats = {report_format for report_format, in cursor.fetchall()}
+        connection.rollback()
+        if not stored_formats.issuperset(get_available_report_formats()):
+            write_report_artifacts(connection, report_id)
+        return True
+    finally:
+        connection.rollback()
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT pg_advisory_unlock(hashtext(%s));
+            """, (lock_key,))
+        connection.commit()
+
+
+def get_report_artifact(connection, report_id: str, report_format: str) -> Tuple[str, int] | None:
+    """
+    :return: The (ETag, size) of a stored report artifact, or None if it was not written yet.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT "etag", "size" FROM "ReportArtifacts" WHERE "report_id" = %s AND "format" = %s;
+        """, (report_id, report_format))
+        artifact = cursor.fetchone()
+    connection.rollback()
+    return artifact
+
+
+def iter_report_artifact(connection, report_id: str, report_format: str, first_byte: int, byte_count: int,
+                         chunk_size: int = ARTIFACT_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Reads `byte_count` bytes of a stored report artifact from `first_byte` on, `chunk_size` bytes per query, so
+    only one chunk is held in memory at a time.
+
+    :return: An iterator of byte chunks.
+    """
+    try:
+        with connection.cursor() as cursor:
+            for offset in range(first_byte, first_byte + byte_count, chunk_size):
+                cursor.execute("""
+                    SELECT substring("content" FROM %s FOR %s) FROM "ReportArtifacts"
+                    WHERE "report_id" = %s AND "format" = %s;
+                """, (offset + 1, min(chunk_size, first_byte + byte_count - offset), report_id, report_format))
+                yield bytes(cursor.fetchone()[0])
+    finally:
+        connection.rollback()
+
+
+def parse_quality_values(header: str) -> List[Tuple[str, float]]:
+    """
+    :return: The (lowercase value, quality) pairs of an Accept or Accept-Encoding header, in header order.
+    """
+    values = []
+    for item in header.split(','):
+        value, *parameters = [part.strip() for part in item.split(';')]
+        if not value:
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            name, _, parameter_value = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(parameter_value)
+                except ValueError:
+                    quality = 0.0
+        values.append((value.lower(), quality))
+    return values
+
+
+def negotiate_report_format(accept: str, accept_encoding: str, available_formats: List[str]) -> str | None:
+    """
+    Picks the report format for the Accept and Accept-Encoding headers of a request: the accepted media type with
+    the highest quality, and for CSV the most compact accepted content encoding.
+
+    :param accept: The Accept header, CSV if empty.
+    :param accept_encoding: The Accept-Encoding header, no encoding if empty.
+    :param available_formats: The formats that can be served, see `get_available_report_formats`.
+
+    :return: A format of `REPORT_FORMATS`, or None if none of the available formats is acceptable.
+    """
+    media_types = parse_quality_values(accept) or [('text/csv', 1.0)]
+    families = sorted(((quality, -position, REPORT_MEDIA_TYPES[media_type])
+                       for position, (media_type, quality) in enumerate(media_types)
+                       if quality > 0 and media_type in REPORT_MEDIA_TYPES), reverse=True)
+    encodings = dict(parse_quality_values(accept_encoding))
+    for _, _, family in families:
+        if family != 'csv':
+            if family in available_formats:
+                return family
+            continue
+        # identity stays acceptable unless it is refused explicitly
+        acceptable = [(encodings.get(encoding, encodings.get('*', 1.0 if encoding == 'identity' else 0.0)),
+                       -preference, report_format)
+                      for preference, (encoding, report_format) in enumerate(CSV_ENCODINGS)
+                      if report_format in available_formats]
+        quality, _, report_format = max(acceptable)
+        if quality > 0:
+            return report_format
+    return None
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    :return: Whether an If-None-Match header lists the ETag, compared weakly as the header requires.
+    """
+    candidates = [candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag.removeprefix('W/') in candidates
+
+
+def parse_byte_range(range_header: str, size: int) -> Tuple[int, int] | None:
+    """
+    Parses a Range header asking for a single byte range of a file of `size` bytes.
+
+    :return: The first and last (inclusive) byte of the range, or None to send the whole file because the header
+            is not a single byte range.
+    :raises ValueError: If the range is not satisfiable.
+    """
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, separator, last = ranges.strip().partition('-')
+    if not separator or not (first + last).isdigit() or (first and last and int(last) < int(first)):
+        return None
+    if not first:
+        # A suffix range: the last `last` bytes
+        if int(last) == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - int(last), 0), size - 1
+    if int(first) >= size:
+        raise ValueError('Range not satisfiable')
+    return int(first), min(int(last), size - 1) if last else size - 1
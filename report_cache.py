@@ -0,0 +1,135 @@
+import os
+from datetime import datetime, timedelta
+from typing import Callable, Tuple
+from uuid import uuid4
+
+from pytz import utc
+
+from schema import bootstrap_schema
+
+DEFAULT_CACHE_TTL = timedelta(seconds=int(os.environ.get('REPORT_CACHE_TTL_SECONDS', 3600)))
+
+
+def create_report_cache_table(connection) -> None:
+    """
+    Creates the table mapping a report bucket, data watermark and engine to the report computed for them.
+    "ReportStatus" has to exist already, see `schema.bootstrap_schema`.
+
+    :param connection: A database connection object.
+
+    :return: None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS "ReportCache" (
+            "bucket" TIMESTAMP WITH TIME ZONE NOT NULL,
+            "watermark" TEXT NOT NULL,
+            "engine" TEXT NOT NULL,
+            "report_id" UUID NOT NULL,
+            "created_at" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+
+            PRIMARY KEY ("bucket", "watermark", "engine"),
+            FOREIGN KEY ("report_id") REFERENCES "ReportStatus"("id") ON DELETE CASCADE ON UPDATE CASCADE
+        );
+        """)
+    connection.commit()
+
+
+def get_report_bucket(now: datetime) -> datetime:
+    """
+    :return: The start of the hour bucket of a timezone aware datetime, in UTC. Report windows end at a local
+            hour, so reports of the same bucket cover the same windows, except for stores in timezones offset from
+            UTC by a fraction of an hour, whose windows may lag by up to one hour.
+    """
+    return now.astimezone(utc).replace(minute=0, second=0, microsecond=0)
+
+
+def get_data_watermark(cursor, until: datetime | None = None) -> str:
+    """
+    Gets a version of the data reports are computed from. Every status check and business hours row gets a
+    higher id than the ones before, and stores are only ever added, so the version changes with any ingest.
+
+    :param cursor: A database cursor object.
+    :param until: A naive UTC datetime; only the status checks before it count, so checks ingested for later times
+            leave the version unchanged. All status checks count if None.
+
+    :return: A string identifying the current version of the data.
+    """
+    cursor.execute("""
+        SELECT (SELECT MAX("id") FROM "StoreStatus" WHERE %s::TIMESTAMP IS NULL OR "timestamp" < %s),
+            (SELECT MAX("id") FROM "StoreBusinessHours"), (SELECT COUNT(*) FROM "StoreTimezones");
+    """, (until, until))
+    return ':'.join(str(value) for value in cursor.fetchone())
+
+
+def evict_report_cache(connection, ttl: timedelta = DEFAULT_CACHE_TTL) -> int:
+    """
+    Drops the cache entries older than `ttl` and those of failed or cancelled reports. The reports themselves are
+    kept.
+
+    :param connection: A database connection object.
+    :param ttl: How long a report is reused after it was triggered.
+
+    :return: The number of dropped entries.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            DELETE FROM "ReportCache" AS cache USING "ReportStatus" AS report
+            WHERE cache."report_id" = report."id"
+                AND (cache."created_at" < NOW() - %s OR report."status" IN ('Failed', 'Cancelled'));
+        """, (ttl,))
+        evicted_count = cursor.rowcount
+    connection.commit()
+    return evicted_count
+
+
+def get_or_create_report(connection, engine: str, now: datetime, ttl: timedelta = DEFAULT_CACHE_TTL,
+                         force: bool = False, on_create: Callable | None = None) -> Tuple[str, bool]:
+    """
+    Gets the report of the current bucket, data watermark and engine, whether it is still running or completed,
+    or creates it. Concurrent triggers, including those of other API processes, serialize on an advisory lock
+    of the cache key, so exactly one of them creates the report and the others get its ID.
+
+    :param connection: A database connection object.
+    :param engine: The report engine computing the report, one of `REPORT_ENGINES`.
+    :param now: A timezone aware datetime used as the current time of the report.
+    :param ttl: How long a report is reused after it was triggered.
+    :param force: Create a new report even if one is cached, and cache it instead.
+    :param on_create: Called with the cursor and the ID of a created report before it is committed, e.g. to queue
+            its generation in the same transaction.
+
+    :return: A tuple of the report ID and whether the report was created (and still has to be generated).
+    """
+    bootstrap_schema(connection)
+    evict_report_cache(connection, ttl)
+    bucket = get_report_bucket(now)
+    with connection.cursor() as cursor:
+        # The report windows of a bucket end at its start (see `get_report_bucket`), so the status checks ingested
+        # during the hour only change the reports of the next bucket
+        watermark = get_data_watermark(cursor, bucket.replace(tzinfo=None))
+        cursor.execute("""
+            SELECT pg_advisory_xact_lock(hashtext(%s));
+        """, (f'ReportCache:{bucket.isoformat()}:{watermark}:{engine}',))
+        if force:
+            cursor.execute("""
+                DELETE FROM "ReportCache" WHERE "bucket" = %s AND "watermark" = %s AND "engine" = %s;
+            """, (bucket, watermark, engine))
+        cursor.execute("""
+            SELECT "report_id" FROM "ReportCache" WHERE "bucket" = %s AND "watermark" = %s AND "engine" = %s;
+        """, (bucket, watermark, engine))
+        cached = cursor.fetchone()
+        if cached is not None:
+            connection.commit()
+            return str(cached[0]), False
+
+        report_id = str(uuid4())
+        cursor.execute("""
+            INSERT INTO "ReportStatus" ("id") VALUES (%s);
+        """, (report_id,))
+        cursor.execute("""
+            INSERT INTO "ReportCache" ("bucket", "watermark", "engine", "report_id") VALUES (%s, %s, %s, %s);
+        """, (bucket, watermark, engine, report_id))
+        if on_create is not None:
+            on_create(cursor, report_id)
+    connection.commit()
+    return report_id, True
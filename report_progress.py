@@ -0,0 +1,155 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic, perf_counter
+from typing import Dict
+
+from psycopg2 import DatabaseError
+
+from db import pooled_connection
+from metrics import REPORT_STAGE_SECONDS, REPORT_STORES_PROCESSED
+from type_defs import StoreRange
+
+REPORT_STAGES = ('fetch', 'localize', 'estimate', 'write')
+DEFAULT_PROGRESS_INTERVAL_SECONDS = 1.0
+
+_current_progress: ContextVar = ContextVar('report_progress', default=None)
+
+
+class ReportCancelled(Exception):
+    """
+    Raised while a report is generated once its "ReportStatus" row was set to 'Cancelled'.
+    """
+
+
+class ReportProgress:
+    """
+    Tracks the stores processed and the time spent in each of `REPORT_STAGES` while a report (or a shard of it) is
+    generated, and adds them to the report's "ReportStatus" row at most every `interval` seconds. Progress is saved
+    on a pooled connection of its own, so it is visible while the report's rows are still uncommitted. Only the
+    increments since the previous save are added, so the shards of a report computed by several workers add up in
+    the same row. Every save also reads back the status of the report, so a cancelled report stops at the next one.
+    """
+
+    def __init__(self, report_id: str, interval: float = DEFAULT_PROGRESS_INTERVAL_SECONDS):
+        """
+        :param report_id: A UUID string representing the ID of the report.
+        :param interval: The minimum number of seconds between two saves.
+        """
+        self.report_id = str(report_id)
+        self.interval = interval
+        self.stores_processed = 0
+        self.cancelled = False
+        self.stage_seconds: Dict[str, float] = dict.fromkeys(REPORT_STAGES, 0.0)
+        self._unsaved_stores = 0
+        self._unsaved_seconds: Dict[str, float] = dict.fromkeys(REPORT_STAGES, 0.0)
+        self._saved_at = monotonic()
+
+    def start(self, store_range: StoreRange) -> None:
+        """
+        Records the start time of the report, unless a shard started it already, and the number of stores in
+        `store_range` as its total.
+        """
+        self._execute("""
+            UPDATE "ReportStatus"
+            SET "started_at" = COALESCE("started_at", clock_timestamp()),
+                "stores_total" = (SELECT COUNT(*) FROM "StoreTimezones" WHERE "store_id" BETWEEN %s AND %s)
+            WHERE "id" = %s;
+        """, (*store_range, self.report_id))
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Adds the time spent in the `with` block to the stage `name`.
+        """
+        started_at = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - started_at
+            self.stage_seconds[name] += seconds
+            self._unsaved_seconds[name] += seconds
+
+    def advance(self, store_count: int = 1) -> None:
+        """
+        Counts processed stores, saving the progress if the last save is `interval` seconds ago.
+
+        :raises ReportCancelled: If the report was cancelled.
+        """
+        self.stores_processed += store_count
+        self._unsaved_stores += store_count
+        if monotonic() - self._saved_at >= self.interval:
+            self.save()
+            if self.cancelled:
+                raise ReportCancelled(f'Report {self.report_id} was cancelled')
+
+    def save(self) -> None:
+        """
+        Adds the stores and stage seconds since the previous save to the "ReportStatus" row. A failed save is
+        reported and retried with the next one, it never fails the report.
+        """
+        stage_columns = ', '.join(f'"{stage}_seconds" = "{stage}_seconds" + %s' for stage in REPORT_STAGES)
+        saved = self._execute(f"""
+            UPDATE "ReportStatus" SET "stores_processed" = "stores_processed" + %s, {stage_columns}
+            WHERE "id" = %s
+            RETURNING "status";
+        """, (self._unsaved_stores, *(self._unsaved_seconds[stage] for stage in REPORT_STAGES), self.report_id))
+        self._saved_at = monotonic()
+        if saved is not None:
+            self.cancelled = saved[:1] == ('Cancelled',)
+            REPORT_STORES_PROCESSED.inc(self._unsaved_stores)
+            self._unsaved_stores = 0
+            self._unsaved_seconds = dict.fromkeys(REPORT_STAGES, 0.0)
+
+    def observe_stages(self) -> None:
+        """
+        Records the stage times of the finished report in the `report_stage_seconds` metric.
+        """
+        for stage, seconds in self.stage_seconds.items():
+            REPORT_STAGE_SECONDS.observe(seconds, stage=stage)
+
+    def _execute(self, query: str, parameters: tuple) -> tuple | None:
+        """
+        :return: The returned row (an empty tuple if none), or None if the statement failed.
+        """
+        try:
+            with pooled_connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(query, parameters)
+                    row = cursor.fetchone() if cursor.description else None
+                connection.commit()
+            return row or ()
+        except DatabaseError as error:
+            print(f'Saving the progress of report {self.report_id} failed: {error}')
+            return None
+
+
+@contextmanager
+def tracking_report_progress(progress: ReportProgress):
+    """
+    Makes `progress` the progress that `report_stage` and `advance_report_progress` record to within the `with`
+    block, so report engines do not have to pass it around.
+    """
+    token = _current_progress.set(progress)
+    try:
+        yield progress
+    finally:
+        _current_progress.reset(token)
+
+
+@contextmanager
+def report_stage(name: str):
+    """
+    Adds the time spent in the `with` block to the stage `name` of the report tracked in this context, if any.
+    """
+    progress = _current_progress.get()
+    if progress is None:
+        yield
+        return
+    with progress.stage(name):
+        yield
+
+
+def advance_report_progress(store_count: int = 1) -> None:
+    progress = _current_progress.get()
+    if progress is not None:
+        progress.advance(store_count)
@@ -0,0 +1,113 @@
+import base64
+import hashlib
+import json
+import re
+from typing import List, Sequence
+
+from reporting import REPORT_CSV_HEADER
+from type_defs import ReportFilter, ReportRow, StoreRange
+
+DEFAULT_PAGE_SIZE = 1_000
+MAX_PAGE_SIZE = 10_000
+MAX_FILTER_STORE_IDS = 1_000
+REPORT_FILTER_COLUMNS = REPORT_CSV_HEADER[1:]
+# Operators of a filter expression and their SQL
+REPORT_FILTER_OPERATORS = {'<': '<', '<=': '<=', '>': '>', '>=': '>=', '=': '=', '!=': '<>'}
+REPORT_FILTER_PATTERN = re.compile(r'^\s*(\w+)\s*(<=|>=|!=|<|>|=)\s*(-?\d+)\s*$')
+
+
+def parse_report_filter(expression: str) -> ReportFilter:
+    """
+    Parses a threshold filter on a report column, e.g. 'uptime_last_day<30'.
+
+    :param expression: A column of `REPORT_FILTER_COLUMNS`, an operator of `REPORT_FILTER_OPERATORS` and an integer.
+
+    :return: A (column, operator, value) tuple.
+    :raises ValueError: If the expression is malformed or names an unknown column.
+    """
+    match = REPORT_FILTER_PATTERN.match(expression)
+    if match is None:
+        raise ValueError(f'Malformed filter "{expression}", expected e.g. "uptime_last_day<30".')
+    column, operator, value = match.groups()
+    if column not in REPORT_FILTER_COLUMNS:
+        raise ValueError(f'Unknown filter column "{column}", expected one of {", ".join(REPORT_FILTER_COLUMNS)}.')
+    return column, operator, int(value)
+
+
+def get_report_query_key(report_id: str, store_ids: Sequence[int], store_range: StoreRange | None,
+                         filters: Sequence[ReportFilter]) -> str:
+    """
+    :return: A short fingerprint of a report query, so a cursor is only accepted by the query that issued it.
+    """
+    query = json.dumps([report_id, sorted(store_ids), store_range, sorted(filters)])
+    return hashlib.sha256(query.encode()).hexdigest()[:16]
+
+
+def encode_report_cursor(query_key: str, last_store_id: int) -> str:
+    """
+    :return: An opaque cursor token for the page after the store `last_store_id`.
+    """
+    token = json.dumps({'query': query_key, 'after': last_store_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip('=')
+
+
+def decode_report_cursor(cursor: str, query_key: str) -> int:
+    """
+    :return: The store id a page continues after.
+    :raises ValueError: If the cursor is malformed or was issued by a different query.
+    """
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        after_store_id = int(token['after'])
+        token_query_key = token['query']
+    except (ValueError, TypeError, KeyError) as error:
+        raise ValueError('Malformed cursor.') from error
+    if token_query_key != query_key:
+        raise ValueError('The cursor belongs to a different query.')
+    return after_store_id
+
+
+def query_report_data(connection, report_id: str, store_ids: Sequence[int] = (),
+                      store_range: StoreRange | None = None, filters: Sequence[ReportFilter] = (),
+                      after_store_id: int | None = None, limit: int = DEFAULT_PAGE_SIZE) -> List[ReportRow]:
+    """
+    Reads one page of the rows of a report ordered by store id, starting after `after_store_id` (keyset
+    pagination). The page is read by a range scan of the "ReportData" ("report_id", "store_id") index from the
+    previous page's last store, so a page takes the same time on the first and the last page of any report, as
+    long as the filters do not skip most rows.
+
+    :param connection: A database connection object.
+    :param report_id: A UUID string representing the ID of the report.
+    :param store_ids: Only return these stores, if any.
+    :param store_range: Only return the stores in this inclusive range of store ids, if given.
+    :param filters: Threshold filters every row must pass, see `parse_report_filter`.
+    :param after_store_id: Only return stores after this store id, the last one of the previous page.
+    :param limit: The maximum number of rows of the page.
+
+    :return: A list of report rows.
+    """
+    conditions, parameters = ['"report_id" = %s'], [report_id]
+    if after_store_id is not None:
+        conditions.append('"store_id" > %s')
+        parameters.append(after_store_id)
+    if store_ids:
+        conditions.append('"store_id" = ANY(%s)')
+        parameters.append(list(store_ids))
+    if store_range is not None:
+        conditions.append('"store_id" BETWEEN %s AND %s')
+        parameters.extend(store_range)
+    for column, operator, value in filters:
+        # Both are checked against `REPORT_FILTER_COLUMNS` and `REPORT_FILTER_OPERATORS` by `parse_report_filter`
+        conditions.append(f'"{column}" {REPORT_FILTER_OPERATORS[operator]} %s')
+        parameters.append(value)
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT "store_id", "uptime_last_hour", "uptime_last_day", "uptime_last_week", "down_time_last_hour", "down_time_last_day", "down_time_last_week"
+            FROM "ReportData"
+            WHERE {' AND '.join(conditions)}
+            ORDER BY "store_id"
+            LIMIT %s
+        """, (*parameters, limit))
+        report_rows = cursor.fetchall()
+    connection.rollback()
+    return report_rows
@@ -0,0 +1,435 @@
+import argparse
+import os
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+from threading import Event, Thread
+from uuid import uuid4
+
+import psycopg2
+from psycopg2 import DatabaseError, errors
+from pytz import utc
+
+from db import get_connection_parameters
+from metrics import REPORT_DURATION_SECONDS
+from report_progress import ReportCancelled, ReportProgress, advance_report_progress, report_stage, \
+    tracking_report_progress
+from reporting import ALL_STORES, REPORT_ENGINES, ReportDataWriter, create_report, get_report_engine, \
+    get_report_inserter, prepare_report_engine
+from schema import bootstrap_schema
+
+DEFAULT_LEASE_DURATION = timedelta(minutes=15)
+# A shard failing this many times is not claimed again, and fails its report
+DEFAULT_SHARD_MAX_ATTEMPTS = int(os.environ.get('REPORT_SHARD_MAX_ATTEMPTS', 3))
+DEFAULT_POLL_INTERVAL_SECONDS = 5.0
+
+
+def create_report_shards_table(connection) -> None:
+    """
+    Creates the table leasing the store ranges of sharded reports to workers.
+
+    :param connection: A database connection object.
+
+    :return: None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS "ReportShards" (
+            "report_id" UUID NOT NULL,
+            "shard_id" INT NOT NULL,
+            "first_store_id" BIGINT NOT NULL,
+            "last_store_id" BIGINT NOT NULL,
+            "engine" TEXT NOT NULL,
+            "report_time" TIMESTAMP WITH TIME ZONE NOT NULL,
+            "status" TEXT NOT NULL DEFAULT 'Pending',
+            "leased_by" TEXT,
+            "lease_expires_at" TIMESTAMP WITH TIME ZONE,
+            "attempts" INT NOT NULL DEFAULT 0,
+            "last_error" TEXT,
+
+            PRIMARY KEY ("report_id", "shard_id"),
+            FOREIGN KEY ("report_id") REFERENCES "ReportStatus"("id") ON DELETE RESTRICT ON UPDATE CASCADE
+        );
+        """)
+        # Tables created before shard errors were recorded; DDL waits for the shards being written, so it only runs
+        # when the column is missing
+        cursor.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE "table_schema" = current_schema() AND "table_name" = 'ReportShards' AND "column_name" = 'last_error'
+        """)
+        if cursor.fetchone() is None:
+            cursor.execute("""
+                ALTER TABLE "ReportShards" ADD COLUMN IF NOT EXISTS "last_error" TEXT;
+            """)
+    connection.commit()
+
+
+def plan_report_shards(connection, report_id: str, shard_count: int, engine: str, now: datetime) -> int:
+    """
+    Splits the stores into `shard_count` contiguous store id ranges of about the same size.
+
+    :param connection: A database connection object.
+    :param report_id: A UUID string representing the ID of the report.
+    :param shard_count: The number of shards to split the stores into.
+    :param engine: The report engine computing every shard, one of `REPORT_ENGINES`.
+    :param now: A timezone aware datetime used as the current time of the report, shared by every shard.
+
+    :return: The number of planned shards (less than `shard_count` when there are fewer stores, and none when the
+            report was planned before, so a retried report keeps its completed shards and tries its failed shards
+            again).
+    """
+    bootstrap_schema(connection)
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE "ReportShards" SET "status" = 'Pending', "attempts" = 0
+            WHERE "report_id" = %s AND "status" = 'Failed';
+        """, (report_id,))
+        cursor.execute("""
+            INSERT INTO "ReportShards" ("report_id", "shard_id", "first_store_id", "last_store_id", "engine", "report_time")
+            SELECT %s, "shard_id", MIN("store_id"), MAX("store_id"), %s, %s
+            FROM (SELECT "store_id", NTILE(%s) OVER (ORDER BY "store_id") AS "shard_id" FROM "StoreTimezones") AS stores
+            GROUP BY "shard_id"
+            ON CONFLICT ("report_id", "shard_id") DO NOTHING;
+        """, (report_id, engine, now, shard_count))
+        planned_shard_count = cursor.rowcount
+    connection.commit()
+    return planned_shard_count
+
+
+def claim_report_shard(connection, worker_id: str, report_id: str | None = None,
+                       lease_duration: timedelta = DEFAULT_LEASE_DURATION,
+                       max_attempts: int = DEFAULT_SHARD_MAX_ATTEMPTS):
+    """
+    Leases the next pending shard, or a running shard whose lease expired because its worker died.
+    `FOR UPDATE SKIP LOCKED` lets any number of workers claim concurrently without waiting on each other.
+    Shards whose lease expired after their last attempt are failed together with their report first.
+
+    :param connection: A database connection object.
+    :param worker_id: A string identifying the claiming worker.
+    :param report_id: Only claim shards of this report, or of any report when None.
+    :param lease_duration: How long the shard stays leased to the worker.
+    :param max_attempts: How often a shard is tried before it fails its report.
+
+    :return: A (report_id, shard_id, first_store_id, last_store_id, engine, report_time) tuple or None.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            WITH stale AS (
+                UPDATE "ReportShards"
+                SET "status" = 'Failed', "lease_expires_at" = NULL, "last_error" = 'The lease expired'
+                WHERE ("report_id", "shard_id") IN (
+                    SELECT "report_id", "shard_id" FROM "ReportShards"
+                    WHERE "status" = 'Running' AND "lease_expires_at" < NOW() AND "attempts" >= %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING "report_id"
+            )
+            UPDATE "ReportStatus" SET "status" = 'Failed', "finished_at" = clock_timestamp()
+            WHERE "id" IN (SELECT "report_id" FROM stale) AND "status" = 'Running';
+        """, (max_attempts,))
+        cursor.execute("""
+            UPDATE "ReportShards"
+            SET "status" = 'Running', "leased_by" = %s, "lease_expires_at" = NOW() + %s, "attempts" = "attempts" + 1
+            WHERE ("report_id", "shard_id") = (
+                SELECT "report_id", "shard_id" FROM "ReportShards"
+                WHERE ("status" = 'Pending' OR ("status" = 'Running' AND "lease_expires_at" < NOW()))
+                    AND "attempts" < %s AND (%s::UUID IS NULL OR "report_id" = %s::UUID)
+                ORDER BY "report_id", "shard_id"
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING "report_id", "shard_id", "first_store_id", "last_store_id", "engine", "report_time";
+        """, (worker_id, lease_duration, max_attempts, report_id, report_id))
+        shard = cursor.fetchone()
+    connection.commit()
+    return shard
+
+
+def release_report_shard(connection, worker_id: str, shard, error: BaseException,
+                         max_attempts: int = DEFAULT_SHARD_MAX_ATTEMPTS) -> str | None:
+    """
+    Gives up the lease of a shard that failed, so the next worker claims it at once instead of after its lease
+    expired. A shard that used up its attempts is failed together with its report. Nothing is recorded if the lease
+    was lost to another worker.
+
+    :param connection: A database connection object, rolled back first.
+    :param worker_id: The string identifying the worker holding the lease.
+    :param shard: A shard as returned by `claim_report_shard`.
+    :param error: The error the shard failed with.
+    :param max_attempts: How often a shard is tried before it fails its report.
+
+    :return: The status of the shard afterwards ('Pending' or 'Failed'), or None if the lease was lost.
+    """
+    report_id, shard_id = shard[:2]
+    connection.rollback()
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE "ReportShards"
+            SET "status" = CASE WHEN "attempts" < %s THEN 'Pending' ELSE 'Failed' END, "lease_expires_at" = NULL,
+                "last_error" = %s
+            WHERE "report_id" = %s AND "shard_id" = %s AND "leased_by" = %s AND "status" = 'Running'
+            RETURNING "status";
+        """, (max_attempts, f'{type(error).__name__}: {error}', report_id, shard_id, worker_id))
+        released_shard = cursor.fetchone()
+        if released_shard is not None and released_shard[0] == 'Failed':
+            cursor.execute("""
+                UPDATE "ReportStatus" SET "status" = 'Failed', "finished_at" = clock_timestamp()
+                WHERE "id" = %s AND "status" = 'Running';
+            """, (report_id,))
+    connection.commit()
+    return released_shard and released_shard[0]
+
+
+class ShardLeaseLost(Exception):
+    """
+    Raised while a shard is computed once its lease was lost to another worker.
+    """
+
+
+def renew_report_shard_lease(connection, worker_id: str, shard,
+                             lease_duration: timedelta = DEFAULT_LEASE_DURATION) -> bool:
+    """
+    Extends the lease of a running shard.
+
+    :return: Whether the lease is still held by `worker_id`.
+    """
+    report_id, shard_id = shard[:2]
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE "ReportShards" SET "lease_expires_at" = NOW() + %s
+            WHERE "report_id" = %s AND "shard_id" = %s AND "leased_by" = %s AND "status" = 'Running';
+        """, (lease_duration, report_id, shard_id, worker_id))
+        renewed = cursor.rowcount > 0
+    connection.commit()
+    return renewed
+
+
+class ShardHeartbeat(Thread):
+    """
+    Renews the lease of a running shard on a connection of its own every third of the lease duration, so a shard
+    taking longer than its lease is not claimed by another worker while its worker is alive. Once the lease is lost
+    anyway, `lost` is set, which stops `write_report_shard` at its next store, and the statement running on the
+    shard's connection is cancelled, so a shard computed in one statement (the 'sql' engine) stops at once.
+    """
+
+    def __init__(self, shard_connection, worker_id: str, shard, lease_duration: timedelta = DEFAULT_LEASE_DURATION):
+        super().__init__(name=f'report-shard-{shard[0]}-{shard[1]}-heartbeat', daemon=True)
+        self.shard_connection = shard_connection
+        self.worker_id = worker_id
+        self.shard = shard
+        self.lease_duration = lease_duration
+        self.lost = False
+        self._stopped = Event()
+
+    def run(self) -> None:
+        connection = psycopg2.connect(**get_connection_parameters())
+        try:
+            while not self._stopped.wait(self.lease_duration.total_seconds() / 3):
+                try:
+                    renewed = renew_report_shard_lease(connection, self.worker_id, self.shard, self.lease_duration)
+                except DatabaseError as error:
+                    print(f'Renewing the lease of shard {self.shard[1]} of report {self.shard[0]} failed: {error}')
+                    connection.rollback()
+                    continue
+                if not renewed:
+                    self.lost = True
+                    self.shard_connection.cancel()
+                    return
+        finally:
+            connection.close()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+
+def run_report_shard(connection, worker_id: str, shard, lease_duration: timedelta = DEFAULT_LEASE_DURATION) -> bool:
+    """
+    Computes the stores of a leased shard and writes their "ReportData" rows in one transaction, while a
+    `ShardHeartbeat` renews the lease. Rows of an earlier attempt are replaced, and nothing is written if the lease
+    was lost to another worker, or if the report was cancelled meanwhile. A shard that fails is rolled back and
+    released (see `release_report_shard`).
+
+    :param connection: A database connection object.
+    :param worker_id: The string identifying the worker holding the lease.
+    :param shard: A shard as returned by `claim_report_shard`.
+    :param lease_duration: How long each renewal extends the lease.
+
+    :return: Whether the shard was completed by this worker.
+    """
+    report_id, shard_id = shard[:2]
+    progress = ReportProgress(report_id)
+    try:
+        if not write_report_shard(connection, worker_id, shard, progress, lease_duration):
+            return False
+    except ReportCancelled:
+        connection.rollback()
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE "ReportShards" SET "status" = 'Cancelled', "lease_expires_at" = NULL
+                WHERE "report_id" = %s AND "shard_id" = %s AND "leased_by" = %s;
+            """, (report_id, shard_id, worker_id))
+        connection.commit()
+        return False
+    except Exception as error:
+        status = release_report_shard(connection, worker_id, shard, error)
+        print(f'Shard {shard_id} of report {report_id} failed ({status or "Lost"}): {error}')
+        return False
+    progress.save()
+    progress.observe_stages()
+    complete_report_if_finished(connection, report_id)
+    return True
+
+
+def write_report_shard(connection, worker_id: str, shard, progress: ReportProgress,
+                       lease_duration: timedelta = DEFAULT_LEASE_DURATION) -> bool:
+    """
+    Computes and writes the rows of a leased shard for `run_report_shard`, recording to `progress`.
+
+    :return: Whether the lease was still held and the rows were committed.
+    """
+    report_id, shard_id, first_store_id, last_store_id, engine, report_time = shard
+    insert_rows = get_report_inserter(engine)
+    heartbeat = ShardHeartbeat(connection, worker_id, shard, lease_duration)
+    heartbeat.start()
+    try:
+        with tracking_report_progress(progress):
+            if insert_rows is None:
+                report_rows = []
+                for report_row in get_report_engine(engine)(connection, report_time, (first_store_id, last_store_id)):
+                    if heartbeat.lost:
+                        raise ShardLeaseLost()
+                    report_rows.append(report_row)
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE "ReportShards" SET "status" = 'Completed', "lease_expires_at" = NULL
+                    WHERE "report_id" = %s AND "shard_id" = %s AND "leased_by" = %s AND "status" = 'Running';
+                """, (report_id, shard_id, worker_id))
+                if cursor.rowcount == 0:
+                    connection.rollback()
+                    return False
+                cursor.execute("""
+                    DELETE FROM "ReportData" WHERE "report_id" = %s AND "store_id" BETWEEN %s AND %s;
+                """, (report_id, first_store_id, last_store_id))
+                if insert_rows is not None:
+                    with report_stage('estimate'):
+                        row_count = insert_rows(cursor, str(report_id), report_time, (first_store_id, last_store_id))
+                    advance_report_progress(row_count)
+                else:
+                    writer = ReportDataWriter(cursor, str(report_id))
+                    for report_row in report_rows:
+                        writer.write(report_row)
+                    writer.flush()
+            connection.commit()
+        return True
+    except (ShardLeaseLost, errors.QueryCanceled):
+        if not heartbeat.lost:
+            raise
+        connection.rollback()
+        print(f'Shard {shard_id} of report {report_id} stopped, its lease was lost')
+        return False
+    finally:
+        heartbeat.stop()
+
+
+def complete_report_if_finished(connection, report_id: str) -> bool:
+    """
+    Flips the report to 'Completed' once every one of its shards is completed.
+
+    :return: Whether the report is completed.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE "ReportStatus" SET "status" = 'Completed', "finished_at" = clock_timestamp()
+            WHERE "id" = %s AND "status" <> 'Cancelled' AND NOT EXISTS (
+                SELECT 1 FROM "ReportShards" WHERE "report_id" = %s AND "status" <> 'Completed'
+            )
+            RETURNING "id";
+        """, (report_id, report_id))
+        completed = cursor.fetchone() is not None
+    connection.commit()
+    return completed
+
+
+def run_shard_worker(report_id: str | None = None, poll_interval: float | None = None,
+                     lease_duration: timedelta = DEFAULT_LEASE_DURATION) -> int:
+    """
+    Claims and computes shards with a connection of its own until none is left.
+
+    :param report_id: Only work on shards of this report, or of any report when None.
+    :param poll_interval: Seconds to wait for new shards once none is left, or None to stop instead.
+    :param lease_duration: How long each claimed shard stays leased to this worker.
+
+    :return: The number of shards completed by this worker.
+    """
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    connection = psycopg2.connect(**get_connection_parameters())
+    completed_shard_count = 0
+    try:
+        bootstrap_schema(connection)
+        while True:
+            shard = claim_report_shard(connection, worker_id, report_id, lease_duration)
+            if shard is None:
+                if poll_interval is None:
+                    return completed_shard_count
+                time.sleep(poll_interval)
+                continue
+            completed_shard_count += run_report_shard(connection, worker_id, shard, lease_duration)
+    finally:
+        connection.close()
+
+
+def generate_report_data_sharded(connection, report_id: str, engine: str = 'python', shard_count: int = 64,
+                                 processes: int | None = None, now: datetime | None = None) -> None:
+    """
+    Generates a report by splitting its stores into shards and computing them on a local pool of worker
+    processes. Workers started on other hosts with `python report_shards.py worker` join in on the same shards.
+
+    :param connection: A database connection object.
+    :param report_id: A UUID string representing the ID of an already created report.
+    :param engine: The report engine computing every shard, one of `REPORT_ENGINES`.
+    :param shard_count: The number of shards to split the stores into.
+    :param processes: The number of local worker processes, defaults to the CPU count.
+    :param now: A timezone aware datetime used as the current time of the report, defaults to the current time.
+
+    :return: None
+    """
+    get_report_engine(engine)
+    started_at = time.perf_counter()
+    ReportProgress(report_id).start(ALL_STORES)
+    prepare_report_engine(connection, engine)
+    plan_report_shards(connection, report_id, shard_count, engine, now or datetime.now(utc))
+    processes = processes or os.cpu_count()
+    # Spawned workers do not inherit the caller's connections or threads
+    with ProcessPoolExecutor(max_workers=processes, mp_context=get_context('spawn')) as executor:
+        for future in [executor.submit(run_shard_worker, report_id) for _ in range(processes)]:
+            future.result()
+    completed = complete_report_if_finished(connection, report_id)
+    REPORT_DURATION_SECONDS.observe(time.perf_counter() - started_at, engine=engine,
+                                    status='Completed' if completed else 'Running')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates reports in store range shards.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Create a report and generate it with a local process pool.')
+    run_parser.add_argument('--engine', choices=REPORT_ENGINES, default='python')
+    run_parser.add_argument('--shards', type=int, default=64)
+    run_parser.add_argument('--processes', type=int, default=None)
+    worker_parser = subparsers.add_parser('worker', help='Work on the shards of running reports.')
+    worker_parser.add_argument('--report-id', default=None)
+    worker_parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL_SECONDS)
+    arguments = parser.parse_args()
+
+    if arguments.command == 'run':
+        _connection = psycopg2.connect(**get_connection_parameters())
+        _report_id = str(uuid4())
+        create_report(_connection, _report_id)
+        generate_report_data_sharded(_connection, _report_id, arguments.engine, arguments.shards,
+                                     arguments.processes)
+        print(f'Report {_report_id} generated.')
+        _connection.close()
+    else:
+        print(f'Completed {run_shard_worker(arguments.report_id, arguments.poll_interval)} shards.')
@@ -1,13 +1,57 @@
-import pandas as pd
-from typing import Tuple
+import csv
+from bisect import bisect_left
+from io import StringIO
+from operator import itemgetter
+from time import perf_counter
+from typing import Dict, Iterator, List, Tuple
 
 from pytz.tzinfo import DstTzInfo
-from tqdm import tqdm
 
+from business_calendar import business_calendar_cache, to_naive_utc
+from db import execute_prepared, register_prepared_statement
+from metrics import REPORT_DURATION_SECONDS
+from report_progress import REPORT_STAGES, ReportCancelled, ReportProgress, advance_report_progress, report_stage, \
+    tracking_report_progress
 from type_defs import StoreStatusList, StoreBusinessHoursListRaw, \
-    StoreTimezoneListRaw, StoreStatusListRaw, Status, StoreBusinessHoursList, StoreBusinessHours
-from datetime import time, datetime, timedelta
-from pytz import timezone
+    StoreTimezoneListRaw, StoreStatusListRaw, Status, BusinessInterval, BusinessIntervalList, ReportRow, StoreRange
+from datetime import date, time, datetime, timedelta
+from pytz import timezone, utc
+
+LAST_HOUR = 1
+LAST_DAY = 24
+LAST_WEEK = 168
+REPORT_WINDOWS = (LAST_HOUR, LAST_DAY, LAST_WEEK)
+REPORT_ENGINES = ('python', 'sweep', 'stream', 'vectorized', 'rollup', 'sql')
+DEFAULT_WRITE_BATCH_SIZE = 5_000
+DEFAULT_READ_BATCH_SIZE = 5_000
+REPORT_CSV_HEADER = ('store_id', 'uptime_last_hour', 'uptime_last_day', 'uptime_last_week', 'down_time_last_hour',
+                     'down_time_last_day', 'down_time_last_week')
+REPORT_DATA_COLUMNS = ('report_id', 'store_id', 'uptime_last_hour', 'uptime_last_day', 'uptime_last_week',
+                       'down_time_last_hour', 'down_time_last_day', 'down_time_last_week')
+# Inclusive bounds of a BIGINT "store_id", the store range of a report that is not sharded
+ALL_STORES: StoreRange = (-2 ** 63, 2 ** 63 - 1)
+
+# The statements run once per store or per API request, prepared on every connection that runs them (see `db.py`)
+register_prepared_statement('report_status', ('UUID',), """
+    SELECT "status" FROM "ReportStatus" WHERE "id" = $1
+""")
+register_prepared_statement('report_progress', ('UUID',), f"""
+    SELECT "status", "created_at", "started_at", "finished_at", "stores_total", "stores_processed",
+        EXTRACT(EPOCH FROM COALESCE("finished_at", LOCALTIMESTAMP) - "started_at"),
+        {', '.join(f'"{stage}_seconds"' for stage in REPORT_STAGES)}
+    FROM "ReportStatus" WHERE "id" = $1
+""")
+# The columns are passed as one array each, so a batch of any size is one execution of the same statement
+register_prepared_statement('insert_report_data', ('UUID', 'BIGINT[]', *['INT[]'] * 6), f"""
+    INSERT INTO "ReportData" ({', '.join(f'"{column}"' for column in REPORT_DATA_COLUMNS)})
+    SELECT $1, * FROM unnest($2, $3, $4, $5, $6, $7, $8)
+""")
+register_prepared_statement('store_status_checks', ('BIGINT',), """
+    SELECT "timestamp", "active" FROM "StoreStatus" WHERE "store_id" = $1 ORDER BY "timestamp"
+""")
+register_prepared_statement('store_business_hours', ('BIGINT',), """
+    SELECT "day_of_week", "start_time_local", "end_time_local" FROM "StoreBusinessHours" WHERE "store_id" = $1
+""")
 
 
 def create_reporting_tables(create_table_connection) -> None:
@@ -27,6 +71,21 @@ def create_reporting_tables(create_table_connection) -> None:
         "created_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
     );
     """)
+    # The progress of a running report, see `report_progress.ReportProgress`. DDL waits for the reports being
+    # written (which lock "ReportStatus" rows through "ReportData"), so it only runs when something is missing.
+    progress_columns = {'started_at': 'TIMESTAMP', 'finished_at': 'TIMESTAMP', 'stores_total': 'INT',
+                        'stores_processed': 'INT NOT NULL DEFAULT 0',
+                        **{f'{stage}_seconds': 'DOUBLE PRECISION NOT NULL DEFAULT 0' for stage in REPORT_STAGES}}
+    cursor.execute("""
+        SELECT "column_name" FROM information_schema.columns
+        WHERE "table_schema" = current_schema() AND "table_name" = 'ReportStatus'
+    """)
+    missing_columns = progress_columns.keys() - {column_name for column_name, in cursor.fetchall()}
+    if missing_columns:
+        cursor.execute(f"""
+            ALTER TABLE "ReportStatus" {', '.join(f'ADD COLUMN IF NOT EXISTS "{column}" {progress_columns[column]}'
+                                                  for column in sorted(missing_columns))};
+        """)
     create_table_connection.commit()
 
     cursor.execute("""
@@ -44,41 +103,54 @@ def create_reporting_tables(create_table_connection) -> None:
         FOREIGN KEY ("report_id") REFERENCES "ReportStatus"("id")  ON DELETE RESTRICT ON UPDATE CASCADE
     );
     """)
+    # Reports are read, paged (see `report_query.py`) and replaced (per shard) by report id and store id
+    cursor.execute("""
+        SELECT to_regclass('"ReportData_report_id_store_id_idx"') IS NULL;
+    """)
+    if cursor.fetchone()[0]:
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS "ReportData_report_id_store_id_idx" ON "ReportData" ("report_id", "store_id");
+        """)
 
     create_table_connection.commit()
     cursor.close()
 
 
-def localize_time(time_string: str, local_timezone: DstTzInfo) -> time:
+def localize_time(time_value: time | str, day: date, local_timezone: DstTzInfo) -> datetime:
     """
-    Converts a time string to a localized datetime object.
+    Combines a local business-hours time with a calendar day into a timezone aware datetime.
 
-    :param time_string: A string representing the time to convert.
+    :param time_value: A time (or a string in the format 'HH:MM:SS') in the store's local time.
+    :param day: The calendar day, in the store's local time.
     :param local_timezone: A timezone object representing the timezone to localize the datetime to.
 
-    :return: A datetime object representing the localized time.
+    :return: A timezone aware datetime. Ambiguous and non-existent local times (DST transitions) are resolved
+            to standard time.
     """
-    time_instance = datetime.strptime(time_string, "%H:%M:%S").time()
+    if isinstance(time_value, str):
+        time_value = datetime.strptime(time_value, "%H:%M:%S").time()
 
-    return datetime.combine(datetime.today(),
-                            time_instance,
-                            local_timezone.localize(datetime.today()).tzinfo).time()
+    return local_timezone.localize(datetime.combine(day, time_value))
 
 
 def estimate_uptime_downtime(status_checks: StoreStatusList,
-                             business_hours: StoreBusinessHours):
+                             business_interval: BusinessInterval) -> Tuple[timedelta, timedelta]:
     """
     Estimate the uptime and downtime of a store based on its status checks and business hours.
 
+    The business interval is walked in one hour slots starting at its opening time. Within a slot that has
+    status checks, the first check is extrapolated backwards to the start of the slot, the time between two
+    checks is attributed to the earlier one and the last check is extrapolated forwards to the end of the slot.
+    A slot without status checks inherits the status of the last check seen in this interval, while the slots
+    before the first check are neither counted as uptime nor downtime.
+
     :param status_checks: A list of tuples representing the status checks for the store, 
-                            where each tuple contains the timestamp and status of the check.
-    :param business_hours: A tuple representing the business hours of the store, where the 
-                            first element is the day of week, second element is start time 
-                            and third element is end time.
-    :return: A tuple containing the estimated uptime and downtime of the store in hours.
+                            where each tuple contains the timezone aware timestamp and status of the check.
+    :param business_interval: A tuple of the timezone aware opening and closing datetime of the store.
+    :return: A tuple containing the estimated uptime and downtime of the store.
     """
-    # Extract the day of week, start and end times of the business hours
-    day_of_week, start_time_local, end_time_local = business_hours
+    # Extract the opening and closing datetime of the business hours
+    open_datetime, close_datetime = business_interval
 
     # Initialize variables to keep track of the uptime and downtime
     cumulative_uptime: timedelta = timedelta()
@@ -88,21 +160,22 @@ def estimate_uptime_downtime(status_checks: StoreStatusList,
     prev_timestamp: datetime | None = None
     prev_status: Status | None = None
 
-    current_time = start_time_local
+    current_time = open_datetime
 
     # Iterate over each hour within business hours
-    while current_time < end_time_local:
-        next_hour = datetime.combine(datetime.today(), current_time) + timedelta(hours=1)
-        # Find the status checks that are within this hour on this day of the week
+    while current_time < close_datetime:
+        next_hour = min(current_time + timedelta(hours=1), close_datetime)
+        # Find the status checks that are within this hour
         hour_status_checks = [(timestamp, status) for timestamp, status in status_checks if
-                              current_time <= timestamp.time() < next_hour.time() and timestamp.weekday() == day_of_week]
+                              current_time <= timestamp < next_hour]
 
         # If there are no status checks within this hour, use linear interpolation to estimate the status
         if not hour_status_checks:
-            if prev_timestamp is not None and prev_status == 'active':
-                cumulative_uptime += timedelta(hours=1)
-            elif prev_timestamp is not None and prev_status == 'inactive':
-                cumulative_downtime += timedelta(hours=1)
+            if prev_timestamp is not None and prev_status:
+                cumulative_uptime += next_hour - current_time
+            elif prev_timestamp is not None:
+                cumulative_downtime += next_hour - current_time
+            current_time = next_hour
             continue
 
         # Iterate over the status checks within this hour
@@ -110,7 +183,7 @@ def estimate_uptime_downtime(status_checks: StoreStatusList,
             # If this is the first status check within this hour, extrapolate backwards to the start of the hour
             if i == 0:
                 duration = timestamp - current_time
-                if status == 'active':
+                if status:
                     cumulative_uptime += duration
                 else:
                     cumulative_downtime += duration
@@ -119,7 +192,7 @@ def estimate_uptime_downtime(status_checks: StoreStatusList,
             else:
                 prev_timestamp, prev_status = hour_status_checks[i - 1]
                 duration = timestamp - prev_timestamp
-                if prev_status == 'active':
+                if prev_status:
                     cumulative_uptime += duration
                 else:
                     cumulative_downtime += duration
@@ -127,7 +200,7 @@ def estimate_uptime_downtime(status_checks: StoreStatusList,
             # If this is the last status check within this hour, extrapolate forwards to the end of the hour
             if i == len(hour_status_checks) - 1:
                 duration = next_hour - timestamp
-                if status == 'active':
+                if status:
                     cumulative_uptime += duration
                 else:
                     cumulative_downtime += duration
@@ -135,12 +208,64 @@ def estimate_uptime_downtime(status_checks: StoreStatusList,
         # Update the previous status check variables
         prev_timestamp, prev_status = hour_status_checks[-1]
 
-        # Increment the current time by one hour
-        current_time += timedelta(hours=1)
+        # Move on to the next hour
+        current_time = next_hour
 
     return cumulative_uptime, cumulative_downtime
 
 
+def attribute_business_interval(status_checks: StoreStatusList, first_check: int, end_check: int,
+                                business_interval: BusinessInterval) -> Iterator[Tuple[datetime, datetime, Status]]:
+    """
+    Attributes the time of a business interval to the statuses of its status checks, by the hour slot rule of
+    `estimate_uptime_downtime`: every status check holds its status from the start of its hour slot (if it is the
+    first check of the slot) until the next check of the slot, the start of the next slot with a check, or the end
+    of the interval.
+
+    :param status_checks: The status checks of the store, sorted by timestamp.
+    :param first_check: The index of the first status check within the business interval.
+    :param end_check: The index after the last status check within the business interval.
+    :param business_interval: A tuple of the opening and closing datetime of the store.
+
+    :return: An iterator of (held from, held until, status) tuples, ordered and not overlapping.
+    """
+    open_datetime, close_datetime = business_interval
+    one_hour = timedelta(hours=1)
+    previous_slot = None
+    for i in range(first_check, end_check):
+        timestamp, status = status_checks[i]
+        slot = (timestamp - open_datetime) // one_hour
+        held_from = open_datetime + slot * one_hour if slot != previous_slot else timestamp
+        if i == end_check - 1:
+            held_until = close_datetime
+        else:
+            next_slot = (status_checks[i + 1][0] - open_datetime) // one_hour
+            held_until = status_checks[i + 1][0] if next_slot == slot else open_datetime + next_slot * one_hour
+        yield held_from, held_until, status
+        previous_slot = slot
+
+
+def sweep_business_interval(status_checks: StoreStatusList, first_check: int, end_check: int,
+                            business_interval: BusinessInterval) -> Tuple[timedelta, timedelta]:
+    """
+    Same estimate as `estimate_uptime_downtime`, in a single pass over the status checks of the interval with
+    `attribute_business_interval`.
+
+    :param status_checks: The timezone aware status checks of the store, sorted by timestamp.
+    :param first_check: The index of the first status check within the business interval.
+    :param end_check: The index after the last status check within the business interval.
+    :param business_interval: A tuple of the timezone aware opening and closing datetime of the store.
+
+    :return: A tuple containing the estimated uptime and downtime of the store.
+    """
+    held = {True: timedelta(), False: timedelta()}
+    for held_from, held_until, status in attribute_business_interval(status_checks, first_check, end_check,
+                                                                     business_interval):
+        held[status] += held_until - held_from
+
+    return held[True], held[False]
+
+
 def create_report(connection, report_id) -> None:
     """
     Creates a new report by inserting a new row into the "ReportStatus" table with a new UUID as 
@@ -153,7 +278,8 @@ def create_report(connection, report_id) -> None:
     Returns:
         A UUID string representing the ID of the newly created report.
     """
-    create_reporting_tables(connection)
+    from schema import bootstrap_schema
+    bootstrap_schema(connection)
     cursor = connection.cursor()
     cursor.execute(f"""
         INSERT INTO "ReportStatus" (id) VALUES ('{report_id}'::uuid);
@@ -162,139 +288,474 @@ def create_report(connection, report_id) -> None:
     cursor.close()
 
 
-def generate_report_data(connection, report_id) -> None:
+def get_report_engine(engine: str):
     """
-    - Generates report data for the given report_id by querying data from the StoreTimezones, 
-        StoreStatus and StoreBusinessHours tables.
-    - Calculates the uptime and downtime for the last hour, day and week for each store and 
-        inserts the data into the ReportData table.
-    - Updates the status of the report to 'Completed' in the ReportStatus table.
+    Resolves the name of a report engine to its row producer.
+
+    Every engine is a callable taking a connection, the report's reference time (a timezone aware UTC
+    datetime) and optionally an inclusive range of store ids, and yielding one `ReportRow` per store.
+
+    :param engine: One of `REPORT_ENGINES`.
+
+    :return: The row producer of the engine.
+    """
+    if engine == 'python':
+        return compute_report_rows
+    if engine == 'sweep':
+        return compute_report_rows_sweep
+    if engine == 'stream':
+        from streaming_reporting import compute_report_rows_stream
+        return compute_report_rows_stream
+    if engine == 'vectorized':
+        from vectorized_reporting import compute_report_rows_vectorized
+        return compute_report_rows_vectorized
+    if engine == 'rollup':
+        from hourly_rollup import compute_report_rows_rollup
+        return compute_report_rows_rollup
+    if engine == 'sql':
+        from sql_reporting import compute_report_rows_sql
+        return compute_report_rows_sql
+    raise ValueError(f'Unknown report engine "{engine}", expected one of {", ".join(REPORT_ENGINES)}')
+
+
+def get_report_inserter(engine: str):
+    """
+    Resolves the name of a report engine that inserts its rows into "ReportData" itself, without returning them
+    to the client.
+
+    Such an inserter is a callable taking a cursor, the report ID, the report's reference time and an inclusive
+    range of store ids, and returning the number of inserted rows.
+
+    :param engine: One of `REPORT_ENGINES`.
+
+    :return: The inserter of the engine, or None if the engine's rows have to be written by a `ReportDataWriter`.
+    """
+    if engine == 'sql':
+        from sql_reporting import insert_report_rows_sql
+        return insert_report_rows_sql
+    return None
+
+
+def compare_report_engines(connection, now: datetime, engines: Tuple[str, str] = ('python', 'sql'),
+                           store_range: StoreRange = ALL_STORES) -> List[Tuple[ReportRow | None, ReportRow | None]]:
+    """
+    Computes a report with two engines and compares their rows store by store.
 
     :param connection: A database connection object.
-    :param report_id: An integer representing the id of the report.
+    :param now: A timezone aware datetime used as the current time of both reports.
+    :param engines: The names of the two engines to compare.
+    :param store_range: The inclusive range of store ids to compare.
+
+    :return: A list of the (first engine's row, second engine's row) pairs that differ, ordered by store id; a row
+            is None if the engine produced none for the store.
+    """
+    first_rows, second_rows = ({report_row[0]: report_row for report_row in
+                                get_report_engine(engine)(connection, now, store_range)} for engine in engines)
+    connection.rollback()
+    return [(first_rows.get(store_id), second_rows.get(store_id))
+            for store_id in sorted(first_rows.keys() | second_rows.keys())
+            if first_rows.get(store_id) != second_rows.get(store_id)]
+
+
+def prepare_report_engine(connection, engine: str) -> None:
+    """
+    Brings the data an engine reads up to date before a report is computed with it; the 'rollup' engine reads
+    the hourly rollup, which is refreshed with the status checks added since its last refresh.
+
+    :param connection: A database connection object.
+    :param engine: One of `REPORT_ENGINES`.
 
     :return: None
     """
+    if engine == 'rollup':
+        from hourly_rollup import refresh_hourly_rollup
+        refresh_hourly_rollup(connection)
+
+
+def to_report_row(store_id: int, uptime_and_downtime: Dict[int, Tuple[timedelta, timedelta]]) -> ReportRow:
+    """
+    Converts the uptime and downtime of each report window into a "ReportData" row; the last hour in minutes,
+    the last day and week in hours, rounded down.
+    """
+    uptime_last_hour, downtime_last_hour = uptime_and_downtime[LAST_HOUR]
+    uptime_last_day, downtime_last_day = uptime_and_downtime[LAST_DAY]
+    uptime_last_week, downtime_last_week = uptime_and_downtime[LAST_WEEK]
+
+    return (store_id,
+            uptime_last_hour // timedelta(minutes=1),
+            uptime_last_day // timedelta(hours=1),
+            uptime_last_week // timedelta(hours=1),
+            downtime_last_hour // timedelta(minutes=1),
+            downtime_last_day // timedelta(hours=1),
+            downtime_last_week // timedelta(hours=1))
+
+
+class ReportDataWriter:
+    """
+    Buffers computed report rows and flushes them into "ReportData" in batches, either with the prepared
+    `insert_report_data` statement or as a `COPY FROM STDIN`. Nothing is committed, so the caller decides the
+    transaction the rows become visible in.
+    """
+
+    def __init__(self, cursor, report_id: str, batch_size: int = DEFAULT_WRITE_BATCH_SIZE, method: str = 'values'):
+        """
+        :param cursor: A cursor of the connection to write with.
+        :param report_id: A UUID string representing the ID of the report the rows belong to.
+        :param batch_size: The number of buffered rows that triggers a flush.
+        :param method: 'values' for prepared inserts of a batch or 'copy' for COPY.
+        """
+        if method not in ('values', 'copy'):
+            raise ValueError(f'Unknown write method "{method}", expected "values" or "copy"')
+        self.cursor = cursor
+        self.report_id = report_id
+        self.batch_size = batch_size
+        self.method = method
+        self.row_count = 0
+        self.write_seconds = 0.0
+        self._buffer: List[ReportRow] = []
+        self._started_at = perf_counter()
+
+    def write(self, report_row: ReportRow) -> None:
+        self._buffer.append(report_row)
+        advance_report_progress()
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+        with report_stage('write'):
+            self._flush()
+
+    def _flush(self) -> None:
+        started_at = perf_counter()
+        if self.method == 'copy':
+            column_list = ', '.join(f'"{column}"' for column in REPORT_DATA_COLUMNS)
+            buffer = StringIO(''.join(f'{self.report_id},{",".join(map(str, report_row))}\n'
+                                      for report_row in self._buffer))
+            self.cursor.copy_expert(f'COPY "ReportData" ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+        else:
+            execute_prepared(self.cursor, 'insert_report_data',
+                             (self.report_id, *(list(column) for column in zip(*self._buffer))))
+        self.row_count += len(self._buffer)
+        self._buffer.clear()
+        self.write_seconds += perf_counter() - started_at
+
+    @property
+    def rows_per_second(self) -> float:
+        """
+        :return: The rows written per second since the writer was created, including the time spent computing them.
+        """
+        return self.row_count / max(perf_counter() - self._started_at, 1e-9)
+
+    def summary(self) -> str:
+        return (f'Wrote {self.row_count} report rows at {self.rows_per_second:.0f} rows/s '
+                f'({self.row_count / max(self.write_seconds, 1e-9):.0f} rows/s spent writing)')
+
+
+def fetch_store_data(connection, store_range: StoreRange = ALL_STORES) \
+        -> Iterator[Tuple[int, str, StoreStatusListRaw, StoreBusinessHoursListRaw]]:
+    """
+    Queries the status checks and business hours of one store at a time.
+
+    :param connection: A database connection object.
+    :param store_range: The inclusive range of store ids to query.
+
+    :return: An iterator of (store_id, timezone name, status checks ordered by timestamp, business hours) tuples.
+    """
+    from tqdm import tqdm
     cursor = connection.cursor()
     # Query the data from StoreTimezones tables
-    cursor.execute("""
-        SELECT "store_id", "timezone"
-        FROM "StoreTimezones"
-    """)
+    with report_stage('fetch'):
+        cursor.execute("""
+            SELECT "StoreTimezones"."store_id", "Timezones"."name"
+            FROM "StoreTimezones" JOIN "Timezones" ON "Timezones"."id" = "StoreTimezones"."timezone_id"
+            WHERE "StoreTimezones"."store_id" BETWEEN %s AND %s
+        """, store_range)
 
-    stores: StoreTimezoneListRaw = cursor.fetchall()
+        stores: StoreTimezoneListRaw = cursor.fetchall()
     for store in tqdm(stores, smoothing=0.9):
         store_id: int = store[0]
         store_timezone: str = store[1]
-        # Query the data from StoreStatus table as status_checks
-        cursor.execute("""
-            SELECT "timestamp", "status"
-            FROM "StoreStatus"
-            WHERE "store_id" = %s
-        """, (store_id,))
+        with report_stage('fetch'):
+            # Query the data from StoreStatus table as status_checks
+            execute_prepared(cursor, 'store_status_checks', (store_id,))
 
-        status_checks: StoreStatusListRaw = cursor.fetchall()
+            status_checks: StoreStatusListRaw = cursor.fetchall()
 
-        # Query the data from StoreBusinessHours table
-        cursor.execute("""
-            SELECT "day_of_week", "start_time_local", "end_time_local"
-            FROM "StoreBusinessHours"
-            WHERE "store_id" = %s
-        """, (store_id,))
-
-        business_days = cursor.fetchall()
-
-        # Calculate the uptime and downtime for the last hour, day and
-        timezone_object = timezone(store_timezone)
-        LAST_HOUR = 1
-        LAST_DAY = 24
-        LAST_WEEK = 168
-        uptime_last_hour, downtime_last_hour = calculate_uptime_and_downtime(LAST_HOUR, business_days, status_checks,
-                                                                             timezone_object)
-        uptime_last_day, downtime_last_day = calculate_uptime_and_downtime(LAST_DAY, business_days, status_checks,
-                                                                           timezone_object)
-        uptime_last_week, downtime_last_week = calculate_uptime_and_downtime(LAST_WEEK, business_days, status_checks,
-                                                                             timezone_object)
-        uptime_last_hour_in_minutes = int(uptime_last_hour.total_seconds() // 60)
-        downtime_last_hour_in_minutes = int(downtime_last_hour.total_seconds() // 60)
-
-        uptime_last_day_in_hours = int(uptime_last_day.total_seconds() // 3600)
-        downtime_last_day_in_hours = int(downtime_last_day.total_seconds() // 3600)
-
-        uptime_last_week_in_hours = int(uptime_last_week.total_seconds() // 3600)
-        downtime_last_week_in_hours = int(downtime_last_week.total_seconds() // 3600)
+            # Query the data from StoreBusinessHours table
+            execute_prepared(cursor, 'store_business_hours', (store_id,))
+
+            business_days = cursor.fetchall()
+        yield store_id, store_timezone, status_checks, business_days
+    cursor.close()
+
+
+def compute_report_rows(connection, now: datetime, store_range: StoreRange = ALL_STORES) -> Iterator[ReportRow]:
+    """
+    The original report engine; estimates every report window of one store at a time with
+    `calculate_uptime_and_downtime`.
+
+    :param connection: A database connection object.
+    :param now: A timezone aware datetime used as the current time of the report.
+    :param store_range: The inclusive range of store ids to report on.
+
+    :return: An iterator of report rows.
+    """
+    for store_id, store_timezone, status_checks, business_days in fetch_store_data(connection, store_range):
+        # Calculate the uptime and downtime for the last hour, day and week
+        with report_stage('localize'):
+            timezone_object = timezone(store_timezone)
+        # The status checks are localized while they are estimated
+        with report_stage('estimate'):
+            report_row = to_report_row(store_id, {
+                duration_in_hours: calculate_uptime_and_downtime(duration_in_hours, business_days, status_checks,
+                                                                 timezone_object, now)
+                for duration_in_hours in REPORT_WINDOWS})
+        yield report_row
+
+
+def compute_report_rows_sweep(connection, now: datetime, store_range: StoreRange = ALL_STORES) \
+        -> Iterator[ReportRow]:
+    """
+    Same as `compute_report_rows`, estimating all report windows of a store in one sweep with
+    `calculate_uptime_and_downtime_windows` over the store's cached business calendar.
+
+    :param connection: A database connection object.
+    :param now: A timezone aware datetime used as the current time of the report.
+    :param store_range: The inclusive range of store ids to report on.
+
+    :return: An iterator of report rows.
+    """
+    for store_id, store_timezone, status_checks, business_days in fetch_store_data(connection, store_range):
+        with report_stage('localize'):
+            timezone_object = timezone(store_timezone)
+            business_intervals = business_calendar_cache.get_business_intervals(
+                store_id, store_timezone, business_days,
+                *get_report_window(max(REPORT_WINDOWS), timezone_object, now))
+        with report_stage('estimate'):
+            report_row = to_report_row(store_id, calculate_uptime_and_downtime_windows(business_days, status_checks,
+                                                                                       timezone_object, now,
+                                                                                       business_intervals))
+        yield report_row
+
+
+def generate_report_data(connection, report_id, engine: str = 'python', now: datetime | None = None,
+                         batch_size: int = DEFAULT_WRITE_BATCH_SIZE, write_method: str = 'values') -> None:
+    """
+    - Generates report data for the given report_id by querying data from the StoreTimezones, 
+        StoreStatus and StoreBusinessHours tables.
+    - Calculates the uptime and downtime for the last hour, day and week for each store and 
+        inserts the data into the ReportData table in batches.
+    - Updates the status of the report to 'Completed' in the ReportStatus table.
+    The rows and the status are committed in one transaction, so a report is never visible half written. If the
+    generation fails, the rows are rolled back and the report is marked 'Failed'. The stores processed and the time
+    spent per stage are saved to the ReportStatus row while the report is generated, see `ReportProgress`. A report
+    cancelled meanwhile is rolled back with `ReportCancelled`, and stays 'Cancelled'.
+
+    :param connection: A database connection object.
+    :param report_id: An integer representing the id of the report.
+    :param engine: The report engine computing the rows, one of `REPORT_ENGINES`.
+    :param now: A timezone aware datetime used as the current time of the report, defaults to the current time.
+            Every store of a report shares it, so engines can be compared on the same data.
+    :param batch_size: The number of rows written per statement.
+    :param write_method: 'values' for multi-row inserts or 'copy' for COPY, see `ReportDataWriter`.
 
+    :return: None
+    """
+    compute_rows = get_report_engine(engine)
+    progress = ReportProgress(report_id)
+    progress.start(ALL_STORES)
+    started_at = perf_counter()
+    status = 'Failed'
+    prepare_report_engine(connection, engine)
+    now = now or datetime.now(utc)
+    cursor = connection.cursor()
+    insert_rows = get_report_inserter(engine)
+    try:
+        with tracking_report_progress(progress):
+            if insert_rows is not None:
+                # The SQL engine fetches, estimates and writes in one statement
+                with report_stage('estimate'):
+                    row_count = insert_rows(cursor, report_id, now)
+                advance_report_progress(row_count)
+                summary = f'Inserted {row_count} report rows in {perf_counter() - started_at:.1f}s'
+            else:
+                writer = ReportDataWriter(cursor, report_id, batch_size, write_method)
+                for report_row in compute_rows(connection, now):
+                    writer.write(report_row)
+                writer.flush()
+                summary = writer.summary()
+
+        cursor.execute("""
+            UPDATE "ReportStatus" SET "status" = 'Completed', "finished_at" = clock_timestamp()
+            WHERE "id" = %s AND "status" <> 'Cancelled';
+        """, (report_id,))
+        if cursor.rowcount == 0:
+            raise ReportCancelled(f'Report {report_id} was cancelled')
+        connection.commit()
+        status = 'Completed'
+    except Exception as error:
+        connection.rollback()
+        if isinstance(error, ReportCancelled):
+            status = 'Cancelled'
         cursor.execute("""
-            INSERT INTO "ReportData" ("report_id", "store_id", "uptime_last_hour", "uptime_last_day", "uptime_last_week", "down_time_last_hour", "down_time_last_day", "down_time_last_week")
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-        """, (report_id, store_id,
-              uptime_last_hour_in_minutes,
-              uptime_last_day_in_hours,
-              uptime_last_week_in_hours,
-              downtime_last_hour_in_minutes,
-              downtime_last_day_in_hours,
-              downtime_last_week_in_hours))
+            UPDATE "ReportStatus" SET "status" = 'Failed', "finished_at" = clock_timestamp()
+            WHERE "id" = %s AND "status" <> 'Cancelled';
+        """, (report_id,))
         connection.commit()
-
-    cursor.execute("""
-        UPDATE "ReportStatus" SET "status" = 'Completed' WHERE "id" = %s;
-    """, (report_id,))
-    connection.commit()
-    cursor.close()
+        raise
+    finally:
+        cursor.close()
+        # Saved after the commit, which releases the lock the status update took on the row
+        progress.save()
+        progress.observe_stages()
+        REPORT_DURATION_SECONDS.observe(perf_counter() - started_at, engine=engine, status=status)
+    print(f'Report {report_id}: {summary}')
 
 
-def localize_timestamp(timestamp: str, local_timezone: DstTzInfo) -> datetime:
+def localize_timestamp(timestamp: datetime, local_timezone: DstTzInfo) -> datetime:
     """
-    Converts a UTC timestamp string to a datetime object with the specified local timezone.
+    Converts a UTC timestamp to a datetime object with the specified local timezone.
 
-    :param timestamp: A string representing a timestamp in the format '%Y-%m-%d %H:%M:%S.%f %Z'.
+    :param timestamp: A naive UTC datetime, as returned for "StoreStatus"."timestamp" (parsed when it was loaded,
+            see `sequelize.prepare_store_status`).
     :param local_timezone: A timezone object representing the local timezone.
 
     returns: A datetime object representing the converted timestamp with the specified local 
             timezone.
     """
-    UTC_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f %Z'
-    return datetime.strptime(timestamp, UTC_DATETIME_FORMAT).replace(tzinfo=local_timezone)
+    return utc.localize(timestamp).astimezone(local_timezone)
+
+
+def get_report_window(duration_in_hours: int, store_timezone: DstTzInfo, now: datetime) -> BusinessInterval:
+    """
+    Gets the window of the last `duration_in_hours` hours of a store, aligned to the store's local hour.
+
+    :param duration_in_hours: The length of the window in hours.
+    :param store_timezone: A timezone object representing the timezone of the store.
+    :param now: A timezone aware datetime used as the current time.
+
+    :return: A tuple of the timezone aware start (inclusive) and end (exclusive) of the window.
+    """
+    now_local = now.astimezone(store_timezone)
+    window_start = (now_local - timedelta(hours=duration_in_hours)).replace(minute=0, second=0, microsecond=0)
+    window_end = window_start + timedelta(hours=duration_in_hours)
+    return window_start, window_end
+
+
+def get_window_days(window_start: datetime, window_end: datetime) -> List[date]:
+    """
+    :return: Every local calendar day a business interval overlapping the window could start on.
+    """
+    first_day = (window_start - timedelta(days=1)).date()
+    return [first_day + timedelta(days=offset) for offset in range((window_end.date() - first_day).days + 1)]
+
+
+def expand_business_hours(business_days: StoreBusinessHoursListRaw, store_timezone: DstTzInfo,
+                          window_start: datetime, window_end: datetime) -> BusinessIntervalList:
+    """
+    Expands the weekly business hours of a store into the concrete business intervals of a window, clipped to
+    the window.
+
+    :return: A list of tuples of the timezone aware opening and closing datetime of each business interval.
+    """
+    business_intervals: BusinessIntervalList = []
+    for day in get_window_days(window_start, window_end):
+        for day_of_week, start_time_local, end_time_local in business_days:
+            if day_of_week != day.weekday():
+                continue
+            open_datetime = max(localize_time(start_time_local, day, store_timezone), window_start)
+            close_datetime = min(localize_time(end_time_local, day, store_timezone), window_end)
+            if open_datetime < close_datetime:
+                business_intervals.append((open_datetime, close_datetime))
+    return business_intervals
+
+
+def calculate_uptime_and_downtime_windows(business_days: StoreBusinessHoursListRaw,
+                                          status_checks: StoreStatusListRaw, store_timezone: DstTzInfo,
+                                          now: datetime, business_intervals: BusinessIntervalList | None = None
+                                          ) -> Dict[int, Tuple[timedelta, timedelta]]:
+    """
+    Calculates the uptime and downtime of a store for every report window together, with the same result as
+    `calculate_uptime_and_downtime`. The status checks are sorted once and the business hours are expanded once
+    for the widest window; every business interval of a window then finds its checks by binary search and is
+    swept once, so a store costs O(n log n) instead of O(hours x checks) per window. Only absolute instants
+    matter to the sweep, so everything is compared in naive UTC and no status check is localized.
+
+    :param business_days: A list of tuples representing the business hours for each day of the week.
+    :param status_checks: A list of tuples of the naive UTC timestamp and status of each status check.
+    :param store_timezone: A timezone object representing the timezone of the store.
+    :param now: A timezone aware datetime used as the current time.
+    :param business_intervals: The (open, close) naive UTC business intervals of the store overlapping the widest
+            window, e.g. from `business_calendar.BusinessCalendarCache`. Expanded from `business_days` if omitted.
+
+    :return: A dictionary of the uptime and downtime tuple of each window in `REPORT_WINDOWS`.
+    """
+    windows = {duration_in_hours: tuple(to_naive_utc(bound) for bound in
+                                        get_report_window(duration_in_hours, store_timezone, now))
+               for duration_in_hours in REPORT_WINDOWS}
+    # Every window ends with the widest one, so its status checks and business intervals cover all of them
+    widest_start, widest_end = windows[max(REPORT_WINDOWS)]
+    widest_status_checks: StoreStatusList = sorted(
+        [(timestamp, status) for timestamp, status in status_checks if widest_start <= timestamp < widest_end],
+        key=itemgetter(0))
+    timestamps = [timestamp for timestamp, _ in widest_status_checks]
+    if business_intervals is None:
+        business_intervals = [(to_naive_utc(open_datetime), to_naive_utc(close_datetime)) for
+                              open_datetime, close_datetime in
+                              expand_business_hours(business_days, store_timezone,
+                                                    *get_report_window(max(REPORT_WINDOWS), store_timezone, now))]
+
+    uptime_and_downtime = {}
+    for duration_in_hours, (window_start, window_end) in windows.items():
+        uptime_in_duration = downtime_in_duration = timedelta()
+        for open_datetime, close_datetime in business_intervals:
+            open_datetime, close_datetime = max(open_datetime, window_start), min(close_datetime, window_end)
+            if open_datetime >= close_datetime:
+                continue
+            uptime, downtime = sweep_business_interval(widest_status_checks,
+                                                       bisect_left(timestamps, open_datetime),
+                                                       bisect_left(timestamps, close_datetime),
+                                                       (open_datetime, close_datetime))
+            uptime_in_duration += uptime
+            downtime_in_duration += downtime
+        uptime_and_downtime[duration_in_hours] = uptime_in_duration, downtime_in_duration
+    return uptime_and_downtime
 
 
 def calculate_uptime_and_downtime(duration_in_hours: int, business_days: StoreBusinessHoursListRaw,
-                                  status_checks: StoreStatusListRaw, store_timezone: DstTzInfo) -> Tuple[
-    timedelta, timedelta]:
+                                  status_checks: StoreStatusListRaw, store_timezone: DstTzInfo,
+                                  now: datetime | None = None) -> Tuple[timedelta, timedelta]:
     """
     Calculates the uptime and downtime for a store within a given duration.
 
     :param duration_in_hours: The duration in hours for which to calculate uptime and downtime.
     :param business_days: A list of tuples representing the business hours for each day of the week.
             Each tuple contains an integer representing the day of the week (0-6, where 0 is Monday and 6 is Sunday),
-            a string representing the start time of the business hours in the format 'HH:MM', and a string representing
-            the end time of the business hours in the format 'HH:MM'.
+            the local start time of the business hours and the local end time of the business hours.
     :param status_checks: A list of tuples representing the status checks for the store.
-            Each tuple contains a string representing the timestamp of the status check in the format 'YYYY-MM-DD HH:MM:SS.ssssss',
-            and a string representing the status of the store ('up' or 'down').
+            Each tuple contains the naive UTC timestamp of the status check, and whether the store was active.
     :param store_timezone: A timezone object representing the timezone of the store.
+    :param now: A timezone aware datetime used as the current time, defaults to the current time.
 
     :return: A tuple containing the uptime and downtime for the store within the given duration.
     """
     uptime_in_duration = downtime_in_duration = timedelta()
-    now_local = datetime.utcnow().astimezone(store_timezone)
-    last_duration_start_time = (now_local - timedelta(hours=duration_in_hours)).replace(minute=0, second=0,
-                                                                                        microsecond=0)
-    last_duration_end_time = last_duration_start_time + timedelta(hours=duration_in_hours)
-    last_duration_business_days: StoreBusinessHoursList \
-        = [(day_of_week, localize_time(start_time_local, store_timezone),
-            localize_time(end_time_local, store_timezone)) for
-           day_of_week, start_time_local,
-           end_time_local in business_days if
-           day_of_week == last_duration_start_time.weekday()]
+    last_duration_start_time, last_duration_end_time = get_report_window(duration_in_hours, store_timezone,
+                                                                         now or datetime.now(utc))
+    last_duration_business_intervals = expand_business_hours(business_days, store_timezone,
+                                                             last_duration_start_time, last_duration_end_time)
 
+    localized_status_checks: StoreStatusList \
+        = [(localize_timestamp(timestamp, store_timezone), status) for timestamp, status in status_checks]
     last_duration_status_checks: StoreStatusList \
-        = [(localize_timestamp(timestamp, store_timezone), status) for
-           timestamp, status in status_checks if
-           last_duration_start_time <= localize_timestamp(timestamp, store_timezone) < last_duration_end_time]
-    for business_hours in last_duration_business_days:
-        response = estimate_uptime_downtime(last_duration_status_checks, business_hours)
-        uptime_in_duration += timedelta(hours=response[0].total_seconds() // 3600)
-        downtime_in_duration += timedelta(hours=response[1].total_seconds() // 3600)
+        = [(timestamp, status) for timestamp, status in localized_status_checks if
+           last_duration_start_time <= timestamp < last_duration_end_time]
+    for business_interval in last_duration_business_intervals:
+        response = estimate_uptime_downtime(last_duration_status_checks, business_interval)
+        uptime_in_duration += response[0]
+        downtime_in_duration += response[1]
     return uptime_in_duration, downtime_in_duration
 
 
@@ -307,9 +768,7 @@ def is_report_completed(connection, report_id: str) -> bool | None:
     :return: A bool representing status of the report or None if the report does not exist.
     """
     with connection.cursor() as cursor:
-        cursor.execute("""
-            SELECT "status" FROM "ReportStatus" WHERE "id" = %s;
-        """, (report_id,))
+        execute_prepared(cursor, 'report_status', (report_id,))
         if cursor.rowcount == 0:
             return None
         status = cursor.fetchone()[0]
@@ -317,6 +776,39 @@ def is_report_completed(connection, report_id: str) -> bool | None:
     return status == 'Completed'
 
 
+def get_report_status(connection, report_id: str) -> dict | None:
+    """
+    Gets the status and progress of a report: the stores processed out of the total, the start and finish times
+    and the seconds spent in each stage so far.
+
+    :param connection: A database connection object.
+    :param report_id: A UUID string representing the ID of the report.
+
+    :return: A JSON serializable dictionary, or None if the report does not exist.
+    """
+    with connection.cursor() as cursor:
+        execute_prepared(cursor, 'report_progress', (report_id,))
+        report_status = cursor.fetchone()
+    connection.rollback()
+    if report_status is None:
+        return None
+
+    status, created_at, started_at, finished_at, stores_total, stores_processed, elapsed_seconds, *stage_seconds \
+        = report_status
+    return {
+        'report_id': report_id,
+        'status': status,
+        'created_at': created_at.isoformat(),
+        'started_at': started_at and started_at.isoformat(),
+        'finished_at': finished_at and finished_at.isoformat(),
+        'stores_total': stores_total,
+        'stores_processed': stores_processed,
+        'progress': round(min(stores_processed / stores_total, 1.0), 4) if stores_total else None,
+        'elapsed_seconds': None if elapsed_seconds is None else round(float(elapsed_seconds), 3),
+        'stage_seconds': {stage: round(seconds, 3) for stage, seconds in zip(REPORT_STAGES, stage_seconds)},
+    }
+
+
 def get_report_data(connection, report_id: str):
     """
     Gets the report data for the given report ID.
@@ -325,15 +817,54 @@ def get_report_data(connection, report_id: str):
 
     :return: A list of tuples representing the report data.
     """
-    with connection.cursor() as cursor:
-        cursor.execute("""
-            SELECT "store_id", "uptime_last_hour", "uptime_last_day", "uptime_last_week", "down_time_last_hour", "down_time_last_day", "down_time_last_week"
-            FROM "ReportData"
-            WHERE "report_id" = %s
-        """, (report_id,))
-        report_data = cursor.fetchall()
+    return list(iter_report_data(connection, report_id))
+
+
+def iter_report_data(connection, report_id: str, batch_size: int = DEFAULT_READ_BATCH_SIZE) -> Iterator[ReportRow]:
+    """
+    Reads the report data for the given report ID in store order through a named (server-side) cursor, so only
+    `batch_size` rows are held in memory at a time. The cursor lives in a transaction that is ended once the rows
+    are exhausted.
 
-    return report_data
+    :param connection: A database connection object.
+    :param report_id: A UUID string representing the ID of the report.
+    :param batch_size: The number of rows fetched from the server per round trip.
+
+    :return: An iterator of report rows.
+    """
+    try:
+        with connection.cursor(name=f'report_data_{report_id.replace("-", "_")}') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute("""
+                SELECT "store_id", "uptime_last_hour", "uptime_last_day", "uptime_last_week", "down_time_last_hour", "down_time_last_day", "down_time_last_week"
+                FROM "ReportData"
+                WHERE "report_id" = %s
+                ORDER BY "store_id"
+            """, (report_id,))
+            yield from cursor
+    finally:
+        connection.rollback()
+
+
+def iter_report_csv(report_rows: Iterator[ReportRow], batch_size: int = DEFAULT_READ_BATCH_SIZE) -> Iterator[str]:
+    """
+    Renders report rows as CSV, starting with the header line, in chunks of up to `batch_size` rows.
+
+    :param report_rows: An iterable of report rows.
+    :param batch_size: The number of rows rendered per chunk.
+
+    :return: An iterator of CSV text chunks.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(REPORT_CSV_HEADER)
+    for row_count, report_row in enumerate(report_rows, 1):
+        writer.writerow(report_row)
+        if row_count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
 
 
 def convert_to_csv(report_data):
@@ -344,12 +875,4 @@ def convert_to_csv(report_data):
 
     :return: A string representing the CSV file.
     """
-    data_frame = pd.DataFrame(report_data,
-                              columns=["store_id",
-                                       "uptime_last_hour",
-                                       "uptime_last_day",
-                                       "uptime_last_week",
-                                       "down_time_last_hour",
-                                       "down_time_last_day",
-                                       "down_time_last_week"])
-    return data_frame.to_csv(index=False)
+    return ''.join(iter_report_csv(report_data))
@@ -0,0 +1,39 @@
+from threading import Lock
+
+# The databases (by DSN) whose tables this process created or checked already
+_bootstrapped_databases = set()
+_bootstrap_lock = Lock()
+
+
+def bootstrap_schema(connection) -> None:
+    """
+    Creates and migrates the tables of the report service once per process and database: the report status and data
+    (`reporting.create_reporting_tables`), the job queue, the report cache, the report shards, the report artifacts
+    and the hourly rollup. The DDL takes catalog locks that wait for the reports being written, so it runs when the
+    API or a worker starts instead of on every request; later calls return at once. The datastore tables are
+    created and migrated by `sequelize.py`.
+
+    :param connection: A database connection object.
+
+    :return: None
+    """
+    if connection.dsn in _bootstrapped_databases:
+        return
+    # Imported here, as every module below uses the bootstrap itself
+    from hourly_rollup import create_rollup_tables
+    from jobs import create_report_jobs_table
+    from report_artifacts import create_report_artifacts_table
+    from report_cache import create_report_cache_table
+    from report_shards import create_report_shards_table
+    from reporting import create_reporting_tables
+
+    with _bootstrap_lock:
+        if connection.dsn in _bootstrapped_databases:
+            return
+        create_reporting_tables(connection)
+        create_report_jobs_table(connection)
+        create_report_cache_table(connection)
+        create_report_shards_table(connection)
+        create_report_artifacts_table(connection)
+        create_rollup_tables(connection)
+        _bootstrapped_databases.add(connection.dsn)
@@ -1,8 +1,23 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import BytesIO, StringIO
+
 import pandas as pd
 import numpy as np
 import psycopg2
 from tqdm import tqdm
 
+from db import get_connection_parameters
+
+DEFAULT_TIMEZONE = 'America/Chicago'
+DATA_SOURCE_DIRECTORY = 'data_source'
+DEFAULT_CHUNK_BYTES = 16 * 1024 * 1024
+# "StoreStatus" partitions span one week each, starting on Mondays, so a report week touches at most two
+STORE_STATUS_PARTITION_DAYS = 7
+
+CONNECTION_PARAMETERS = get_connection_parameters()
+
 
 def is_table_populated(connection, table_name):
     cursor = connection.cursor()
@@ -17,13 +32,91 @@ def is_table_populated(connection, table_name):
     print(f'is_table_populated({table_name}) -> {skip_insertion}')
     return skip_insertion
 
+def copy_dataframe(cursor, dataframe, table_name, columns):
+    """
+    Streams a DataFrame into a table with a single `COPY ... FROM STDIN` round trip.
+
+    :param cursor: A cursor of the connection to copy into.
+    :param dataframe: The DataFrame to copy, its columns in the same order as `columns`.
+    :param table_name: The (unquoted) name of the target table.
+    :param columns: The target column names.
+
+    :return: None
+    """
+    buffer = StringIO()
+    dataframe.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    cursor.copy_expert(f'COPY "{table_name}" ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def intern_timezone(cursor, timezone_name):
+    """
+    Gets the id of a timezone name in "Timezones", adding the name if it is new. The name is looked up first, as
+    every `INSERT ... ON CONFLICT` would use up an id of the small "id" sequence even if the name exists.
+
+    :return: The id of the timezone.
+    """
+    cursor.execute('SELECT "id" FROM "Timezones" WHERE "name" = %s', (timezone_name,))
+    timezone_row = cursor.fetchone()
+    if timezone_row is None:
+        cursor.execute('INSERT INTO "Timezones" ("name") VALUES (%s) ON CONFLICT ("name") DO NOTHING',
+                       (timezone_name,))
+        cursor.execute('SELECT "id" FROM "Timezones" WHERE "name" = %s', (timezone_name,))
+        timezone_row = cursor.fetchone()
+    return timezone_row[0]
+
+
+def repair_orphan_business_hours_stores(cursor, staging_table_name):
+    """
+    Set-based version of `repair_business_hours_record`: gives every store in the staging table that is
+    missing from "StoreTimezones" the default timezone.
+
+    :return: The number of repaired stores.
+    """
+    cursor.execute(f"""
+        INSERT INTO "StoreTimezones" (store_id, timezone_id)
+        SELECT DISTINCT store_id, %s FROM "{staging_table_name}"
+        ORDER BY store_id
+        ON CONFLICT (store_id) DO NOTHING
+    """, (intern_timezone(cursor, DEFAULT_TIMEZONE),))
+    return cursor.rowcount
+
+
+def repair_orphan_store_status_stores(cursor, staging_table_name):
+    """
+    Set-based version of `repair_store_status_record`: gives every store in the staging table that is
+    missing from "StoreTimezones" the default timezone and 24/7 business hours.
+
+    :return: The number of repaired stores.
+    """
+    cursor.execute(f"""
+        WITH repaired AS (
+            INSERT INTO "StoreTimezones" (store_id, timezone_id)
+            SELECT DISTINCT store_id, %s FROM "{staging_table_name}"
+            ORDER BY store_id
+            ON CONFLICT (store_id) DO NOTHING
+            RETURNING store_id
+        )
+        INSERT INTO "StoreBusinessHours" (store_id, day_of_week, start_time_local, end_time_local)
+        SELECT repaired.store_id, day_of_week, '00:00:00', '23:59:59'
+        FROM repaired CROSS JOIN generate_series(0, 6) AS day_of_week
+    """, (intern_timezone(cursor, DEFAULT_TIMEZONE),))
+    return cursor.rowcount // 7
+
+
 def process_business_hours():
     print('Reading "business_hours.csv"...')
-    business_hours = pd.read_csv('data_source/business_hours.csv')
+    business_hours = prepare_business_hours(pd.read_csv(f'{DATA_SOURCE_DIRECTORY}/business_hours.csv'))
+    print(f'"Business Hours" Row Count = {len(business_hours)}')
+
+    return business_hours
+
+
+def prepare_business_hours(business_hours):
     business_hours.fillna({'start_time_local': '00:00:00', 'end_time_local': '23:59:59'}, inplace=True)
     business_hours['start_time_local'] = pd.to_datetime(business_hours['start_time_local'], format='%H:%M:%S').dt.time
     business_hours['end_time_local'] = pd.to_datetime(business_hours['end_time_local'], format='%H:%M:%S').dt.time
-    print(f'"Business Hours" Row Count = {len(business_hours)}')
 
     return business_hours
 
@@ -35,9 +128,8 @@ def insert_business_hours(business_hours_connection, processed_business_hours_da
         return
     def repair_business_hours_record(repair_business_hours_connection, business_hours_row):
         repair_cursor = repair_business_hours_connection.cursor()
-        timezone_repair_data = {'store_id': business_hours_row['store_id'], 'timezone': 'America/Chicago'}
-        repair_cursor.execute(
-            f'INSERT INTO "StoreTimezones" (store_id, timezone) VALUES ({timezone_repair_data["store_id"]}, \'{timezone_repair_data["timezone"]}\')')
+        repair_cursor.execute('INSERT INTO "StoreTimezones" (store_id, timezone_id) VALUES (%s, %s)',
+                              (business_hours_row['store_id'], intern_timezone(repair_cursor, DEFAULT_TIMEZONE)))
         repair_business_hours_connection.commit()
         repair_cursor.execute(
             f'INSERT INTO "StoreBusinessHours" (store_id, day_of_week, start_time_local, end_time_local) VALUES ({business_hours_row["store_id"]}, \'{business_hours_row["day_of_week"]}\', \'{business_hours_row["start_time_local"]}\', \'{business_hours_row["end_time_local"]}\')')
@@ -69,25 +161,89 @@ def insert_business_hours(business_hours_connection, processed_business_hours_da
     cursor.close()
 
 
+def is_store_status_partitioned(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("""SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('"StoreStatus"')""")
+        row = cursor.fetchone()
+    connection.commit()
+    return bool(row and row[0])
+
+
+def ensure_store_status_partitions(connection, timestamps):
+    """
+    Creates the missing weekly partitions of a partitioned "StoreStatus" for a set of status check timestamps,
+    in a short transaction of its own. It has to run before the rows are inserted, outside of the inserting
+    transaction: attaching a partition locks the whole table, which would deadlock against concurrent loaders.
+
+    :param connection: A database connection object.
+    :param timestamps: The timestamps about to be inserted, as UTC strings or datetimes.
+
+    :return: The number of created partitions.
+    """
+    if len(timestamps) == 0 or not is_store_status_partitioned(connection):
+        return 0
+    timestamps = pd.to_datetime(pd.Series(timestamps), format='mixed', utc=True).dt.tz_localize(None)
+    first_week = (timestamps.min() - pd.Timedelta(days=timestamps.min().weekday())).normalize()
+    week_starts = [first_week + pd.Timedelta(days=offset)
+                   for offset in range(0, (timestamps.max() - first_week).days + 1, STORE_STATUS_PARTITION_DAYS)]
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = '"StoreStatus"'::regclass
+    """)
+    existing_partitions = {partition_name for partition_name, in cursor.fetchall()}
+    missing_weeks = [week_start for week_start in week_starts
+                     if f'StoreStatus_{week_start:%Y%m%d}' not in existing_partitions]
+    if missing_weeks:
+        # Loaders racing for the same week serialize here; the losers find the partition already created
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('StoreStatus partitions'))")
+        for week_start in missing_weeks:
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS "StoreStatus_{week_start:%Y%m%d}" PARTITION OF "StoreStatus"
+                FOR VALUES FROM (%s) TO (%s)
+            """, (week_start.to_pydatetime(),
+                  (week_start + pd.Timedelta(days=STORE_STATUS_PARTITION_DAYS)).to_pydatetime()))
+    connection.commit()
+    cursor.close()
+    return len(missing_weeks)
+
+
 def process_store_status():
     print('Reading "store_status.csv"...')
-    store_status = pd.read_csv('data_source/store_status.csv')
-    # store_status['timestamp_utc'] = pd.to_datetime(store_status['timestamp_utc'], format='mixed')
+    store_status = prepare_store_status(pd.read_csv(f'{DATA_SOURCE_DIRECTORY}/store_status.csv'))
     print(f'"Store Status" Row Count = {len(store_status)}')
 
     return store_status
 
 
+def prepare_store_status(store_status):
+    """
+    Normalizes status checks once, when they are loaded: the UTC timestamp strings are parsed in one vectorized
+    call into naive UTC datetimes (the form of "StoreStatus"."timestamp") and the status becomes a boolean, so
+    reports never parse a status check.
+
+    :param store_status: A DataFrame with the columns of "store_status.csv": store_id, status and timestamp_utc.
+
+    :return: A DataFrame of (store_id, active, timestamp) rows.
+    """
+    return pd.DataFrame({
+        'store_id': store_status['store_id'].astype('int64'),
+        'active': store_status['status'] == 'active',
+        'timestamp': pd.to_datetime(store_status['timestamp_utc'], format='mixed', utc=True).dt.tz_localize(None),
+    })
+
+
 def insert_store_status(store_status_connection, processed_store_status_dataframe):
     cursor = store_status_connection.cursor()
     skip_insertion = is_table_populated(store_status_connection, 'store_status_populated')
     if skip_insertion:
         return
+    ensure_store_status_partitions(store_status_connection, processed_store_status_dataframe.iloc[:, 2])
     def repair_store_status_record(repair_store_status_connection, store_status_row):
         repair_cursor = repair_store_status_connection.cursor()
-        timezone_repair_data = {'store_id': store_status_row['store_id'], 'timezone': 'America/Chicago'}
-        repair_cursor.execute(
-            f'INSERT INTO "StoreTimezones" (store_id, timezone) VALUES ({timezone_repair_data["store_id"]}, \'{timezone_repair_data["timezone"]}\')')
+        repair_cursor.execute('INSERT INTO "StoreTimezones" (store_id, timezone_id) VALUES (%s, %s)',
+                              (store_status_row['store_id'], intern_timezone(repair_cursor, DEFAULT_TIMEZONE)))
         repair_store_status_connection.commit()
         for day in range(7):
             try:
@@ -97,20 +253,21 @@ def insert_store_status(store_status_connection, processed_store_status_datafram
             except Exception:
                 repair_store_status_connection.rollback()
                 continue
-        repair_cursor.execute(
-            f'INSERT INTO "StoreStatus" (store_id, status, timestamp) VALUES ({store_status_row["store_id"]}, \'{store_status_row["status"]}\', \'{store_status_row["timestamp"]}\')')
+        repair_cursor.execute('INSERT INTO "StoreStatus" (store_id, active, timestamp) VALUES (%s, %s, %s)',
+                              (store_status_row['store_id'], store_status_row['active'],
+                               store_status_row['timestamp']))
         repair_store_status_connection.commit()
         repair_cursor.close()
     broken_store_count = 0
     broken_stores = []
-    for row in tqdm(np.array(processed_store_status_dataframe), smoothing=0.9):
-        insert_query = 'INSERT INTO "StoreStatus" (store_id, status, timestamp) VALUES (%s, %s, %s)'
+    for row in tqdm(processed_store_status_dataframe.astype(object).to_numpy(), smoothing=0.9):
+        insert_query = 'INSERT INTO "StoreStatus" (store_id, active, timestamp) VALUES (%s, %s, %s)'
         try:
             cursor.execute(insert_query, row)
             store_status_connection.commit()
         except Exception:
             store_status_connection.rollback()
-            dict_row = {'store_id': row[0], 'status': row[1], 'timestamp': row[2]}
+            dict_row = {'store_id': row[0], 'active': row[1], 'timestamp': row[2]}
             broken_stores.append(dict_row)
             broken_store_count += 1
 
@@ -125,11 +282,16 @@ def insert_store_status(store_status_connection, processed_store_status_datafram
 
 def process_timezones():
     print('Reading "timezones.csv"...')
-    timezones = pd.read_csv('data_source/timezones.csv')
-    timezones.fillna({'timezone_str': 'America/Chicago'}, inplace=True)
+    timezones = prepare_timezones(pd.read_csv(f'{DATA_SOURCE_DIRECTORY}/timezones.csv'))
+    print(f'"Timezones" Row Count = {len(timezones)}')
+
+    return timezones
+
+
+def prepare_timezones(timezones):
+    timezones.fillna({'timezone_str': DEFAULT_TIMEZONE}, inplace=True)
     timezones['timezone'] = timezones['timezone_str']  # .apply(lambda x: pytz.timezone(x))
     timezones.drop(columns=['timezone_str'], inplace=True)
-    print(f'"Timezones" Row Count = {len(timezones)}')
 
     return timezones
 
@@ -139,9 +301,9 @@ def insert_timezones(timezones_connection, processed_timezones_dataframe):
     skip_insertion = is_table_populated(timezones_connection, 'timezones_populated')
     if skip_insertion:
         return
-    for row in tqdm(np.array(processed_timezones_dataframe), smoothing=0.9):
-        insert_query = 'INSERT INTO "StoreTimezones" (store_id, timezone) VALUES (%s, %s)'
-        cursor.execute(insert_query, row)
+    for store_id, timezone_name in tqdm(np.array(processed_timezones_dataframe), smoothing=0.9):
+        insert_query = 'INSERT INTO "StoreTimezones" (store_id, timezone_id) VALUES (%s, %s)'
+        cursor.execute(insert_query, (store_id, intern_timezone(cursor, timezone_name)))
         timezones_connection.commit()
     print('Inserted all timezones!')
     cursor.execute('UPDATE "_DataProgress" SET timezones_populated = %s WHERE id = %s', (True, 1))
@@ -149,7 +311,252 @@ def insert_timezones(timezones_connection, processed_timezones_dataframe):
     cursor.close()
 
 
-def create_tables(create_table_connection):
+def load_timezones_frame(cursor, processed_timezones_dataframe):
+    """
+    Copies a processed timezones DataFrame into the datastore inside the caller's transaction.
+
+    :return: A tuple of the inserted row count and the repaired store count.
+    """
+    cursor.execute("""
+        CREATE TEMP TABLE "_StagingStoreTimezones" (store_id BIGINT, timezone TEXT) ON COMMIT DROP
+    """)
+    copy_dataframe(cursor, processed_timezones_dataframe, '_StagingStoreTimezones', ['store_id', 'timezone'])
+    # Only new names are inserted, so no id of the small "id" sequence is used up by a conflict
+    cursor.execute("""
+        INSERT INTO "Timezones" (name)
+        SELECT DISTINCT timezone FROM "_StagingStoreTimezones"
+        WHERE NOT EXISTS (SELECT FROM "Timezones" WHERE "Timezones".name = "_StagingStoreTimezones".timezone)
+        ORDER BY timezone
+        ON CONFLICT (name) DO NOTHING
+    """)
+    cursor.execute("""
+        INSERT INTO "StoreTimezones" (store_id, timezone_id)
+        SELECT DISTINCT ON (staging.store_id) staging.store_id, timezones.id
+        FROM "_StagingStoreTimezones" AS staging JOIN "Timezones" AS timezones ON timezones.name = staging.timezone
+        ORDER BY staging.store_id
+        ON CONFLICT (store_id) DO NOTHING
+    """)
+    return cursor.rowcount, 0
+
+
+def load_business_hours_frame(cursor, processed_business_hours_dataframe):
+    """
+    Copies a processed business hours DataFrame into the datastore inside the caller's transaction.
+
+    :return: A tuple of the inserted row count and the repaired store count.
+    """
+    cursor.execute("""
+        CREATE TEMP TABLE "_StagingStoreBusinessHours" (
+            store_id BIGINT, day_of_week INT, start_time_local TIME, end_time_local TIME
+        ) ON COMMIT DROP
+    """)
+    copy_dataframe(cursor, processed_business_hours_dataframe, '_StagingStoreBusinessHours',
+                   ['store_id', 'day_of_week', 'start_time_local', 'end_time_local'])
+    broken_store_count = repair_orphan_business_hours_stores(cursor, '_StagingStoreBusinessHours')
+    # Rows violating "StoreBusinessHours_start_time_local_check" would abort the whole COPY transaction
+    cursor.execute("""
+        INSERT INTO "StoreBusinessHours" (store_id, day_of_week, start_time_local, end_time_local)
+        SELECT store_id, day_of_week, start_time_local, end_time_local FROM "_StagingStoreBusinessHours"
+        WHERE start_time_local < end_time_local
+    """)
+    return cursor.rowcount, broken_store_count
+
+
+def load_store_status_frame(cursor, processed_store_status_dataframe):
+    """
+    Copies a store status DataFrame prepared by `prepare_store_status` into the datastore inside the caller's
+    transaction.
+
+    :return: A tuple of the inserted row count and the repaired store count.
+    """
+    cursor.execute("""
+        CREATE TEMP TABLE "_StagingStoreStatus" (
+            store_id BIGINT, active BOOLEAN, timestamp TIMESTAMP WITHOUT TIME ZONE
+        ) ON COMMIT DROP
+    """)
+    copy_dataframe(cursor, processed_store_status_dataframe, '_StagingStoreStatus',
+                   ['store_id', 'active', 'timestamp'])
+    broken_store_count = repair_orphan_store_status_stores(cursor, '_StagingStoreStatus')
+    cursor.execute("""
+        INSERT INTO "StoreStatus" (store_id, active, timestamp)
+        SELECT store_id, active, timestamp FROM "_StagingStoreStatus"
+    """)
+    return cursor.rowcount, broken_store_count
+
+
+def bulk_insert_timezones(timezones_connection, processed_timezones_dataframe):
+    cursor = timezones_connection.cursor()
+    skip_insertion = is_table_populated(timezones_connection, 'timezones_populated')
+    if skip_insertion:
+        return
+    inserted_count, _ = load_timezones_frame(cursor, processed_timezones_dataframe)
+    print(f'Inserted all timezones ({inserted_count})!')
+    cursor.execute('UPDATE "_DataProgress" SET timezones_populated = %s WHERE id = %s', (True, 1))
+    timezones_connection.commit()
+    cursor.close()
+
+
+def bulk_insert_business_hours(business_hours_connection, processed_business_hours_dataframe):
+    cursor = business_hours_connection.cursor()
+    skip_insertion = is_table_populated(business_hours_connection, 'business_hours_populated')
+    if skip_insertion:
+        return
+    inserted_count, broken_store_count = load_business_hours_frame(cursor, processed_business_hours_dataframe)
+    print(
+        f'Inserted all business hours ({inserted_count}) and fixed {broken_store_count} broken(timezone-less) stores')
+    cursor.execute('UPDATE "_DataProgress" SET business_hours_populated = %s WHERE id = %s',
+                   (True, 1))
+    business_hours_connection.commit()
+    cursor.close()
+
+
+def bulk_insert_store_status(store_status_connection, processed_store_status_dataframe):
+    cursor = store_status_connection.cursor()
+    skip_insertion = is_table_populated(store_status_connection, 'store_status_populated')
+    if skip_insertion:
+        return
+    ensure_store_status_partitions(store_status_connection, processed_store_status_dataframe.iloc[:, 2])
+    inserted_count, broken_store_count = load_store_status_frame(cursor, processed_store_status_dataframe)
+    print(
+        f'Inserted all store status ({inserted_count}) and fixed {broken_store_count} broken(timezone-less) stores')
+    cursor.execute('UPDATE "_DataProgress" SET store_status_populated = %s WHERE id = %s', (True, 1))
+    store_status_connection.commit()
+    cursor.close()
+
+
+# file name -> (progress column, DataFrame preparation, frame loader)
+SOURCE_FILES = {
+    'timezones.csv': ('timezones_populated', prepare_timezones, load_timezones_frame),
+    'business_hours.csv': ('business_hours_populated', prepare_business_hours, load_business_hours_frame),
+    'store_status.csv': ('store_status_populated', prepare_store_status, load_store_status_frame),
+}
+
+_worker_connection = None
+
+
+def split_csv_chunks(file_path, chunk_bytes):
+    """
+    Splits a csv file into line-aligned byte ranges of roughly `chunk_bytes` each.
+    The split only depends on the file and `chunk_bytes`, so chunk ids are stable between runs.
+
+    :return: A tuple of the header columns and a list of (chunk_id, start_offset, end_offset) tuples.
+    """
+    file_size = os.path.getsize(file_path)
+    chunks = []
+    with open(file_path, 'rb') as source_file:
+        header = source_file.readline().decode().strip().split(',')
+        start_offset = source_file.tell()
+        while start_offset < file_size:
+            source_file.seek(min(start_offset + chunk_bytes, file_size))
+            source_file.readline()
+            end_offset = min(source_file.tell(), file_size)
+            chunks.append((len(chunks), start_offset, end_offset))
+            start_offset = end_offset
+    return header, chunks
+
+
+def read_csv_chunk(file_path, header, start_offset, end_offset):
+    with open(file_path, 'rb') as source_file:
+        source_file.seek(start_offset)
+        data = source_file.read(end_offset - start_offset)
+    return pd.read_csv(BytesIO(data), names=header, header=None)
+
+
+def init_ingest_worker(connection_parameters):
+    global _worker_connection
+    _worker_connection = psycopg2.connect(**connection_parameters)
+
+
+def ingest_chunk(file_name, header, chunk_bytes, chunk_id, start_offset, end_offset):
+    """
+    Loads one chunk of a source file and records its checkpoint in the same transaction, so a chunk is
+    either fully loaded and checkpointed or not loaded at all. Runs inside an ingest worker process.
+
+    :return: The number of rows loaded from the chunk.
+    """
+    _, prepare_frame, load_frame = SOURCE_FILES[file_name]
+    dataframe = prepare_frame(read_csv_chunk(f'{DATA_SOURCE_DIRECTORY}/{file_name}', header, start_offset, end_offset))
+    if file_name == 'store_status.csv':
+        ensure_store_status_partitions(_worker_connection, dataframe.iloc[:, 2])
+    cursor = _worker_connection.cursor()
+    try:
+        load_frame(cursor, dataframe)
+        cursor.execute("""
+            INSERT INTO "_IngestCheckpoint" (file_name, chunk_id, chunk_bytes, start_offset, end_offset, row_count)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (file_name, chunk_id, chunk_bytes, start_offset, end_offset, len(dataframe)))
+        _worker_connection.commit()
+    except Exception:
+        _worker_connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    return len(dataframe)
+
+
+def get_committed_chunks(connection, file_name):
+    """
+    :return: A tuple of the chunk size the file was started with (or None) and the set of committed chunk ids.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT chunk_id, chunk_bytes FROM "_IngestCheckpoint" WHERE file_name = %s', (file_name,))
+        checkpoints = cursor.fetchall()
+    if not checkpoints:
+        return None, set()
+    return checkpoints[0][1], {chunk_id for chunk_id, _ in checkpoints}
+
+
+def ingest_source_file(connection, executor, file_name, chunk_bytes):
+    """
+    Loads a source file chunk by chunk on the worker pool, skipping chunks committed by a previous run.
+
+    :return: None
+    """
+    progress_column = SOURCE_FILES[file_name][0]
+    if is_table_populated(connection, progress_column):
+        return
+    started_chunk_bytes, committed_chunks = get_committed_chunks(connection, file_name)
+    # Resume with the chunk size of the interrupted run, otherwise the chunk ids would not line up
+    chunk_bytes = started_chunk_bytes or chunk_bytes
+    header, chunks = split_csv_chunks(f'{DATA_SOURCE_DIRECTORY}/{file_name}', chunk_bytes)
+    pending_chunks = [chunk for chunk in chunks if chunk[0] not in committed_chunks]
+    print(f'Ingesting "{file_name}": {len(pending_chunks)} of {len(chunks)} chunks pending')
+
+    futures = [executor.submit(ingest_chunk, file_name, header, chunk_bytes, *chunk) for chunk in pending_chunks]
+    row_count = 0
+    for future in tqdm(as_completed(futures), total=len(futures), smoothing=0.9):
+        row_count += future.result()
+    print(f'Ingested {row_count} rows from "{file_name}"')
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'UPDATE "_DataProgress" SET {progress_column} = %s WHERE id = %s', (True, 1))
+    connection.commit()
+
+
+def ingest_source_files(connection, workers, chunk_bytes):
+    """
+    Streams every source file into the datastore in fixed-size chunks loaded in parallel by `workers`
+    processes, each holding its own connection. Peak memory stays around `workers * chunk_bytes`.
+    Files are loaded one after another because business hours and statuses reference timezones.
+
+    :return: None
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_ingest_worker,
+                             initargs=(CONNECTION_PARAMETERS,)) as executor:
+        for file_name in SOURCE_FILES:
+            ingest_source_file(connection, executor, file_name, chunk_bytes)
+
+
+def create_tables(create_table_connection, partition_store_status=False):
+    """
+    Creates the datastore tables. Their secondary indexes are built by `create_indexes` once the data is loaded.
+
+    :param create_table_connection: A database connection object.
+    :param partition_store_status: Create "StoreStatus" partitioned by weekly "timestamp" ranges, so queries of a
+            report window only scan the partitions of that window. Only takes effect when the table is created.
+
+    :return: None
+    """
     _cursor = create_table_connection.cursor()
 
     def create_data_progress_db(cursor):
@@ -168,11 +575,39 @@ def create_tables(create_table_connection):
         except Exception:
             create_table_connection.rollback()
 
+    def create_ingest_checkpoint_db(cursor):
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS "_IngestCheckpoint" (
+            "file_name" TEXT NOT NULL,
+            "chunk_id" INT NOT NULL,
+            "chunk_bytes" BIGINT NOT NULL,
+            "start_offset" BIGINT NOT NULL,
+            "end_offset" BIGINT NOT NULL,
+            "row_count" INT NOT NULL,
+            "committed_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+            PRIMARY KEY ("file_name", "chunk_id")
+        );
+        """)
+        create_table_connection.commit()
+
+    def create_timezones_db(cursor):
+        # Every timezone name is stored once, stores refer to it by a small id
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS "Timezones" (
+            "id" SMALLSERIAL NOT NULL PRIMARY KEY,
+            "name" TEXT NOT NULL UNIQUE
+        );
+        """)
+        create_table_connection.commit()
+
     def create_store_timezones_db(cursor):
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS "StoreTimezones" (
             "store_id" BIGINT NOT NULL PRIMARY KEY,
-            "timezone" TEXT NOT NULL
+            "timezone_id" SMALLINT NOT NULL,
+
+            FOREIGN KEY ("timezone_id") REFERENCES "Timezones"("id") ON DELETE RESTRICT ON UPDATE CASCADE
         );
         """)
         create_table_connection.commit()
@@ -195,12 +630,27 @@ def create_tables(create_table_connection):
         create_table_connection.commit()
 
     def create_store_status_db(cursor):
+        if partition_store_status:
+            # The primary key of a partitioned table has to include the partition key
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS "StoreStatus" (
+                "id" BIGSERIAL NOT NULL,
+                "store_id" BIGINT NOT NULL,
+                "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                "active" BOOLEAN NOT NULL,
+
+                PRIMARY KEY ("id", "timestamp"),
+                FOREIGN KEY ("store_id") REFERENCES "StoreTimezones"("store_id") ON DELETE RESTRICT ON UPDATE CASCADE
+            ) PARTITION BY RANGE ("timestamp");
+            """)
+            create_table_connection.commit()
+            return
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS "StoreStatus" (
             "id" BIGSERIAL NOT NULL PRIMARY KEY,
             "store_id" BIGINT NOT NULL,
-            "status" TEXT NOT NULL,
             "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            "active" BOOLEAN NOT NULL,
         
             FOREIGN KEY ("store_id") REFERENCES "StoreTimezones"("store_id") ON DELETE RESTRICT ON UPDATE CASCADE
         );
@@ -208,32 +658,147 @@ def create_tables(create_table_connection):
         create_table_connection.commit()
 
     create_data_progress_db(_cursor)
+    create_ingest_checkpoint_db(_cursor)
+    create_timezones_db(_cursor)
+    migrate_store_columns(create_table_connection)
     create_store_timezones_db(_cursor)
     create_store_business_hours_db(_cursor)
     create_store_status_db(_cursor)
     _cursor.close()
     print('Datastore prepared!')
 
-def populate_tables(connection):
-    processed_timezones = process_timezones()
-    insert_timezones(connection, processed_timezones)
-    processed_business_hours = process_business_hours()
-    insert_business_hours(connection, processed_business_hours)
-    processed_store_status = process_store_status()
-    insert_store_status(connection, processed_store_status)
-
-
-print('Connecting to the database...')
-# Connect to the database
-_connection = psycopg2.connect(
-    host="localhost",
-    database="loop_datastore_db",
-    user="loop_datastore_admin",
-    password="top_secret"
-)
-print('Connected!')
-create_tables(_connection)
-populate_tables(_connection)
-print('Operation completed!!!')
-print('Closing DB connection.')
-_connection.close()
+
+def get_table_columns(connection, table_name):
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT "column_name" FROM information_schema.columns
+            WHERE "table_schema" = current_schema() AND "table_name" = %s
+        """, (table_name,))
+        columns = {column_name for column_name, in cursor.fetchall()}
+    connection.commit()
+    return columns
+
+
+def migrate_store_columns(connection):
+    """
+    Migrates a datastore created before the columns were normalized, in one transaction: the timezone names of
+    "StoreTimezones" move to "Timezones" and are referred to by id, and the "status" text of "StoreStatus" becomes
+    the boolean "active". Rewriting "StoreStatus" (and its indexes) takes a while on a large table and blocks it
+    meanwhile. Does nothing on a migrated or new datastore.
+
+    :param connection: A database connection object.
+
+    :return: None
+    """
+    migrate_timezones = 'timezone' in get_table_columns(connection, 'StoreTimezones')
+    migrate_status = 'status' in get_table_columns(connection, 'StoreStatus')
+    if not migrate_timezones and not migrate_status:
+        return
+    cursor = connection.cursor()
+    if migrate_timezones:
+        print('Migrating "StoreTimezones"."timezone" to "Timezones"...')
+        cursor.execute("""
+            INSERT INTO "Timezones" ("name")
+            SELECT DISTINCT "timezone" FROM "StoreTimezones" ORDER BY "timezone"
+            ON CONFLICT ("name") DO NOTHING;
+        """)
+        cursor.execute("""
+            ALTER TABLE "StoreTimezones" ADD COLUMN "timezone_id" SMALLINT
+                REFERENCES "Timezones"("id") ON DELETE RESTRICT ON UPDATE CASCADE;
+            UPDATE "StoreTimezones" SET "timezone_id" = "Timezones"."id"
+            FROM "Timezones" WHERE "Timezones"."name" = "StoreTimezones"."timezone";
+            ALTER TABLE "StoreTimezones" ALTER COLUMN "timezone_id" SET NOT NULL, DROP COLUMN "timezone";
+        """)
+    if migrate_status:
+        print('Migrating "StoreStatus"."status" to the boolean "active"...')
+        cursor.execute("""
+            ALTER TABLE "StoreStatus" ALTER COLUMN "status" TYPE BOOLEAN USING ("status" = 'active');
+            ALTER TABLE "StoreStatus" RENAME COLUMN "status" TO "active";
+        """)
+    connection.commit()
+    cursor.execute('ANALYZE "StoreTimezones", "StoreStatus"')
+    connection.commit()
+    cursor.close()
+    print('Migrated the datastore!')
+
+
+def create_indexes(connection):
+    """
+    Builds the indexes of the per-store report queries. Building them once after the bulk load is much cheaper
+    than maintaining them row by row during it. On a partitioned "StoreStatus" the index is created on every
+    partition, and partitions created later get it too.
+
+    :param connection: A database connection object.
+
+    :return: None
+    """
+    cursor = connection.cursor()
+    print('Building indexes...')
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS "StoreStatus_store_id_timestamp_idx" ON "StoreStatus" ("store_id", "timestamp");
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS "StoreBusinessHours_store_id_day_of_week_idx"
+        ON "StoreBusinessHours" ("store_id", "day_of_week");
+    """)
+    cursor.execute('ANALYZE "StoreTimezones", "StoreBusinessHours", "StoreStatus"')
+    connection.commit()
+    cursor.close()
+
+
+LOAD_MODES = {
+    'copy': (bulk_insert_timezones, bulk_insert_business_hours, bulk_insert_store_status),
+    'row': (insert_timezones, insert_business_hours, insert_store_status),
+}
+
+
+def populate_tables(connection, mode='chunked', workers=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Loads the three source files into the datastore, then builds the indexes of the report queries.
+
+    :param connection: A database connection object.
+    :param mode: 'chunked' loads each file in resumable, checkpointed chunks on a pool of workers;
+            'copy' streams every file with one COPY into a staging table and repairs orphan stores
+            set-based; 'row' is the original one INSERT and commit per row.
+    :param workers: The number of ingest worker processes in 'chunked' mode (defaults to the CPU count).
+    :param chunk_bytes: The approximate chunk size in bytes in 'chunked' mode.
+
+    :return: None
+    """
+    if mode == 'chunked':
+        ingest_source_files(connection, workers or os.cpu_count(), chunk_bytes)
+    else:
+        timezones_loader, business_hours_loader, store_status_loader = LOAD_MODES[mode]
+        processed_timezones = process_timezones()
+        timezones_loader(connection, processed_timezones)
+        processed_business_hours = process_business_hours()
+        business_hours_loader(connection, processed_business_hours)
+        processed_store_status = process_store_status()
+        store_status_loader(connection, processed_store_status)
+    create_indexes(connection)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loads the source csv files into the datastore.')
+    parser.add_argument('--mode', choices=['chunked', *LOAD_MODES], default='chunked',
+                        help='"chunked" loads resumable chunks in parallel, "copy" bulk loads each file in one '
+                             'transaction, "row" inserts one row at a time.')
+    parser.add_argument('--workers', type=int, default=None, help='Ingest worker processes in "chunked" mode.')
+    parser.add_argument('--chunk-bytes', type=int, default=DEFAULT_CHUNK_BYTES,
+                        help='Approximate chunk size in bytes in "chunked" mode.')
+    parser.add_argument('--partition-store-status', action='store_true',
+                        help='Create "StoreStatus" partitioned by week (only when the table does not exist yet).')
+    parser.add_argument('--migrate', action='store_true',
+                        help='Only create the missing tables and migrate an existing datastore, load nothing.')
+    arguments = parser.parse_args()
+
+    print('Connecting to the database...')
+    # Connect to the database
+    _connection = psycopg2.connect(**CONNECTION_PARAMETERS)
+    print('Connected!')
+    create_tables(_connection, arguments.partition_store_status)
+    if not arguments.migrate:
+        populate_tables(_connection, arguments.mode, arguments.workers, arguments.chunk_bytes)
+    print('Operation completed!!!')
+    print('Closing DB connection.')
+    _connection.close()
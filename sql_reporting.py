@@ -0,0 +1,156 @@
+import argparse
+from datetime import datetime
+from typing import Iterator
+
+import psycopg2
+from pytz import utc
+
+from db import get_connection_parameters
+from reporting import ALL_STORES, LAST_HOUR, REPORT_DATA_COLUMNS, REPORT_ENGINES, REPORT_WINDOWS, \
+    compare_report_engines
+from type_defs import ReportRow, StoreRange
+
+# Computes every report row in one statement, with the semantics of `reporting.estimate_uptime_downtime`:
+# - windows: the local hour `now` falls in is truncated and shifted back by the window length, and converted back
+#   to UTC with the UTC offset of `now` (like `reporting.get_report_window`)
+# - business intervals: the weekly hours of every local day a widest-window interval could start on, localized
+#   with `AT TIME ZONE` (which resolves DST gaps and overlaps to standard time, like pytz `localize`), clipped
+#   to each window
+# - hour slots: every status check of a clipped interval holds its status from the start of its hour slot (if it
+#   is the first check of the slot, see LAG) until the next check of the slot, the start of the next slot with a
+#   check (see LEAD) or the end of the interval
+REPORT_QUERY = """
+    WITH stores AS (
+        SELECT store_timezones."store_id", timezones."name" AS "timezone",
+            %(now)s::TIMESTAMPTZ AT TIME ZONE timezones."name" AS "now_local"
+        FROM "StoreTimezones" AS store_timezones
+        JOIN "Timezones" AS timezones ON timezones."id" = store_timezones."timezone_id"
+        WHERE store_timezones."store_id" BETWEEN %(first_store_id)s AND %(last_store_id)s
+    ), windows AS (
+        SELECT stores."store_id", stores."timezone", durations."hours",
+            date_trunc('hour', stores."now_local" - make_interval(hours => durations."hours")) AS "local_start",
+            date_trunc('hour', stores."now_local" - make_interval(hours => durations."hours"))
+                - (stores."now_local" - (%(now)s::TIMESTAMPTZ AT TIME ZONE 'UTC')) AS "window_start",
+            date_trunc('hour', stores."now_local" - make_interval(hours => durations."hours"))
+                - (stores."now_local" - (%(now)s::TIMESTAMPTZ AT TIME ZONE 'UTC'))
+                + make_interval(hours => durations."hours") AS "window_end"
+        FROM stores CROSS JOIN unnest(%(windows)s::INT[]) AS durations ("hours")
+    ), business_intervals AS (
+        SELECT windows."store_id", hours."id" AS "business_hours_id", days."day",
+            (days."day"::DATE + hours."start_time_local") AT TIME ZONE windows."timezone" AT TIME ZONE 'UTC'
+                AS "open_at",
+            (days."day"::DATE + hours."end_time_local") AT TIME ZONE windows."timezone" AT TIME ZONE 'UTC'
+                AS "close_at"
+        FROM windows
+        CROSS JOIN generate_series((windows."local_start" - INTERVAL '1 day')::DATE,
+                                   (windows."local_start" + make_interval(hours => windows."hours"))::DATE,
+                                   INTERVAL '1 day') AS days ("day")
+        JOIN "StoreBusinessHours" AS hours ON hours."store_id" = windows."store_id"
+            AND hours."day_of_week" = EXTRACT(ISODOW FROM days."day") - 1
+        WHERE windows."hours" = %(widest_window)s
+    ), clipped_intervals AS (
+        SELECT windows."store_id", windows."hours", business_intervals."business_hours_id", business_intervals."day",
+            GREATEST(business_intervals."open_at", windows."window_start") AS "open_at",
+            LEAST(business_intervals."close_at", windows."window_end") AS "close_at"
+        FROM windows JOIN business_intervals ON business_intervals."store_id" = windows."store_id"
+        WHERE GREATEST(business_intervals."open_at", windows."window_start")
+            < LEAST(business_intervals."close_at", windows."window_end")
+    ), interval_checks AS (
+        SELECT clipped_intervals.*, status."id" AS "status_id", status."timestamp", status."active",
+            floor(EXTRACT(EPOCH FROM status."timestamp" - clipped_intervals."open_at") / 3600)::INT AS "slot"
+        FROM clipped_intervals
+        JOIN "StoreStatus" AS status ON status."store_id" = clipped_intervals."store_id"
+            AND status."timestamp" >= clipped_intervals."open_at" AND status."timestamp" < clipped_intervals."close_at"
+    ), held AS (
+        SELECT "store_id", "hours", "active",
+            CASE
+                WHEN LEAD("timestamp") OVER checks IS NULL THEN "close_at"
+                WHEN LEAD("slot") OVER checks = "slot" THEN LEAD("timestamp") OVER checks
+                ELSE "open_at" + LEAD("slot") OVER checks * INTERVAL '1 hour'
+            END
+            - CASE
+                WHEN LAG("slot") OVER checks IS DISTINCT FROM "slot" THEN "open_at" + "slot" * INTERVAL '1 hour'
+                ELSE "timestamp"
+            END AS "held_for"
+        FROM interval_checks
+        WINDOW checks AS (PARTITION BY "store_id", "hours", "business_hours_id", "day" ORDER BY "timestamp", "status_id")
+    )
+    SELECT stores."store_id", {report_columns}
+    FROM stores LEFT JOIN held ON held."store_id" = stores."store_id"
+    GROUP BY stores."store_id"
+"""
+
+
+def get_report_query() -> str:
+    """
+    :return: The report query, selecting the "ReportData" columns after "report_id" in order: the uptime of every
+            window, then the downtime of every window; the last hour in minutes, the other windows in hours.
+    """
+    report_columns = []
+    for held_active in ('held."active"', 'NOT held."active"'):
+        for duration_in_hours in REPORT_WINDOWS:
+            unit_seconds = 60 if duration_in_hours == LAST_HOUR else 3600
+            report_columns.append(
+                f'floor(EXTRACT(EPOCH FROM COALESCE(SUM(held."held_for") FILTER (WHERE {held_active} '
+                f'AND held."hours" = {duration_in_hours}), INTERVAL \'0\')) / {unit_seconds})::INT')
+    return REPORT_QUERY.format(report_columns=', '.join(report_columns))
+
+
+def get_report_parameters(now: datetime, store_range: StoreRange) -> dict:
+    return dict(now=now, first_store_id=store_range[0], last_store_id=store_range[1], windows=list(REPORT_WINDOWS),
+                widest_window=max(REPORT_WINDOWS))
+
+
+def compute_report_rows_sql(connection, now: datetime, store_range: StoreRange = ALL_STORES) -> Iterator[ReportRow]:
+    """
+    Computes the report of every store inside Postgres with one statement and fetches the rows, e.g. to compare
+    them with another engine. Reports are written with `insert_report_rows_sql` instead, which never fetches them.
+
+    :param connection: A database connection object.
+    :param now: A timezone aware datetime used as the current time of the report.
+    :param store_range: The inclusive range of store ids to report on.
+
+    :return: An iterator of report rows.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(get_report_query(), get_report_parameters(now, store_range))
+        yield from cursor
+
+
+def insert_report_rows_sql(cursor, report_id: str, now: datetime, store_range: StoreRange = ALL_STORES) -> int:
+    """
+    Computes the report of every store inside Postgres and inserts the rows into "ReportData" with one
+    `INSERT ... SELECT`, so no report row crosses the wire. Nothing is committed.
+
+    :param cursor: A cursor of the connection to write with.
+    :param report_id: A UUID string representing the ID of the report the rows belong to.
+    :param now: A timezone aware datetime used as the current time of the report.
+    :param store_range: The inclusive range of store ids to report on.
+
+    :return: The number of inserted rows.
+    """
+    column_list = ', '.join(f'"{column}"' for column in REPORT_DATA_COLUMNS)
+    cursor.execute(f"""
+        INSERT INTO "ReportData" ({column_list})
+        SELECT %(report_id)s, report.* FROM ({get_report_query()}) AS report
+    """, dict(get_report_parameters(now, store_range), report_id=report_id))
+    return cursor.rowcount
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the report rows of the SQL engine with another engine.')
+    parser.add_argument('--engine', choices=[engine for engine in REPORT_ENGINES if engine != 'sql'],
+                        default='python')
+    parser.add_argument('--now', type=datetime.fromisoformat, default=None,
+                        help='The current time of the report as an ISO 8601 datetime, defaults to now (UTC).')
+    arguments = parser.parse_args()
+
+    _connection = psycopg2.connect(**get_connection_parameters())
+    _now = arguments.now or datetime.now(utc)
+    _now = _now if _now.tzinfo else utc.localize(_now)
+    _mismatches = compare_report_engines(_connection, _now, ('sql', arguments.engine))
+    _connection.close()
+    for _mismatch in _mismatches[:20]:
+        print(_mismatch)
+    print(f'{len(_mismatches)} stores differ between the "sql" and "{arguments.engine}" engines.')
+    raise SystemExit(1 if _mismatches else 0)
@@ -0,0 +1,395 @@
+import argparse
+import json
+import mmap
+import os
+from datetime import datetime, time, timedelta
+from threading import Lock
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import psycopg2
+from pytz import utc
+
+from db import get_connection_parameters
+from report_cache import get_data_watermark
+from type_defs import StoreBusinessHoursList, StoreRange
+from vectorized_reporting import fetch_frame, to_epoch_microseconds
+
+DEFAULT_STATUS_INDEX_PATH = os.environ.get('STATUS_INDEX_PATH', '')
+SNAPSHOT_MAGIC = b'STATIDX1'
+SNAPSHOT_VERSION = 1
+# Arrays start at a multiple of this many bytes, so every mapped array is aligned for its dtype
+SNAPSHOT_ALIGNMENT = 64
+# The arrays of a status index and their dtypes, in snapshot order
+STATUS_INDEX_ARRAYS = {
+    'store_ids': np.int64,
+    'timezone_ids': np.uint16,
+    'check_offsets': np.int64,
+    'check_times': np.int64,
+    'check_statuses': np.uint8,
+    'hours_offsets': np.int64,
+    'hours_days': np.uint8,
+    'hours_opens': np.int32,
+    'hours_closes': np.int32,
+}
+
+_status_index = None
+_status_index_key = None
+_status_index_lock = Lock()
+
+
+def align(offset: int) -> int:
+    return -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+
+class StatusIndex:
+    """
+    The status checks, timezones and business hours of every store in compressed sparse row (CSR) form, instead
+    of a `(datetime, str)` tuple per status check: the checks of the store at position `i` of the sorted
+    `store_ids` are `check_times[check_offsets[i]:check_offsets[i + 1]]` (UTC epoch microseconds, sorted) with
+    `check_statuses` (1 for active, 0 for inactive) alongside, 9 bytes per check. Business hours are stored the
+    same way with `hours_offsets`, and the timezone of a store is its entry of `timezones` at `timezone_ids[i]`.
+
+    An index is built from Postgres with `build_status_index` and saved as a snapshot file, which `load` maps into
+    memory without copying it, so every report worker on a host shares the same pages.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray], timezones: List[str], watermark: str, built_at: str,
+                 since_us: int | None = None):
+        """
+        :param arrays: The arrays of `STATUS_INDEX_ARRAYS` by name.
+        :param timezones: The timezone names `timezone_ids` refer to.
+        :param watermark: The version of the data the index was built from, see `report_cache.get_data_watermark`.
+        :param built_at: The ISO time the index was built at.
+        :param since_us: The epoch microseconds the oldest status checks were taken from, or None for all checks.
+        """
+        self.arrays = arrays
+        self.timezones = timezones
+        self.watermark = watermark
+        self.built_at = built_at
+        self.since_us = since_us
+        self.store_ids = arrays['store_ids']
+        self.timezone_ids = arrays['timezone_ids']
+        self.check_offsets = arrays['check_offsets']
+        self.check_times = arrays['check_times']
+        self.check_statuses = arrays['check_statuses']
+        self.hours_offsets = arrays['hours_offsets']
+        self.hours_days = arrays['hours_days']
+        self.hours_opens = arrays['hours_opens']
+        self.hours_closes = arrays['hours_closes']
+        # The mapped snapshot file the arrays are views of, if loaded from one
+        self._buffer = None
+
+    @property
+    def store_count(self) -> int:
+        return len(self.store_ids)
+
+    @property
+    def check_count(self) -> int:
+        return len(self.check_times)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def covers(self, start: datetime) -> bool:
+        """
+        :return: Whether the index holds every status check from `start` on.
+        """
+        return self.since_us is None or self.since_us <= to_epoch_microseconds(start)
+
+    def get_store_position(self, store_id: int) -> int | None:
+        """
+        :return: The position of a store in the arrays, or None if the index has no such store.
+        """
+        position = int(np.searchsorted(self.store_ids, store_id))
+        if position < self.store_count and self.store_ids[position] == store_id:
+            return position
+        return None
+
+    def get_store_positions(self, store_range: StoreRange) -> Tuple[int, int]:
+        """
+        :return: The first and the end position of the stores in an inclusive range of store ids.
+        """
+        return (int(np.searchsorted(self.store_ids, store_range[0], side='left')),
+                int(np.searchsorted(self.store_ids, store_range[1], side='right')))
+
+    def get_timezone(self, position: int) -> str:
+        return self.timezones[self.timezone_ids[position]]
+
+    def get_status_checks(self, position: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: Views of the check times and statuses of the store at `position`, sorted by time.
+        """
+        first_check, end_check = self.check_offsets[position], self.check_offsets[position + 1]
+        return self.check_times[first_check:end_check], self.check_statuses[first_check:end_check]
+
+    def get_business_hours(self, position: int) -> StoreBusinessHoursList:
+        """
+        :return: The (day_of_week, start_time_local, end_time_local) business hours of the store at `position`.
+        """
+        first_hours, end_hours = self.hours_offsets[position], self.hours_offsets[position + 1]
+        return [(int(day), seconds_to_time(opens), seconds_to_time(closes))
+                for day, opens, closes in zip(self.hours_days[first_hours:end_hours],
+                                              self.hours_opens[first_hours:end_hours],
+                                              self.hours_closes[first_hours:end_hours])]
+
+    def get_stores_frame(self, store_range: StoreRange) -> pd.DataFrame:
+        """
+        :return: The stores of a range as a DataFrame of (store_id, timezone), like the "StoreTimezones" rows.
+        """
+        first_store, end_store = self.get_store_positions(store_range)
+        timezones = np.array(self.timezones, dtype=object)
+        return pd.DataFrame({'store_id': self.store_ids[first_store:end_store],
+                             'timezone': timezones[self.timezone_ids[first_store:end_store]]})
+
+    def get_business_hours_frame(self, store_range: StoreRange) -> pd.DataFrame:
+        """
+        :return: The business hours of a range of stores as a DataFrame of (store_id, day_of_week,
+                start_time_local, end_time_local), like the "StoreBusinessHours" rows.
+        """
+        first_store, end_store = self.get_store_positions(store_range)
+        first_hours, end_hours = self.hours_offsets[first_store], self.hours_offsets[end_store]
+        return pd.DataFrame({
+            'store_id': np.repeat(self.store_ids[first_store:end_store],
+                                  np.diff(self.hours_offsets[first_store:end_store + 1])),
+            'day_of_week': self.hours_days[first_hours:end_hours].astype(np.int64),
+            'start_time_local': seconds_to_times(self.hours_opens[first_hours:end_hours]),
+            'end_time_local': seconds_to_times(self.hours_closes[first_hours:end_hours]),
+        })
+
+    def get_status_checks_frame(self, store_range: StoreRange, start: datetime, end: datetime) -> pd.DataFrame:
+        """
+        :return: The status checks of a range of stores taken in [start, end) as a DataFrame of (store_id,
+                timestamp_us, active), like the rows the vectorized engine fetches from "StoreStatus".
+        """
+        first_store, end_store = self.get_store_positions(store_range)
+        first_check, end_check = self.check_offsets[first_store], self.check_offsets[end_store]
+        check_times = self.check_times[first_check:end_check]
+        in_window = (check_times >= to_epoch_microseconds(start)) & (check_times < to_epoch_microseconds(end))
+        store_ids = np.repeat(self.store_ids[first_store:end_store],
+                              np.diff(self.check_offsets[first_store:end_store + 1]))
+        return pd.DataFrame({'store_id': store_ids[in_window], 'timestamp_us': check_times[in_window],
+                             'active': self.check_statuses[first_check:end_check][in_window].astype(np.int64)})
+
+    def save(self, path: str) -> int:
+        """
+        Writes the index to a snapshot file: a magic number, the length of a JSON header describing the arrays and
+        the header, followed by the raw arrays, each aligned to `SNAPSHOT_ALIGNMENT` bytes. The file is written
+        next to `path` and renamed over it, so workers mapping the previous snapshot keep reading a complete file.
+
+        :param path: The path of the snapshot file.
+
+        :return: The size of the snapshot file in bytes.
+        """
+        layout, offset = {}, 0
+        for name, dtype in STATUS_INDEX_ARRAYS.items():
+            offset = align(offset)
+            layout[name] = {'dtype': np.dtype(dtype).str, 'length': len(self.arrays[name]), 'offset': offset}
+            offset += self.arrays[name].nbytes
+        header = json.dumps({
+            'version': SNAPSHOT_VERSION, 'watermark': self.watermark, 'built_at': self.built_at,
+            'since_us': self.since_us, 'timezones': self.timezones, 'arrays': layout,
+        }).encode()
+        data_start = align(len(SNAPSHOT_MAGIC) + 8 + len(header))
+
+        temporary_path = f'{path}.tmp-{os.getpid()}'
+        with open(temporary_path, 'wb') as snapshot_file:
+            snapshot_file.write(SNAPSHOT_MAGIC + len(header).to_bytes(8, 'little') + header)
+            for name in STATUS_INDEX_ARRAYS:
+                snapshot_file.seek(data_start + layout[name]['offset'])
+                snapshot_file.write(np.ascontiguousarray(self.arrays[name]).tobytes())
+            snapshot_file.truncate(data_start + offset)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, path)
+        return data_start + offset
+
+    @classmethod
+    def load(cls, path: str) -> 'StatusIndex':
+        """
+        Maps a snapshot file written by `save` into memory. The arrays are read-only views of the mapped file, so
+        nothing is copied or parsed, and pages are only read from disk when they are used.
+
+        :param path: The path of the snapshot file.
+
+        :return: The status index of the snapshot.
+        :raises ValueError: If the file is not a status index snapshot of this version.
+        """
+        with open(path, 'rb') as snapshot_file:
+            buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_start = len(SNAPSHOT_MAGIC) + 8
+        if buffer[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f'"{path}" is not a status index snapshot')
+        header_length = int.from_bytes(buffer[len(SNAPSHOT_MAGIC):header_start], 'little')
+        header = json.loads(buffer[header_start:header_start + header_length])
+        if header['version'] != SNAPSHOT_VERSION:
+            raise ValueError(f'"{path}" is a version {header["version"]} snapshot, expected {SNAPSHOT_VERSION}')
+        data_start = align(header_start + header_length)
+        arrays = {name: np.frombuffer(buffer, dtype=np.dtype(spec['dtype']), count=spec['length'],
+                                      offset=data_start + spec['offset'])
+                  for name, spec in header['arrays'].items()}
+        status_index = cls(arrays, header['timezones'], header['watermark'], header['built_at'], header['since_us'])
+        status_index._buffer = buffer
+        return status_index
+
+
+def seconds_to_time(seconds) -> time:
+    seconds = int(seconds)
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def seconds_to_times(seconds: np.ndarray) -> List[time]:
+    """
+    :return: The times of day of an array of seconds since midnight, converting every distinct value once.
+    """
+    distinct_seconds, inverse = np.unique(seconds, return_inverse=True)
+    times = [seconds_to_time(value) for value in distinct_seconds]
+    return [times[position] for position in inverse]
+
+
+def group_store_rows(rows: pd.DataFrame, store_ids: np.ndarray, sort_column: str) -> Tuple[np.ndarray, pd.DataFrame]:
+    """
+    Orders rows by store and `sort_column` into CSR form. Rows of stores without a timezone are left out, as the
+    report engines leave them out.
+
+    :param rows: A DataFrame with a store_id column.
+    :param store_ids: The sorted ids of the indexed stores.
+    :param sort_column: The column ordering the rows of a store.
+
+    :return: The offsets of the rows of every store and the ordered rows.
+    """
+    row_store_ids = rows['store_id'].to_numpy(dtype=np.int64)
+    positions = np.searchsorted(store_ids, row_store_ids)
+    known = positions < len(store_ids)
+    known[known] = store_ids[positions[known]] == row_store_ids[known]
+    positions = positions[known]
+    order = np.lexsort((rows[sort_column].to_numpy()[known], positions))
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(positions, minlength=len(store_ids))))).astype(np.int64)
+    return offsets, rows[known].iloc[order]
+
+
+def build_status_index(connection, since: datetime | None = None) -> StatusIndex:
+    """
+    Builds a status index from "StoreTimezones", "StoreBusinessHours" and "StoreStatus". The tables are read in
+    one repeatable read transaction, so the data matches the watermark recorded with it.
+
+    :param connection: A database connection object.
+    :param since: A timezone aware datetime; only the status checks taken from then on are indexed. All status
+            checks are indexed if None.
+
+    :return: The status index.
+    """
+    connection.rollback()
+    with connection.cursor() as cursor:
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;')
+        watermark = get_data_watermark(cursor)
+    try:
+        stores = fetch_frame(connection, """
+            SELECT "StoreTimezones"."store_id", "Timezones"."name" FROM "StoreTimezones"
+            JOIN "Timezones" ON "Timezones"."id" = "StoreTimezones"."timezone_id"
+        """, (), ['store_id', 'timezone'])
+        business_hours = fetch_frame(connection, """
+            SELECT "store_id", "day_of_week", EXTRACT(EPOCH FROM "start_time_local")::INT,
+                EXTRACT(EPOCH FROM "end_time_local")::INT
+            FROM "StoreBusinessHours"
+        """, (), ['store_id', 'day_of_week', 'opens', 'closes'])
+        status_checks = fetch_frame(connection, f"""
+            SELECT "store_id", (EXTRACT(EPOCH FROM "timestamp") * 1000000)::BIGINT, "active"::INT
+            FROM "StoreStatus"
+            {'WHERE "timestamp" >= %s' if since is not None else ''}
+        """, (since.astimezone(utc).replace(tzinfo=None),) if since is not None else (),
+                                    ['store_id', 'timestamp_us', 'active'])
+    finally:
+        connection.rollback()
+
+    stores = stores.sort_values('store_id')
+    store_ids = stores['store_id'].to_numpy(dtype=np.int64)
+    timezones, timezone_ids = np.unique(stores['timezone'].to_numpy(dtype=str), return_inverse=True)
+    arrays = {'store_ids': store_ids, 'timezone_ids': timezone_ids.astype(np.uint16)}
+
+    check_offsets, status_checks = group_store_rows(status_checks, store_ids, 'timestamp_us')
+    hours_offsets, business_hours = group_store_rows(business_hours, store_ids, 'day_of_week')
+    arrays.update({
+        'check_offsets': check_offsets,
+        'check_times': status_checks['timestamp_us'].to_numpy(dtype=np.int64),
+        'check_statuses': status_checks['active'].to_numpy(dtype=np.uint8),
+        'hours_offsets': hours_offsets,
+        'hours_days': business_hours['day_of_week'].to_numpy(dtype=np.uint8),
+        'hours_opens': business_hours['opens'].to_numpy(dtype=np.int32),
+        'hours_closes': business_hours['closes'].to_numpy(dtype=np.int32),
+    })
+    return StatusIndex(arrays, timezones.tolist(), watermark, datetime.now(utc).isoformat(),
+                       None if since is None else to_epoch_microseconds(since))
+
+
+def get_index_start(connection, days: int | None) -> datetime | None:
+    """
+    :return: The time `days` days before the latest status check, or None (index every check) if `days` is None
+            or there are no status checks.
+    """
+    if days is None:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT MAX("timestamp") FROM "StoreStatus";
+        """)
+        latest = cursor.fetchone()[0]
+    connection.rollback()
+    return latest and utc.localize(latest) - timedelta(days=days)
+
+
+def get_status_index(path: str = DEFAULT_STATUS_INDEX_PATH) -> StatusIndex | None:
+    """
+    Maps the status index snapshot at `path` once per process, and again once the file was replaced by a newer
+    snapshot.
+
+    :param path: The path of the snapshot file, `STATUS_INDEX_PATH` by default.
+
+    :return: The status index, or None if no snapshot is configured or it does not exist.
+    """
+    global _status_index, _status_index_key
+    if not path:
+        return None
+    try:
+        snapshot_stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    snapshot_key = (path, snapshot_stat.st_ino, snapshot_stat.st_mtime_ns)
+    with _status_index_lock:
+        if _status_index_key != snapshot_key:
+            _status_index = StatusIndex.load(path)
+            _status_index_key = snapshot_key
+        return _status_index
+
+
+def get_current_status_index(connection, path: str = DEFAULT_STATUS_INDEX_PATH) -> StatusIndex | None:
+    """
+    :return: The status index snapshot if it was built from the current data, otherwise None.
+    """
+    status_index = get_status_index(path)
+    if status_index is None:
+        return None
+    with connection.cursor() as cursor:
+        watermark = get_data_watermark(cursor)
+    return status_index if watermark == status_index.watermark else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds a status index snapshot for the report workers.')
+    parser.add_argument('--path', default=DEFAULT_STATUS_INDEX_PATH or 'status_index.snapshot',
+                        help='The snapshot file, STATUS_INDEX_PATH by default.')
+    parser.add_argument('--days', type=int, default=None,
+                        help='Only index the status checks of this many days before the latest one.')
+    arguments = parser.parse_args()
+
+    _connection = psycopg2.connect(**get_connection_parameters())
+    print('Building the status index...')
+    _started_at = perf_counter()
+    _built_index = build_status_index(_connection, get_index_start(_connection, arguments.days))
+    _connection.close()
+    _size = _built_index.save(arguments.path)
+    print(f'Indexed {_built_index.check_count} status checks of {_built_index.store_count} stores in '
+          f'{perf_counter() - _started_at:.1f}s, {_size / 1024 / 1024:.1f} MiB written to {arguments.path}')
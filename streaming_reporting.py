@@ -0,0 +1,105 @@
+import os
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+from typing import Iterator, Tuple
+
+from pytz import timezone, utc
+from tqdm import tqdm
+
+from business_calendar import expand_weekly_hours
+from report_progress import report_stage
+from reporting import ALL_STORES, LAST_DAY, LAST_WEEK, REPORT_WINDOWS, calculate_uptime_and_downtime_windows, \
+    get_report_window, to_report_row
+from type_defs import ReportRow, StoreBusinessHoursListRaw, StoreRange, StoreStatusListRaw
+
+# Rows fetched from the server per round trip
+DEFAULT_STREAM_FETCH_SIZE = int(os.environ.get('REPORT_STREAM_FETCH_SIZE', 10_000))
+# The widest window starts less than an hour before `now` minus its length (see `reporting.get_report_window`), so
+# older status checks are never estimated
+STATUS_CHECKS_HORIZON = timedelta(hours=LAST_WEEK + LAST_DAY)
+
+# One row per business hours row of a store (without a timestamp, so they sort first), then one row per status check
+# of the report week in timestamp order. A store without either still gets one row of NULLs, and so a report row.
+# The stores are scanned in "store_id" order, so the rows are only sorted within each store.
+STORE_ROWS_QUERY = """
+    SELECT stores."store_id", timezones."name", store_rows."timestamp", store_rows."active",
+        store_rows."day_of_week", store_rows."start_time_local", store_rows."end_time_local"
+    FROM "StoreTimezones" AS stores
+    JOIN "Timezones" AS timezones ON timezones."id" = stores."timezone_id"
+    LEFT JOIN LATERAL (
+        SELECT NULL::TIMESTAMP AS "timestamp", NULL::BOOLEAN AS "active", hours."day_of_week",
+            hours."start_time_local", hours."end_time_local"
+        FROM "StoreBusinessHours" AS hours
+        WHERE hours."store_id" = stores."store_id"
+        UNION ALL
+        SELECT status."timestamp", status."active", NULL, NULL, NULL
+        FROM "StoreStatus" AS status
+        WHERE status."store_id" = stores."store_id" AND status."timestamp" >= %(since)s
+            AND status."timestamp" < %(until)s
+    ) AS store_rows ON TRUE
+    WHERE stores."store_id" BETWEEN %(first_store_id)s AND %(last_store_id)s
+    ORDER BY stores."store_id", store_rows."timestamp" NULLS FIRST
+"""
+
+
+def stream_store_data(connection, now: datetime, store_range: StoreRange = ALL_STORES,
+                      fetch_size: int = DEFAULT_STREAM_FETCH_SIZE) \
+        -> Iterator[Tuple[int, str, StoreStatusListRaw, StoreBusinessHoursListRaw]]:
+    """
+    Same as `reporting.fetch_store_data`, but streams the stores through one named (server-side) cursor instead of
+    two queries per store, and only reads the status checks a report of `now` can estimate. The rows are grouped
+    by store as they arrive, so only `fetch_size` rows and the rows of one store are held in memory at a time.
+
+    The cursor lives in the caller's transaction, which must stay open until the stores are exhausted.
+
+    :param connection: A database connection object.
+    :param now: A timezone aware datetime used as the current time of the report.
+    :param store_range: The inclusive range of store ids to query.
+    :param fetch_size: The number of rows fetched from the server per round trip.
+
+    :return: An iterator of (store_id, timezone name, status checks ordered by timestamp, business hours) tuples.
+    """
+    until = now.astimezone(utc).replace(tzinfo=None)
+    with connection.cursor(name='report_store_rows') as cursor:
+        cursor.itersize = fetch_size
+        with report_stage('fetch'):
+            cursor.execute(STORE_ROWS_QUERY, dict(since=until - STATUS_CHECKS_HORIZON, until=until,
+                                                  first_store_id=store_range[0], last_store_id=store_range[1]))
+        for (store_id, store_timezone), store_rows in tqdm(groupby(cursor, key=itemgetter(0, 1)), smoothing=0.9):
+            with report_stage('fetch'):
+                store_rows = list(store_rows)
+            status_checks: StoreStatusListRaw = [(timestamp, active) for _, _, timestamp, active, *_ in store_rows
+                                                 if timestamp is not None]
+            business_days: StoreBusinessHoursListRaw = [store_row[4:] for store_row in store_rows
+                                                        if store_row[4] is not None]
+            yield store_id, store_timezone, status_checks, business_days
+
+
+def compute_report_rows_stream(connection, now: datetime, store_range: StoreRange = ALL_STORES,
+                               fetch_size: int = DEFAULT_STREAM_FETCH_SIZE) -> Iterator[ReportRow]:
+    """
+    Estimates every report window of one store at a time like `reporting.compute_report_rows_sweep`, over the
+    stores of `stream_store_data`. The business hours are expanded per store with `expand_weekly_hours` instead of
+    being kept in the business calendar cache, so the peak memory is bounded by the largest store rather than by the
+    number of stores; only the localized times are cached, per timezone, day and time.
+
+    :param connection: A database connection object.
+    :param now: A timezone aware datetime used as the current time of the report.
+    :param store_range: The inclusive range of store ids to report on.
+    :param fetch_size: The number of rows fetched from the server per round trip.
+
+    :return: An iterator of report rows.
+    """
+    for store_id, store_timezone, status_checks, business_days in stream_store_data(connection, now, store_range,
+                                                                                    fetch_size):
+        with report_stage('localize'):
+            timezone_object = timezone(store_timezone)
+            widest_start, widest_end = get_report_window(max(REPORT_WINDOWS), timezone_object, now)
+            business_intervals = expand_weekly_hours(business_days, store_timezone,
+                                                     (widest_start - timedelta(days=1)).date(), widest_end.date())
+        with report_stage('estimate'):
+            report_row = to_report_row(store_id, calculate_uptime_and_downtime_windows(business_days, status_checks,
+                                                                                       timezone_object, now,
+                                                                                       business_intervals))
+        yield report_row
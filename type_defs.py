@@ -1,4 +1,4 @@
-from typing import List, Tuple, Literal
+from typing import List, Tuple
 from datetime import datetime, time
 
 StoreTimezone = Tuple[int, datetime]
@@ -6,13 +6,27 @@ StoreTimezoneRaw = Tuple[int, str]
 StoreTimezoneList = List[StoreTimezone]
 StoreTimezoneListRaw = List[StoreTimezoneRaw]
 
-Status = Literal['active', 'inactive']
-StoreStatus = Tuple[datetime, str]
+# Whether the store was active ("StoreStatus"."active")
+Status = bool
+StoreStatus = Tuple[datetime, Status]
 StoreStatusList = List[StoreStatus]
-StoreStatusRaw = Tuple[str, str]
+# A naive UTC timestamp, as stored in "StoreStatus"
+StoreStatusRaw = Tuple[datetime, Status]
 StoreStatusListRaw = List[StoreStatusRaw]
 
 StoreBusinessHours = Tuple[int, time, time]
 StoreBusinessHoursList = List[StoreBusinessHours]
 StoreBusinessHoursRaw = Tuple[int, str, str]
 StoreBusinessHoursListRaw = List[StoreBusinessHoursRaw]
+
+BusinessInterval = Tuple[datetime, datetime]
+BusinessIntervalList = List[BusinessInterval]
+
+# store_id, uptime_last_hour, uptime_last_day, uptime_last_week, down_time_last_hour, down_time_last_day, down_time_last_week
+ReportRow = Tuple[int, int, int, int, int, int, int]
+
+# Inclusive first and last store_id
+StoreRange = Tuple[int, int]
+
+# column, operator, value of a threshold filter on a report column
+ReportFilter = Tuple[str, str, int]
@@ -0,0 +1,208 @@
+import os
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter
+from typing import Tuple
+
+import numpy as np
+from pytz import timezone
+
+from db import pooled_connection
+from metrics import UPTIME_INDEX_AGE_SECONDS
+from report_cache import get_data_watermark
+from reporting import expand_business_hours
+from status_index import StatusIndex, build_status_index, get_current_status_index, get_index_start
+from vectorized_reporting import MICROSECONDS_PER_HOUR, to_epoch_microseconds
+
+DEFAULT_REFRESH_SECONDS = int(os.environ.get('UPTIME_INDEX_REFRESH_SECONDS', 60))
+# Days of status checks before the latest one that are indexed, 0 for all of them
+DEFAULT_INDEX_DAYS = int(os.environ.get('UPTIME_INDEX_DAYS', 30))
+
+
+class UptimeIndex:
+    """
+    Answers the business hours uptime and downtime of a store for any window from the sorted status checks of a
+    `StatusIndex`, with the estimate of `reporting.calculate_uptime_and_downtime`, without walking the checks.
+
+    Within a business interval, every status check holds its status until the next one. The time held by active
+    checks up to each check is summed once into `active_prefix`, so the held time of the checks of an interval is
+    the difference of two prefix sums. The hour slot rule of `reporting.estimate_uptime_downtime` only differs
+    from this where a check is the first of its hour slot: the time from the start of that slot to the check is
+    held by the check instead of the one before. That only changes the uptime if the two checks have different
+    statuses, so it is corrected at the status changes within the interval, which `transitions` lists.
+    """
+
+    def __init__(self, status_index: StatusIndex):
+        self.status_index = status_index
+        # When the index was last found to match the data, see `UptimeIndexRefresher`
+        self.checked_at = monotonic()
+        check_times = status_index.check_times
+        check_statuses = status_index.check_statuses.astype(np.int64)
+        # Consecutive checks of different stores are never differenced, so their gaps do not matter
+        self.active_prefix = np.concatenate(([0], np.cumsum(check_statuses[:-1] * np.diff(check_times))))
+        self.transitions = np.flatnonzero(check_statuses[:-1] != check_statuses[1:])
+
+    @property
+    def watermark(self) -> str:
+        return self.status_index.watermark
+
+    def covers(self, start: datetime) -> bool:
+        return self.status_index.covers(start)
+
+    def get_uptime_and_downtime(self, store_id: int, start: datetime, end: datetime) \
+            -> Tuple[timedelta, timedelta] | None:
+        """
+        Calculates the uptime and downtime of a store within its business hours in a window.
+
+        :param store_id: The ID of the store.
+        :param start: A timezone aware datetime, the start of the window (inclusive).
+        :param end: A timezone aware datetime, the end of the window (exclusive).
+
+        :return: A tuple containing the uptime and downtime, or None if the index has no such store.
+        """
+        position = self.status_index.get_store_position(store_id)
+        if position is None:
+            return None
+        store_timezone = timezone(self.status_index.get_timezone(position))
+        business_intervals = expand_business_hours(self.status_index.get_business_hours(position), store_timezone,
+                                                   start.astimezone(store_timezone), end.astimezone(store_timezone))
+        if not business_intervals:
+            return timedelta(), timedelta()
+        opens = np.array([to_epoch_microseconds(open_datetime) for open_datetime, _ in business_intervals])
+        closes = np.array([to_epoch_microseconds(close_datetime) for _, close_datetime in business_intervals])
+
+        # The checks of every interval, as positions of the whole index
+        first_store_check = self.status_index.check_offsets[position]
+        store_check_times = self.status_index.get_status_checks(position)[0]
+        first_check = first_store_check + np.searchsorted(store_check_times, opens)
+        end_check = first_store_check + np.searchsorted(store_check_times, closes)
+        # The time before the first check of an interval is neither uptime nor downtime
+        has_checks = end_check > first_check
+        opens, closes = opens[has_checks], closes[has_checks]
+        first_check, last_check = first_check[has_checks], end_check[has_checks] - 1
+        if not len(opens):
+            return timedelta(), timedelta()
+
+        check_times = self.status_index.check_times
+        check_statuses = self.status_index.check_statuses.astype(np.int64)
+        first_slot_start = (opens + (check_times[first_check] - opens) // MICROSECONDS_PER_HOUR
+                            * MICROSECONDS_PER_HOUR)
+        held = closes - first_slot_start
+        active = (check_statuses[first_check] * (check_times[first_check] - first_slot_start)
+                  + self.active_prefix[last_check] - self.active_prefix[first_check]
+                  + check_statuses[last_check] * (closes - check_times[last_check]))
+
+        # Status changes from a check to the next one within the same interval
+        first_transition = np.searchsorted(self.transitions, first_check)
+        end_transition = np.searchsorted(self.transitions, last_check)
+        transition_counts = end_transition - first_transition
+        interval_index = np.repeat(np.arange(len(opens)), transition_counts)
+        offset = np.arange(len(interval_index)) - np.repeat(np.cumsum(transition_counts) - transition_counts,
+                                                            transition_counts)
+        change = self.transitions[first_transition[interval_index] + offset]
+        change_open = opens[interval_index]
+        # If the next check starts a new hour slot, it holds its status from the start of that slot
+        starts_slot = ((check_times[change] - change_open) // MICROSECONDS_PER_HOUR
+                       != (check_times[change + 1] - change_open) // MICROSECONDS_PER_HOUR)
+        moved = np.where(starts_slot, (check_times[change + 1] - change_open) % MICROSECONDS_PER_HOUR, 0)
+        np.add.at(active, interval_index, np.where(check_statuses[change + 1] == 1, moved, -moved))
+
+        uptime, total = int(active.sum()), int(held.sum())
+        return timedelta(microseconds=uptime), timedelta(microseconds=total - uptime)
+
+
+class UptimeIndexRefresher:
+    """
+    Keeps an `UptimeIndex` of the status checks of the last `days` days fresh: a background thread rebuilds it
+    every `refresh_seconds` once the data changed, from the status index snapshot if it is current (see
+    `status_index.py`) or from Postgres. Queries keep using the previous index until the new one replaces it.
+    """
+
+    def __init__(self, refresh_seconds: float = DEFAULT_REFRESH_SECONDS, days: int = DEFAULT_INDEX_DAYS):
+        self.refresh_seconds = refresh_seconds
+        self.days = days or None
+        self.index: UptimeIndex | None = None
+        self._ready = Event()
+        self._stopped = Event()
+        self._refresher = Thread(target=self._refresh_periodically, name='uptime-index-refresher', daemon=True)
+        self._refresher.start()
+
+    def get_index(self, timeout: float | None = None) -> UptimeIndex | None:
+        """
+        :return: The current index, waiting up to `timeout` seconds for the first one, or None if it is not built
+                yet.
+        """
+        self._ready.wait(timeout)
+        return self.index
+
+    def refresh(self) -> bool:
+        """
+        Rebuilds the index if the data changed since it was built.
+
+        :return: Whether the index was rebuilt.
+        """
+        started_at = perf_counter()
+        with pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                watermark = get_data_watermark(cursor)
+            connection.rollback()
+            if self.index is not None and self.index.watermark == watermark:
+                self.index.checked_at = monotonic()
+                return False
+            since = get_index_start(connection, self.days)
+            status_index = get_current_status_index(connection)
+            if status_index is None or (since is not None and not status_index.covers(since)):
+                status_index = build_status_index(connection, since)
+            connection.rollback()
+        self.index = UptimeIndex(status_index)
+        print(f'Uptime index: Indexed {status_index.check_count} status checks of {status_index.store_count} '
+              f'stores in {perf_counter() - started_at:.1f}s')
+        return True
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._refresher.join()
+
+    def _refresh_periodically(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception as error:
+                print(f'Refreshing the uptime index failed: {error}')
+            self._ready.set()
+            self._stopped.wait(self.refresh_seconds)
+
+
+_uptime_index_refresher = None
+_uptime_index_refresher_lock = Lock()
+
+
+def get_uptime_index_refresher() -> UptimeIndexRefresher:
+    """
+    Gets the process wide uptime index, starting its refresher on first use.
+    """
+    global _uptime_index_refresher
+    with _uptime_index_refresher_lock:
+        if _uptime_index_refresher is None:
+            _uptime_index_refresher = UptimeIndexRefresher()
+        return _uptime_index_refresher
+
+
+def get_uptime_index_age_seconds() -> float:
+    refresher = _uptime_index_refresher
+    index = refresher.index if refresher is not None else None
+    return monotonic() - index.checked_at if index is not None else 0.0
+
+
+def close_uptime_index_refresher() -> None:
+    """
+    Stops the process wide uptime index refresher, if it was started.
+    """
+    global _uptime_index_refresher
+    with _uptime_index_refresher_lock:
+        if _uptime_index_refresher is not None:
+            _uptime_index_refresher.close()
+            _uptime_index_refresher = None
+
+
+UPTIME_INDEX_AGE_SECONDS.set_function(get_uptime_index_age_seconds)
@@ -0,0 +1,213 @@
+from datetime import datetime, timedelta
+from io import StringIO
+from typing import Iterator, List
+
+import numpy as np
+import pandas as pd
+from pytz import timezone, utc
+
+from report_progress import report_stage
+from reporting import ALL_STORES, LAST_HOUR, LAST_WEEK, REPORT_WINDOWS, get_report_window, get_window_days, \
+    localize_time
+from type_defs import ReportRow, StoreRange
+
+MICROSECONDS_PER_MINUTE = 60_000_000
+MICROSECONDS_PER_HOUR = 3_600_000_000
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+# Status check times are packed next to the store position into one sortable int64 key
+TIME_KEY_BITS = 40
+
+
+def to_epoch_microseconds(value: datetime) -> int:
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def fetch_frame(connection, query: str, parameters: tuple, columns: List[str]) -> pd.DataFrame:
+    """
+    Bulk fetches the result of a query with a single `COPY ... TO STDOUT` into a DataFrame.
+
+    :param connection: A database connection object.
+    :param query: The query to copy out.
+    :param parameters: The parameters of the query.
+    :param columns: The column names of the resulting DataFrame.
+
+    :return: A DataFrame holding every row of the query.
+    """
+    buffer = StringIO()
+    with report_stage('fetch'):
+        with connection.cursor() as cursor:
+            cursor.copy_expert(f'COPY ({cursor.mogrify(query, parameters).decode()}) TO STDOUT WITH (FORMAT csv)',
+                               buffer)
+        if buffer.tell() == 0:
+            return pd.DataFrame(columns=columns)
+        buffer.seek(0)
+        return pd.read_csv(buffer, names=columns, header=None)
+
+
+def expand_business_intervals(stores: pd.DataFrame, business_hours: pd.DataFrame, now: datetime):
+    """
+    Expands the weekly business hours of every store into the concrete business intervals of every report
+    window, clipped to the window. Timezones are localized once per distinct (timezone, day, time) instead of
+    once per store.
+
+    :return: A tuple of a DataFrame of intervals (store_id, window, open_us, close_us) in UTC epoch microseconds
+            and the earliest and latest instant covered by any window.
+    """
+    intervals = []
+    earliest_start = latest_end = None
+    store_business_hours = business_hours.merge(stores, on='store_id')
+    for timezone_name, timezone_business_hours in store_business_hours.groupby('timezone'):
+        store_timezone = timezone(timezone_name)
+        windows = {duration_in_hours: get_report_window(duration_in_hours, store_timezone, now)
+                   for duration_in_hours in REPORT_WINDOWS}
+        week_start, week_end = windows[LAST_WEEK]
+        earliest_start = week_start if earliest_start is None else min(earliest_start, week_start)
+        latest_end = week_end if latest_end is None else max(latest_end, week_end)
+
+        # Smaller windows end with the week window, so the week's days cover all of them
+        days = pd.DataFrame({'day': get_window_days(week_start, week_end)})
+        days['day_of_week'] = [day.weekday() for day in days['day']]
+        business_days = timezone_business_hours.merge(days, on='day_of_week')
+        localized = {}
+        for column in ('start_time_local', 'end_time_local'):
+            for day, time_value in set(zip(business_days['day'], business_days[column])):
+                localized[day, time_value] = to_epoch_microseconds(localize_time(time_value, day, store_timezone))
+        open_us = np.array([localized[key] for key in zip(business_days['day'], business_days['start_time_local'])],
+                           dtype=np.int64)
+        close_us = np.array([localized[key] for key in zip(business_days['day'], business_days['end_time_local'])],
+                            dtype=np.int64)
+
+        for duration_in_hours, (window_start, window_end) in windows.items():
+            window_intervals = pd.DataFrame({
+                'store_id': business_days['store_id'].to_numpy(dtype=np.int64),
+                'window': duration_in_hours,
+                'open_us': np.maximum(open_us, to_epoch_microseconds(window_start)),
+                'close_us': np.minimum(close_us, to_epoch_microseconds(window_end)),
+            })
+            intervals.append(window_intervals[window_intervals['open_us'] < window_intervals['close_us']])
+
+    if not intervals:
+        return pd.DataFrame(columns=['store_id', 'window', 'open_us', 'close_us']), None, None
+    return pd.concat(intervals, ignore_index=True), earliest_start, latest_end
+
+
+def compute_report_rows_vectorized(connection, now: datetime, store_range: StoreRange = ALL_STORES) \
+        -> Iterator[ReportRow]:
+    """
+    Computes the report of every store from one bulk fetch of the status checks and business hours of the
+    report horizon, or from the status index snapshot if it is current. Produces the same rows as
+    `reporting.compute_report_rows`: each (check, business interval)
+    pair becomes one array element holding the time the check's status is held for within the interval's one
+    hour slots (see `reporting.estimate_uptime_downtime`), and the held times are summed per store and window.
+
+    :param connection: A database connection object.
+    :param now: A timezone aware datetime used as the current time of the report.
+    :param store_range: The inclusive range of store ids to report on.
+
+    :return: An iterator of report rows.
+    """
+    from status_index import get_current_status_index
+
+    # A status index snapshot of the current data replaces the queries, see `status_index.py`
+    status_index = get_current_status_index(connection)
+    if status_index is not None:
+        with report_stage('fetch'):
+            stores = status_index.get_stores_frame(store_range)
+            business_hours = status_index.get_business_hours_frame(store_range)
+    else:
+        stores = fetch_frame(connection, """
+            SELECT "StoreTimezones"."store_id", "Timezones"."name" FROM "StoreTimezones"
+            JOIN "Timezones" ON "Timezones"."id" = "StoreTimezones"."timezone_id"
+            WHERE "StoreTimezones"."store_id" BETWEEN %s AND %s
+        """, store_range, ['store_id', 'timezone'])
+        business_hours = fetch_frame(connection, """
+            SELECT "store_id", "day_of_week", "start_time_local", "end_time_local" FROM "StoreBusinessHours"
+            WHERE "store_id" BETWEEN %s AND %s
+        """, store_range, ['store_id', 'day_of_week', 'start_time_local', 'end_time_local'])
+    with report_stage('localize'):
+        intervals, earliest_start, latest_end = expand_business_intervals(stores, business_hours, now)
+
+    totals = pd.DataFrame(columns=['store_id', 'window', 'active', 'held_us'])
+    if not intervals.empty:
+        if status_index is not None and status_index.covers(earliest_start):
+            with report_stage('fetch'):
+                status_checks = status_index.get_status_checks_frame(store_range, earliest_start, latest_end)
+        else:
+            status_checks = fetch_frame(connection, """
+                SELECT "store_id", (EXTRACT(EPOCH FROM "timestamp") * 1000000)::BIGINT, "active"::INT
+                FROM "StoreStatus"
+                WHERE "store_id" BETWEEN %s AND %s AND "timestamp" >= %s AND "timestamp" < %s
+            """, (*store_range, earliest_start.astimezone(utc).replace(tzinfo=None),
+                  latest_end.astimezone(utc).replace(tzinfo=None)),
+                                        ['store_id', 'timestamp_us', 'active'])
+        with report_stage('estimate'):
+            totals = sum_held_time(status_checks, intervals, to_epoch_microseconds(earliest_start))
+
+    with report_stage('estimate'):
+        held = totals.groupby(['store_id', 'active', 'window'])['held_us'].sum().unstack(['active', 'window'])
+        # Columns in "ReportData" order: the uptime of every window, then the downtime of every window
+        held = held.reindex(index=stores['store_id'], columns=pd.MultiIndex.from_product([[1, 0], REPORT_WINDOWS]))
+        divisors = [MICROSECONDS_PER_MINUTE if duration_in_hours == LAST_HOUR else MICROSECONDS_PER_HOUR
+                    for _, duration_in_hours in held.columns]
+        report = held.fillna(0).to_numpy(dtype=np.int64) // np.array(divisors, dtype=np.int64)
+    for store_id, report_row in zip(stores['store_id'], report):
+        yield int(store_id), *(int(value) for value in report_row)
+
+
+def sum_held_time(status_checks: pd.DataFrame, intervals: pd.DataFrame, horizon_start_us: int) -> pd.DataFrame:
+    """
+    Attributes the time between status checks to statuses, for every business interval at once.
+
+    :param status_checks: A DataFrame of status checks (store_id, timestamp_us, active).
+    :param intervals: A DataFrame of business intervals (store_id, window, open_us, close_us).
+    :param horizon_start_us: A lower bound of every check and interval time, in epoch microseconds.
+
+    :return: A DataFrame of (store_id, window, active, held_us) with one row per check and interval.
+    """
+    status_checks = status_checks.sort_values(['store_id', 'timestamp_us'])
+    store_ids = np.unique(status_checks['store_id'].to_numpy(dtype=np.int64))
+    check_times = status_checks['timestamp_us'].to_numpy(dtype=np.int64)
+    check_active = status_checks['active'].to_numpy(dtype=np.int64)
+    check_keys = (np.searchsorted(store_ids, status_checks['store_id'].to_numpy(dtype=np.int64))
+                  << TIME_KEY_BITS) | (check_times - horizon_start_us)
+
+    # Only intervals of stores with status checks can hold any time
+    interval_store_ids = intervals['store_id'].to_numpy(dtype=np.int64)
+    store_positions = np.searchsorted(store_ids, interval_store_ids)
+    has_checks = store_positions < len(store_ids)
+    has_checks[has_checks] = store_ids[store_positions[has_checks]] == interval_store_ids[has_checks]
+    intervals = intervals[has_checks]
+    store_positions = store_positions[has_checks]
+    open_us = intervals['open_us'].to_numpy(dtype=np.int64)
+    close_us = intervals['close_us'].to_numpy(dtype=np.int64)
+
+    # The checks of an interval are the contiguous run of [open, close) in the (store, time) ordering
+    first_check = np.searchsorted(check_keys, (store_positions << TIME_KEY_BITS) | (open_us - horizon_start_us))
+    end_check = np.searchsorted(check_keys, (store_positions << TIME_KEY_BITS) | (close_us - horizon_start_us))
+    check_counts = end_check - first_check
+    interval_index = np.repeat(np.arange(len(intervals)), check_counts)
+    position = np.arange(len(interval_index)) - np.repeat(np.cumsum(check_counts) - check_counts, check_counts)
+    check_index = first_check[interval_index] + position
+
+    times = check_times[check_index]
+    interval_open = open_us[interval_index]
+    interval_close = close_us[interval_index]
+    slot = (times - interval_open) // MICROSECONDS_PER_HOUR
+    is_first = position == 0
+    is_last = position == check_counts[interval_index] - 1
+    next_times = np.roll(times, -1)
+    next_slot = np.roll(slot, -1)
+
+    # The first check of a slot is extrapolated back to the slot's start ...
+    first_in_slot = is_first | (slot != np.roll(slot, 1))
+    backward = np.where(first_in_slot, times - (interval_open + slot * MICROSECONDS_PER_HOUR), 0)
+    # ... and every check holds until the next check of its slot, the next slot with a check or the close
+    forward_end = np.where(is_last, interval_close,
+                           np.where(next_slot == slot, next_times, interval_open + next_slot * MICROSECONDS_PER_HOUR))
+
+    return pd.DataFrame({
+        'store_id': intervals['store_id'].to_numpy(dtype=np.int64)[interval_index],
+        'window': intervals['window'].to_numpy(dtype=np.int64)[interval_index],
+        'active': check_active[check_index],
+        'held_us': backward + forward_end - times,
+    })
@@ -0,0 +1,104 @@
+import argparse
+import os
+import signal
+import socket
+import time
+from datetime import timedelta
+from multiprocessing import get_context
+
+import psycopg2
+
+from db import get_connection_parameters
+from jobs import DEFAULT_JOB_LEASE_DURATION, DEFAULT_MAX_RUNNING_JOBS, claim_report_job, recover_stale_report_jobs, \
+    run_report_job
+from schema import bootstrap_schema
+from status_index import get_status_index
+
+DEFAULT_WORKER_PROCESSES = int(os.environ.get('REPORT_WORKER_PROCESSES', 2))
+DEFAULT_POLL_INTERVAL_SECONDS = 2.0
+
+_stopping = False
+
+
+def request_stop(signal_number, frame) -> None:
+    """
+    Lets the worker finish its current job and exit, instead of dying in the middle of it.
+    """
+    global _stopping
+    _stopping = True
+
+
+def run_job_worker(poll_interval: float = DEFAULT_POLL_INTERVAL_SECONDS,
+                   lease_duration: timedelta = DEFAULT_JOB_LEASE_DURATION,
+                   max_running: int = DEFAULT_MAX_RUNNING_JOBS, max_jobs: int | None = None) -> int:
+    """
+    Claims and runs report jobs one at a time with a connection of its own, recovering stale jobs between claims,
+    until it is asked to stop (SIGTERM or SIGINT).
+
+    :param poll_interval: Seconds to wait for new jobs once none is left.
+    :param lease_duration: How long a claimed job stays leased to this worker between renewals.
+    :param max_running: Claim nothing while this many jobs are running across all workers, or 0 for no limit.
+    :param max_jobs: Stop after this many jobs, or never when None.
+
+    :return: The number of jobs run by this worker.
+    """
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    connection = psycopg2.connect(**get_connection_parameters())
+    bootstrap_schema(connection)
+    # Maps the status index snapshot, if any, before the first job needs it
+    get_status_index()
+    job_count = 0
+    try:
+        while not _stopping and (max_jobs is None or job_count < max_jobs):
+            recover_stale_report_jobs(connection)
+            job = claim_report_job(connection, worker_id, lease_duration, max_running)
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+            run_report_job(connection, worker_id, job, lease_duration)
+            job_count += 1
+    finally:
+        connection.close()
+    return job_count
+
+
+def run_worker_pool(processes: int = DEFAULT_WORKER_PROCESSES, **worker_options) -> None:
+    """
+    Runs `processes` job workers, each in a process of its own, so report computation never competes with the
+    API for its CPU or connections. Workers started on other hosts share the same queue. SIGTERM and SIGINT are
+    passed on to the workers, which finish their current job before exiting.
+    """
+    connection = psycopg2.connect(**get_connection_parameters())
+    bootstrap_schema(connection)
+    connection.close()
+    context = get_context('spawn')
+    workers = [context.Process(target=run_job_worker, kwargs=worker_options) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    def stop_workers(signal_number, frame) -> None:
+        for running_worker in workers:
+            if running_worker.is_alive():
+                running_worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a pool of processes generating queued reports.')
+    parser.add_argument('--processes', type=int, default=DEFAULT_WORKER_PROCESSES,
+                        help='Worker processes, each running one report at a time.')
+    parser.add_argument('--max-running', type=int, default=DEFAULT_MAX_RUNNING_JOBS,
+                        help='Limit of reports running at once across every worker, 0 for no limit.')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL_SECONDS)
+    parser.add_argument('--lease-seconds', type=int, default=int(DEFAULT_JOB_LEASE_DURATION.total_seconds()))
+    arguments = parser.parse_args()
+
+    print(f'Starting {arguments.processes} report workers...')
+    run_worker_pool(arguments.processes, poll_interval=arguments.poll_interval,
+                    lease_duration=timedelta(seconds=arguments.lease_seconds), max_running=arguments.max_running)